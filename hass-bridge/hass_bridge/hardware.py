@@ -1,8 +1,15 @@
+import collections
+import itertools
 import logging
+import math
+import os
+import selectors
 import serial
 import sys
 import json
 import time
+from .metrics import QueueStats, Registry
+from .scheduler import Scheduler
 
 log = logging.getLogger(__name__)
 
@@ -10,29 +17,219 @@ log = logging.getLogger(__name__)
 # do any character encoding or decoding
 hw_charset = "ascii"
 
+# Transaction priorities, most urgent first.  A queued transaction
+# never waits for one of lower priority, except for the one already in
+# progress.
+PRIORITY_SET = 0    # Writes requested through MQTT
+PRIORITY_READ = 1   # Reads needed to carry out an MQTT command
+PRIORITY_TCP = 2    # Commands from TCP clients
+PRIORITY_POLL = 3   # Background polling of registers
+PRIORITY_NAMES = ["set", "read", "tcp", "poll"]
+
+# Default fraction of each bus's time that background polling may use
+MAX_POLL_UTILISATION = 0.7
+
+# Commands counted by name in the metrics; anything else is "other"
+COMMANDS = {"SELECT", "READ", "SET", "HELP", "SCANBUS"}
+
+
+class BusMetrics:
+    """Counters and histograms of bus transactions
+
+    These are shared by all the buses in a process, with the bus's
+    serial port as a label.
+    """
+    def __init__(self, registry=None):
+        self.registry = registry or Registry()
+        self.transactions = self.registry.counter(
+            "fvbridge_transactions_total",
+            "Bus transactions by controller, command and result",
+            ("bus", "controller", "command", "result"))
+        self.noise = self.registry.counter(
+            "fvbridge_noisy_responses_total",
+            "Responses with NUL characters from a floating line in them",
+            ("bus",))
+        self.selects = self.registry.counter(
+            "fvbridge_selects_total",
+            "Transactions whose controller was already selected (hit) "
+            "or had to be selected first (miss)",
+            ("bus", "result"))
+        self.latency = self.registry.histogram(
+            "fvbridge_transaction_seconds",
+            "Time from starting a transaction to its response, "
+            "including any SELECT",
+            ("bus", "command"))
+        self.wait = self.registry.histogram(
+            "fvbridge_queue_wait_seconds",
+            "Time transactions waited for the bus",
+            ("bus", "priority"))
+
+
+def classify(response):
+    """Summarise a response for the metrics
+    """
+    if response.startswith(b"OK "):
+        return "ok"
+    if response in (b"TIMEOUT\n", b"CORRUPT\n"):
+        return response[:-1].decode(hw_charset).lower()
+    return "error"
+
+
+class DiscoveryQueue:
+    """Home Assistant discovery messages waiting to be published
+
+    The messages are retained by the broker, so Home Assistant gets
+    them when it starts without our help, and we only publish a
+    message when it has changed since we last did.  They are sent at
+    no more than rate per second, so as not to flood the broker and
+    Home Assistant, and only while we are connected to the broker.
+    """
+    rate = 20
+
+    def __init__(self, mqttc, scheduler):
+        self.mqttc = mqttc
+        self.scheduler = scheduler
+        # topic -> payload last published
+        self.published = {}
+        # topic -> (payload, callback) in the order queued
+        self.pending = {}
+        self.timer = None
+
+    def publish(self, topic, payload, callback=None):
+        """Queue a message to be published if it has changed
+
+        callback is called once it has been published, or straight
+        away if it is unchanged.
+        """
+        if topic not in self.pending and self.published.get(topic) == payload:
+            if callback:
+                callback()
+            return
+        self.pending[topic] = (payload, callback)
+        self.resume()
+
+    def forget(self):
+        """Publish every message again, even if it is unchanged
+
+        Used after reconnecting, since a broker that restarted without
+        persistence has lost its retained messages.
+        """
+        self.published.clear()
+
+    def resume(self):
+        if self.pending and not self.timer:
+            self.timer = self.scheduler.call_later(0, self.send_next)
+
+    def send_next(self):
+        self.timer = None
+        if not self.pending or not self.mqttc.is_connected():
+            # We carry on once connected
+            return
+        topic = next(iter(self.pending))
+        payload, callback = self.pending.pop(topic)
+        self.mqttc.publish(topic, payload, retain=True)
+        self.published[topic] = payload
+        if callback:
+            callback()
+        if self.pending:
+            self.timer = self.scheduler.call_later(
+                1 / self.rate, self.send_next)
+
+
+class Transaction:
+    """A command to be sent on the bus, and what to do with the response
+
+    If ident is set, that controller is selected first if it isn't
+    already.  The callback is called with the response as bytes: a
+    single line, or TIMEOUT or CORRUPT if the controller didn't
+    respond properly.  If the controller couldn't be selected, the
+    callback gets the response to the SELECT command instead.
+    """
+    def __init__(self, ident, command, callback=None,
+                 priority=PRIORITY_POLL):
+        self.ident = ident
+        self.command = command
+        self.callback = callback
+        self.priority = priority
+        self.submitted = None
+
 
 class Bus:
     """A system of controllers connected via a serial port
+
+    Transactions are queued by priority and run one at a time, so that
+    a command from the user only ever has to wait for the transaction
+    already in progress however much polling is queued.  The serial
+    port is never read from while blocking: the main loop waits for it
+    to become readable along with everything else, and a timer deals
+    with controllers that don't respond.
     """
+    # How long to wait for a controller to respond
+    response_timeout = 1.0
+    # Weight of each new measurement in the running average of the
+    # time a transaction takes
+    cost_weight = 0.1
+    # Background polling may build up this many seconds of unused bus
+    # time to spend in a burst
+    poll_burst = 1.0
+
     def __init__(self, sp_path, config, mqttc, ha_discovery_prefix,
-                 mqtt_path):
+                 mqtt_path, cache_max_age=0, scheduler=None,
+                 discovery=None, max_poll_utilisation=MAX_POLL_UTILISATION,
+                 metrics=None):
         self.log = log.getChild(sp_path)
+        self.sp_path = sp_path
+        self.metrics = metrics or BusMetrics()
+        self.scheduler = scheduler or Scheduler()
         self.mqttc = mqttc
+        # Buses in one process share their discovery queue, so that
+        # its rate limit applies to them all
+        self.discovery = discovery or DiscoveryQueue(mqttc, self.scheduler)
         self.ha_discovery_prefix = ha_discovery_prefix
         self.mqtt_path = mqtt_path
         self.availability_topic = f"{mqtt_path}/status"
+        # The ident of the controller currently selected
         self.selected = None
+        # One queue per priority
+        self.queues = [collections.deque() for _ in PRIORITY_NAMES]
+        self.stats = [QueueStats() for _ in PRIORITY_NAMES]
+        # The transaction in progress, the command we have sent for
+        # it, and what we have received so far in response
+        self.current = None
+        self.sent = None
+        self.rxbuf = b""
+        self.selecting = False
+        self.deadline = None
+        self.started = 0.0
+        # Running average of the time a transaction takes, in seconds
+        self.transaction_cost = 0.05
+        # Background polling may use at most this fraction of the
+        # bus's time, so there is always room for interactive commands.
+        # Polls earn credit at this rate, spend it on the time their
+        # transactions take, and wait while it is negative.
+        self.max_poll_utilisation = max_poll_utilisation
+        self.poll_credit = 0.0
+        self.credit_updated = time.monotonic()
+        self.budget_timer = None
+        # Sequence of phase offsets for registers' polls
+        self.phases = itertools.count()
         self.mqtt_topics = {}
-        self.last_online_announcement = 0.0
+        # Default maximum age of cached register values used to answer
+        # READ commands from TCP clients; 0 disables the cache
+        self.cache_max_age = cache_max_age
 
         self.log.debug("About to open serial port")
         try:
-            self.s = serial.Serial(sp_path, timeout=1.0)
+            self.s = serial.Serial(sp_path, timeout=0.1)
         except serial.SerialException:
             self.log.error("Could not open serial port")
             sys.exit(1)
 
         self.full_reset()
+        # From now on reads must not block
+        self.s.timeout = 0
+        # Controllers are probed once the main loop is running, and
+        # come online as they answer
         self.controllers = {k: Controller(k, self, v)
                             for k, v in config.items()}
 
@@ -41,24 +238,13 @@ class Bus:
         """
         self.log.debug("Sending HA discovery messages")
         for controller in self.controllers.values():
-            controller.send_ha_discovery()
-        # Schedule next announcement for 5s in the future
-        self.last_online_announcement = time.time() - 55.0
+            if controller.known:
+                controller.send_ha_discovery()
 
-    def announce_online(self):
-        if time.time() - self.last_online_announcement < 60.0:
-            return
-        self.mqttc.publish(self.availability_topic, b"online")
-        self.last_online_announcement = time.time()
-
-    def process_mqtt_message(self, msg):
-        topic = msg.topic
-        payload = msg.payload.decode("utf8")
-        if topic in self.mqtt_topics:
-            self.mqtt_topics[topic].process_mqtt_message(topic, payload)
-        elif topic == f"{self.ha_discovery_prefix}/status" \
-           and payload == "online":  # noqa: E127
-            self.send_ha_discovery()
+    def republish(self):
+        for controller in self.controllers.values():
+            if controller.known:
+                controller.republish()
 
     def full_reset(self):
         """Return the bus to a known state
@@ -77,78 +263,654 @@ class Bus:
             foo = self.s.read()
             self.selected = None
 
-    def communicate(self, command):
+    def submit(self, transaction):
+        """Queue a transaction to be run on the bus
+        """
+        transaction.submitted = time.monotonic()
+        self.queues[transaction.priority].append(transaction)
+        self.stats[transaction.priority].queued()
+        self.start_next()
+
+    def next_phase(self):
+        """Return a phase offset for a register, as a fraction
+
+        Successive offsets are multiples of the golden ratio, so
+        however many registers there are they are spread evenly.
+        """
+        return (next(self.phases) * 0.6180339887) % 1.0
+
+    def update_poll_credit(self, spent=0.0):
+        now = time.monotonic()
+        self.poll_credit = min(
+            self.poll_credit + (now - self.credit_updated)
+            * self.max_poll_utilisation - spent,
+            self.poll_burst * self.max_poll_utilisation)
+        self.credit_updated = now
+
+    def budget_ready(self):
+        self.budget_timer = None
+        self.start_next()
+
+    def start_next(self):
+        if self.current:
+            return
+        queue = next((q for q in self.queues if q), None)
+        if not queue:
+            return
+        if queue is self.queues[PRIORITY_POLL] \
+           and self.max_poll_utilisation < 1.0:  # noqa: E127
+            self.update_poll_credit()
+            if self.poll_credit < 0:
+                # Wait until polling has earned enough credit
+                if not self.budget_timer:
+                    self.budget_timer = self.scheduler.call_later(
+                        -self.poll_credit / self.max_poll_utilisation,
+                        self.budget_ready)
+                return
+        self.current = queue.popleft()
+        self.started = time.monotonic()
+        wait = self.started - self.current.submitted
+        self.stats[self.current.priority].started(wait)
+        self.metrics.wait.observe(
+            wait, self.sp_path, PRIORITY_NAMES[self.current.priority])
+        ident = self.current.ident
+        self.selecting = ident is not None and ident != self.selected
+        if ident is not None:
+            self.metrics.selects.inc(
+                self.sp_path, "miss" if self.selecting else "hit")
+        if self.selecting:
+            self.send(f"SELECT {ident}".encode(hw_charset))
+        else:
+            self.send(self.current.command)
+
+    def send(self, command):
+        self.sent = command
+        self.rxbuf = b""
         self.s.write(command + b"\n")
-        response = self.s.read_until()
+        self.deadline = self.scheduler.call_later(
+            self.response_timeout, self.timed_out)
+
+    def event(self, fileobj, mask):
+        """The serial port is readable
+        """
+        data = self.s.read(self.s.in_waiting or 1)
+        if self.sent is None:
+            self.log.debug("Discarding unexpected data %s", data)
+            return
+        self.rxbuf += data
+        if b"\n" in self.rxbuf:
+            # No controller will send more than one line
+            self.received(self.rxbuf[:self.rxbuf.index(b"\n") + 1])
+
+    def timed_out(self):
+        self.deadline = None
+        self.received(self.rxbuf)
+
+    def received(self, response):
+        if self.deadline:
+            self.deadline.cancel()
+            self.deadline = None
+        sent = self.sent
+        self.sent = None
+        self.rxbuf = b""
         # A floating line produces \0 characters.  Remove them.
-        response = response.replace(b'\0', b'')
+        if b'\0' in response:
+            self.metrics.noise.inc(self.sp_path)
+            response = response.replace(b'\0', b'')
         if response == b"":
             response = b"TIMEOUT\n"
         elif response[-1] != ord("\n"):
             response = b"CORRUPT\n"
-        return response
+        if sent.startswith(b"SELECT "):
+            ident = sent[7:].decode(hw_charset)
+            if response == f"OK {ident} selected\n".encode(hw_charset):
+                self.selected = ident
+            else:
+                self.selected = None
+        transaction = self.current
+        if self.selecting:
+            self.selecting = False
+            if self.selected == transaction.ident:
+                self.send(transaction.command)
+                return
+            self.log.error("Could not select %s, got %s instead",
+                           transaction.ident, response)
+        self.current = None
+        cost = time.monotonic() - self.started
+        self.transaction_cost += self.cost_weight * (
+            cost - self.transaction_cost)
+        command, _, arg = transaction.command.partition(b" ")
+        command = command.decode(hw_charset, errors="replace")
+        if command not in COMMANDS:
+            command = "other"
+        self.metrics.transactions.inc(
+            self.sp_path,
+            transaction.ident or arg.decode(hw_charset, errors="replace"),
+            command, classify(response))
+        self.metrics.latency.observe(cost, self.sp_path, command)
+        if transaction.priority == PRIORITY_POLL \
+           and self.max_poll_utilisation < 1.0:  # noqa: E127
+            self.update_poll_credit(cost)
+        if transaction.callback:
+            transaction.callback(response)
+        self.start_next()
+
+    def run_until_idle(self):
+        """Run queued transactions until there are none left
+
+        For use when there is no main loop, e.g. in benchmarks.
+        """
+        sel = selectors.DefaultSelector()
+        sel.register(self.s, selectors.EVENT_READ, self)
+        while self.current or any(self.queues):
+            for key, mask in sel.select(self.scheduler.timeout(1.0)):
+                self.event(key.fileobj, mask)
+            self.scheduler.run_due()
+        sel.close()
+
+    def stats_response(self):
+        """Describe the queues and how many states we have published,
+        in response to STATS from a TCP client
+        """
+        lines = [f"{name} {stats}\n"
+                 for name, stats in zip(PRIORITY_NAMES, self.stats)]
+        registers = [r for c in self.controllers.values()
+                     for r in c.registers.values()]
+        states = [c.state for c in self.controllers.values()]
+        lines.append("controllers " + " ".join(
+            f"{state}={states.count(state)}" for state in
+            (Controller.CLOSED, Controller.HALF_OPEN, Controller.OPEN))
+            + "\n")
+        lines.append(
+            f"mqtt published={sum(r.published for r in registers)} "
+            f"suppressed={sum(r.suppressed for r in registers)}\n")
+        lines.append(
+            f"bus transaction_cost={self.transaction_cost:.3f} "
+            f"poll_load={self.poll_load():.3f} "
+            f"max_poll_utilisation={self.max_poll_utilisation:.3f}\n")
+        return (f"OK STATS {len(lines)}\n" + "".join(lines)).encode(
+            hw_charset)
+
+    def poll_load(self):
+        """The fraction of the bus's time polling needs at the current
+        intervals
+        """
+        return self.transaction_cost * sum(
+            1 / r.poll_interval for c in self.controllers.values()
+            if c.online for r in c.registers.values())
+
+    def cached_response(self, ident, sent_b: bytes):
+        """Answer a READ command from a TCP client using the cache
 
-    def interpret(self, sent_b: bytes, received_b: bytes):
+        Returns None if the command isn't a READ or the cache doesn't
+        have a recent enough value.
+        """
+        controller = self.controllers.get(ident)
+        if not sent_b.startswith(b"READ ") or not controller:
+            return
+        val = controller.cached_read(sent_b[5:].decode(hw_charset))
+        if val is None:
+            return
+        self.log.debug("3rd party sent: %s answered from cache", sent_b)
+        return f"OK {val}\n".encode(hw_charset)
+
+    def tcp_transaction(self, client, sent_b: bytes, callback):
+        """Run a command from a TCP client
+
+        callback is called with the response.  Each client has its own
+        idea of which controller is selected, in client.selected; if we
+        have selected a different one since, we select the client's one
+        again before running the command.
+        """
+        # A leading "!" means don't answer from the cache
+        cached = not sent_b.startswith(b"!")
+        if not cached:
+            sent_b = sent_b[1:]
+        if sent_b == b"STATS":
+            callback(self.stats_response())
+            return
+        if sent_b.startswith(b"SELECT "):
+            ident = sent_b[7:].decode(hw_charset)
+
+            def selected(received_b):
+                self.log.debug("3rd party sent: %s received %s",
+                               sent_b, received_b)
+                client.selected = ident if self.selected == ident else None
+                callback(received_b)
+            self.submit(Transaction(None, sent_b, selected, PRIORITY_TCP))
+            return
+        if client.selected is None:
+            # No controller would answer
+            callback(b"TIMEOUT\n")
+            return
+        if cached:
+            received_b = self.cached_response(client.selected, sent_b)
+            if received_b:
+                callback(received_b)
+                return
+        ident = client.selected
+        controller = self.controllers.get(ident)
+        if controller and sent_b.startswith(b"SET "):
+            controller.setting(
+                sent_b[4:].split(b" ")[0].decode(hw_charset, errors="replace"))
+        started = time.monotonic()
+
+        def done(received_b):
+            self.interpret(ident, sent_b, received_b, started)
+            callback(received_b)
+        self.submit(Transaction(ident, sent_b, done, PRIORITY_TCP))
+
+    def cancel_polls(self, ident):
+        """Drop the background polls queued for a controller
+
+        Their callbacks are called as if the controller hadn't
+        answered.
+        """
+        queue = self.queues[PRIORITY_POLL]
+        dropped = [t for t in queue if t.ident == ident]
+        if not dropped:
+            return
+        self.queues[PRIORITY_POLL] = collections.deque(
+            t for t in queue if t.ident != ident)
+        self.stats[PRIORITY_POLL].depth -= len(dropped)
+        for transaction in dropped:
+            if transaction.callback:
+                transaction.callback(b"TIMEOUT\n")
+
+    def interpret(self, ident, sent_b: bytes, received_b: bytes, started):
         # The TCP interface was used to communicate directly with the
         # hardware. Try to figure out what happened.
         self.log.debug("3rd party sent: %s received %s", sent_b, received_b)
-        sent = sent_b.decode(hw_charset)
-        received = received_b.decode(hw_charset)
-        if sent.startswith("SELECT "):
-            selected = sent[7:]
-            if received == f"OK {selected} selected\n":
-                self.selected = self.controllers.get(selected)
-            else:
-                self.selected = None
-            self.log.debug("Controller selected: %s", self.selected)
+        controller = self.controllers.get(ident)
+        if controller:
+            controller.interpret(sent_b.decode(hw_charset),
+                                 received_b.decode(hw_charset), started)
         else:
-            if self.selected:
-                self.selected.interpret(sent, received)
-            else:
-                self.log.debug("No controller selected, ignoring")
+            self.log.debug("Not one of our controllers, ignoring")
+
+
+class Bridge:
+    """All the buses served by one process, sharing an MQTT client
+
+    Each bus has its own serial port and transaction queue, and they
+    all run at once from the main loop.
+
+    If the connection to the MQTT broker is lost we keep polling, and
+    reconnect with exponential backoff.  Once reconnected we publish
+    discovery, availability and the register values we already have
+    again, without polling anything.
+    """
+    # Delay before reconnecting to the MQTT broker; this doubles after
+    # each failure up to the maximum
+    reconnect_delay_min = 1
+    reconnect_delay_max = 60
+    # How long Home Assistant may take to subscribe to state topics
+    # after announcing that it is online
+    ha_settle_time = 5
+    # How often to save register values to the state file, if any
+    save_interval = 60
+
+    def __init__(self, buses, mqttc, ha_discovery_prefix, mqtt_path,
+                 scheduler, state_file=None, metrics=None):
+        self.buses = buses
+        self.mqttc = mqttc
+        self.ha_discovery_prefix = ha_discovery_prefix
+        self.mqtt_path = mqtt_path
+        self.availability_topic = f"{mqtt_path}/status"
+        self.scheduler = scheduler
+        self.last_online_announcement = 0.0
+        self.connected_before = False
+        self.reconnect_delay = self.reconnect_delay_min
+        self.reconnect_timer = None
+        self.state_file = state_file
+        if state_file:
+            self.load_state()
+            self.scheduler.call_later(self.save_interval, self.periodic_save)
+        # Normally the same metrics as the buses'
+        self.metrics = metrics or BusMetrics()
+        self.add_metrics()
+
+    def add_metrics(self):
+        """Expose figures we keep anyway; they are read when asked for
+        """
+        registry = self.metrics.registry
+        registry.sampled(
+            "fvbridge_queue_depth", "Transactions waiting for the bus",
+            ("bus", "priority"), lambda: (
+                ((bus.sp_path, name), stats.depth) for bus in self.buses
+                for name, stats in zip(PRIORITY_NAMES, bus.stats)))
+        registry.sampled(
+            "fvbridge_poll_load",
+            "Fraction of the bus's time polling needs at the current "
+            "intervals",
+            ("bus",), lambda: (
+                ((bus.sp_path,), bus.poll_load()) for bus in self.buses))
+        registry.sampled(
+            "fvbridge_controller_up",
+            "Whether the controller is answering, i.e. its circuit "
+            "breaker is closed",
+            ("bus", "controller"), lambda: (
+                ((bus.sp_path, c.name), int(c.online))
+                for bus in self.buses for c in bus.controllers.values()))
+        for name, attr, help in (
+                ("fvbridge_states_published_total", "published",
+                 "Register states published to MQTT"),
+                ("fvbridge_states_suppressed_total", "suppressed",
+                 "Register states not published because they were "
+                 "unchanged"),
+                ("fvbridge_commands_superseded_total", "superseded",
+                 "Commands from MQTT dropped because a newer one arrived "
+                 "before they were written")):
+            registry.sampled(
+                name, help, ("bus", "controller"),
+                self.register_totals(attr), kind="counter")
+
+    def register_totals(self, attr):
+        """Return a function summing a count over each controller's
+        registers, for the metrics
+        """
+        def sample():
+            for bus in self.buses:
+                for c in bus.controllers.values():
+                    yield ((bus.sp_path, c.name), sum(
+                        getattr(r, attr) for r in c.registers.values()))
+        return sample
+
+    @property
+    def controllers(self):
+        for bus in self.buses:
+            yield from bus.controllers.values()
+
+    def load_state(self):
+        """Restore register values saved by a previous run
+
+        These are published as soon as we connect to the broker, so
+        that Home Assistant has something to show before the
+        registers have been polled.
+        """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning("Could not read state file %s: %s",
+                        self.state_file, e)
+            return
+        # Check everything before restoring anything, so that a file
+        # in an old format or edited by hand leaves us with no state
+        # rather than stopping us from starting
+        try:
+            saved = {
+                name: (c["sw_version"], {
+                    reg: (str(r["value"]), float(r["time"]))
+                    for reg, r in c["registers"].items()})
+                for name, c in state["controllers"].items()}
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            log.warning("Ignoring state file %s in an unexpected format: "
+                        "%r", self.state_file, e)
+            return
+        for controller in self.controllers:
+            if controller.name in saved:
+                controller.restore(*saved[controller.name])
+
+    def save_state(self):
+        """Save register values to the state file
+
+        The file is replaced atomically, so a crash part way through
+        leaves the previous version intact.
+        """
+        state = {
+            "saved": time.time(),
+            "controllers": {c.name: c.snapshot() for c in self.controllers},
+        }
+        tmp = f"{self.state_file}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.state_file)
+        except OSError as e:
+            log.error("Could not write state file %s: %s",
+                      self.state_file, e)
+
+    def periodic_save(self):
+        self.save_state()
+        self.scheduler.call_later(self.save_interval, self.periodic_save)
+
+    def mqtt_connected(self):
+        self.reconnect_delay = self.reconnect_delay_min
+        for bus in self.buses:
+            bus.discovery.resume()
+        if self.connected_before:
+            log.info("Reconnected to MQTT broker; republishing")
+            self.republish()
+        else:
+            self.connected_before = True
+            self.send_ha_discovery()
+
+    def mqtt_disconnected(self):
+        """Arrange to reconnect to the MQTT broker after a delay
+        """
+        if self.reconnect_timer:
+            return
+        log.warning("Reconnecting to MQTT broker in %ds",
+                    self.reconnect_delay)
+        self.reconnect_timer = self.scheduler.call_later(
+            self.reconnect_delay, self.reconnect)
+        self.reconnect_delay = min(
+            self.reconnect_delay * 2, self.reconnect_delay_max)
+
+    def reconnect(self):
+        self.reconnect_timer = None
+        try:
+            self.mqttc.reconnect()
+        except OSError as e:
+            log.error("Could not reconnect to MQTT broker: %s", e)
+            self.mqtt_disconnected()
+
+    def republish(self):
+        """Publish discovery, availability and the values we already have
+
+        This is done after reconnecting to the broker, which may have
+        restarted and lost the retained discovery messages, and when
+        Home Assistant restarts, since states aren't retained.
+        Discovery messages are still rate limited, and each register's
+        state follows its discovery message.
+        """
+        for discovery in {bus.discovery for bus in self.buses}:
+            discovery.forget()
+        self.last_online_announcement = 0.0
+        self.announce_online()
+        for bus in self.buses:
+            bus.republish()
+
+    def send_ha_discovery(self):
+        for bus in self.buses:
+            bus.send_ha_discovery()
+        # Schedule next announcement for 5s in the future
+        self.last_online_announcement = time.time() - 55.0
+
+    def announce_online(self):
+        if time.time() - self.last_online_announcement < 60.0:
+            return
+        self.mqttc.publish(self.availability_topic, b"online")
+        self.last_online_announcement = time.time()
+
+    def process_mqtt_message(self, msg):
+        topic = msg.topic
+        payload = msg.payload.decode("utf8")
+        for bus in self.buses:
+            if topic in bus.mqtt_topics:
+                bus.mqtt_topics[topic].process_mqtt_message(topic, payload)
+                return
+        if topic == f"{self.ha_discovery_prefix}/status" \
+           and payload == "online":  # noqa: E127
+            # Give Home Assistant time to subscribe to our topics
+            self.scheduler.call_later(self.ha_settle_time, self.republish)
+
+    def bus_for(self, ident):
+        """Return the bus a controller is on
+
+        Controllers we don't know about are assumed to be on the first
+        bus.
+        """
+        for bus in self.buses:
+            if ident in bus.controllers:
+                return bus
+        return self.buses[0]
+
+    def tcp_transaction(self, client, sent_b: bytes, callback):
+        """Pass a command from a TCP client to the right bus
+
+        A SELECT goes to the bus the controller is on, and the client's
+        other commands go to the bus of its last SELECT.
+        """
+        command = sent_b[1:] if sent_b.startswith(b"!") else sent_b
+        if command.startswith(b"SELECT "):
+            client.selected_bus = self.bus_for(
+                command[7:].decode(hw_charset))
+        bus = client.selected_bus or self.buses[0]
+        bus.tcp_transaction(client, sent_b, callback)
+
+    def timeout(self, maximum=None):
+        """Return how long the main loop may wait for events
+        """
+        return self.scheduler.timeout(maximum)
 
     def poll(self):
-        for controller in self.controllers.values():
-            controller.poll()
+        """Deal with response timeouts and polls on all the buses
+        """
+        self.scheduler.run_due()
 
 
 class Controller:
+    # Interval between probes of a controller that hasn't answered;
+    # this doubles after each failure up to the maximum
+    probe_interval_min = 10
+    probe_interval_max = 600
+    # After this many transactions in a row have had no response the
+    # controller is taken to be offline
+    failure_threshold = 3
+    # States of the circuit breaker: closed while the controller is
+    # answering and its registers are polled, open while it isn't and
+    # they aren't, and half-open while a probe is in progress
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
     def __init__(self, name, bus, config):
         self.log = bus.log.getChild(name)
         self.name = name
         self.bus = bus
         self.mqtt_path = f"{bus.mqtt_path}/{name}"
+        self.availability_topic = f"{self.mqtt_path}/status"
         self.entity_prefix = config.get("entity_prefix", name.lower())
         self.unique_id = f"fvc_{name}"
         self.buttons = []
+        # Register name -> (time, value) of recent reads, for
+        # answering READ commands from TCP clients
+        self.cache = {}
+        # Register name -> time the most recent SET was started
+        self.set_times = {}
+        self.sw_version = None
+        self.state = self.OPEN
+        # Consecutive transactions with no response
+        self.failures = 0
+        self.failure_threshold = config.get(
+            "failure_threshold", self.failure_threshold)
+        self.published_availability = None
+        self.probe_interval = self.probe_interval_min
         self.registers = {
             r: Register.all_registers[r](self, r, config.get(r, {}))
             for r in config.get("registers", [])}
         if not self.registers:
             self.log.warning("No registers declared")
-        self.ping()
-        self.sw_version = self.read("ver")
+        self.probe()
 
     def __str__(self):
         return self.name
 
-    def select(self):
-        if self.bus.selected == self:
-            return True
-        r = self.bus.communicate(f"SELECT {self.name}".encode(hw_charset))
-        if r != f"OK {self.name} selected\n".encode(hw_charset):
-            self.log.error(f"Could not select, got {r} instead")
-            self.bus.selected = None
-            return False
-        self.bus.selected = self
-        return True
+    @property
+    def online(self):
+        return self.state == self.CLOSED
 
-    def read(self, reg):
-        if not self.select():
-            return
-        r = self.bus.communicate(f"READ {reg}".encode(hw_charset))\
-                    .decode(hw_charset)
-        return self.process_read_reply(r)
+    @property
+    def known(self):
+        """Do we know enough about the controller to announce it?
+
+        This is true once it has answered a probe, or if we restored
+        its state from a previous run.
+        """
+        return self.online or self.sw_version is not None
+
+    def snapshot(self):
+        return {
+            "sw_version": self.sw_version,
+            "registers": {
+                name: {"value": reg.value, "time": reg.updated}
+                for name, reg in self.registers.items() if reg.value},
+        }
+
+    def restore(self, sw_version, registers):
+        """Restore the state saved by snapshot()
+
+        registers maps register names to (value, time).
+        """
+        self.sw_version = sw_version
+        for name, (value, updated) in registers.items():
+            if name in self.registers:
+                self.registers[name].restore(value, updated)
+
+    def read(self, reg, callback=None, priority=PRIORITY_POLL):
+        """Queue a READ of a register
+
+        callback is called with the value, or None if it couldn't be
+        read.
+        """
+        started = time.monotonic()
+
+        def done(r):
+            self.record_response(r)
+            val = self.process_read_reply(r.decode(hw_charset))
+            self.cache_update(reg, val, started)
+            if callback:
+                callback(val)
+            if val and reg in self.registers:
+                self.registers[reg].remember(val)
+        self.bus.submit(Transaction(
+            self.name, f"READ {reg}".encode(hw_charset), done, priority))
+
+    def cache_max_age(self, reg):
+        if reg in self.registers:
+            return self.registers[reg].cache_max_age
+        return self.bus.cache_max_age
+
+    def cache_update(self, reg, val, started):
+        """Cache the result of a READ started at a given time
+
+        If a SET to the register has been started since, the value may
+        be from before the SET, so it isn't kept.
+        """
+        if val is None:
+            self.cache.pop(reg, None)
+        elif started > self.set_times.get(reg, 0.0) \
+                and self.cache_max_age(reg) > 0:
+            self.cache[reg] = (time.time(), val)
+
+    def setting(self, reg):
+        """Note that a SET to a register is starting
+        """
+        self.set_times[reg] = time.monotonic()
+
+    def cached_read(self, reg):
+        """Return a recently read value of a register, or None
+        """
+        t, val = self.cache.get(reg, (0.0, None))
+        if time.time() - t > self.cache_max_age(reg):
+            return None
+        return val
 
     def process_read_reply(self, r):
         if not r:
@@ -165,12 +927,24 @@ class Controller:
             return
         return r[3:-1]
 
-    def write(self, reg, value):
-        if not self.select():
-            return
-        r = self.bus.communicate(f"SET {reg} {value}".encode(hw_charset))\
-                    .decode(hw_charset)
-        return self.process_write_reply(reg, r)
+    def write(self, reg, value, callback=None, priority=PRIORITY_SET):
+        """Queue a SET of a register
+
+        callback is called with the value read back from the register,
+        or None if the write failed.
+        """
+        self.setting(reg)
+
+        def done(r):
+            # Whatever was cached is from before the SET
+            self.cache.pop(reg, None)
+            self.record_response(r)
+            val = self.process_write_reply(reg, r.decode(hw_charset))
+            if callback:
+                callback(val)
+        self.bus.submit(Transaction(
+            self.name, f"SET {reg} {value}".encode(hw_charset), done,
+            priority))
 
     def process_write_reply(self, reg, r):
         if not r:
@@ -189,31 +963,100 @@ class Controller:
             return
         return r[len(expected):]
 
-    def ping(self):
-        if not self.select():
-            return False
-        r = self.read("ident")
-        if not r:
-            self.log.error("Ping could not read ident register")
-            self.bus.selected = None
-            return False
-        if r != self.name:
-            self.log.error(f"Ping returned unexpected result {r} instead")
+    def record_response(self, r):
+        """Keep count of transactions in a row with no response
+
+        Once there have been failure_threshold of them the breaker
+        opens: polling stops and the controller is probed until it
+        answers again, rather than every register costing a response
+        timeout each time it is due.
+        """
+        if r != b"TIMEOUT\n":
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == self.CLOSED \
+           and self.failures >= self.failure_threshold:  # noqa: E127
+            self.log.warning("No response to %d transactions in a row",
+                             self.failures)
+            self.probe_interval = self.probe_interval_min
+            self.probe_failed()
+            self.bus.cancel_polls(self.name)
+
+    def set_state(self, state):
+        self.state = state
+        self.publish_availability()
+
+    def publish_availability(self, force=False):
+        """Tell Home Assistant whether the controller is answering
+
+        Only changes are published, unless force is set.
+        """
+        payload = b"online" if self.online else b"offline"
+        if not self.known or (
+                payload == self.published_availability and not force):
+            return
+        self.bus.mqttc.publish(self.availability_topic, payload, retain=True)
+        self.published_availability = payload
+
+    def probe(self):
+        """Check whether the controller is there
+
+        Once it has answered, its registers are announced to Home
+        Assistant and polled.  Until then it is probed again
+        periodically.
+        """
+        self.set_state(self.HALF_OPEN)
+        self.read("ident", self.probe_reply)
+
+    def probe_reply(self, r):
+        if r == self.name:
+            self.read("ver", self.came_online)
+            return
+        if r:
+            self.log.error(f"Probe returned unexpected result {r} instead")
             self.bus.selected = None
-            return False
-        return True
+        self.probe_failed()
+
+    def probe_failed(self):
+        self.set_state(self.OPEN)
+        self.log.warning("Not responding; trying again in %ds",
+                         self.probe_interval)
+        self.bus.scheduler.call_later(self.probe_interval, self.probe)
+        self.probe_interval = min(
+            self.probe_interval * 2, self.probe_interval_max)
+
+    def came_online(self, version):
+        if not version:
+            self.probe_failed()
+            return
+        self.log.info("Online, firmware version %s", version)
+        restored = self.sw_version == version
+        self.sw_version = version
+        self.set_state(self.CLOSED)
+        self.probe_interval = self.probe_interval_min
+        if restored:
+            # We have already announced it using the saved state, and
+            # only need to start polling
+            for register in self.registers.values():
+                register.schedule_update(register.first_poll_delay())
+        else:
+            self.send_ha_discovery()
 
-    def interpret(self, sent, received):
+    def interpret(self, sent, received, started):
         if sent.startswith("READ "):
             regname = sent[5:]
             self.log.debug("3rd party read from %s", regname)
+            val = self.process_read_reply(received)
+            self.cache_update(regname, val, started)
             reg = self.registers.get(regname)
             if reg:
-                reg.publish_update(self.process_read_reply(received))
+                reg.publish_update(val)
         elif sent.startswith("SET "):
             reg_and_val = sent[4:]
             if ' ' in reg_and_val:
                 regname, val = reg_and_val.split(' ', maxsplit=1)
+                self.cache.pop(regname, None)
                 reg = self.registers.get(regname)
                 if reg:
                     self.log.debug("3rd party write to %s", reg)
@@ -222,6 +1065,18 @@ class Controller:
         else:
             self.log.debug("Don't know that one")
 
+    @property
+    def ha_availability(self):
+        # Entities are available only while both we and the
+        # controller are
+        return {
+            "availability": [
+                {"topic": self.bus.availability_topic},
+                {"topic": self.availability_topic},
+            ],
+            "availability_mode": "all",
+        }
+
     @property
     def ha_device(self):
         return {
@@ -233,14 +1088,21 @@ class Controller:
         }
 
     def send_ha_discovery(self):
+        self.publish_availability(force=True)
         for register in self.registers.values():
             register.send_ha_discovery()
         for button in self.buttons:
             button.send_ha_discovery()
 
-    def poll(self):
+    def republish(self):
+        """Publish discovery, availability and state again, without
+        polling anything
+        """
+        self.publish_availability(force=True)
         for register in self.registers.values():
-            register.poll()
+            register.publish_discovery()
+        for button in self.buttons:
+            button.send_ha_discovery()
 
     def add_button(self, button):
         self.buttons.append(button)
@@ -251,6 +1113,27 @@ class Register:
     names = {}
     writable = False
     poll_interval = 600
+    # If both are set (by min-poll-interval and max-poll-interval in
+    # the register's configuration), the poll interval adapts to how
+    # the value behaves: it halves (down to the minimum) each time the
+    # value changes, and grows by half (up to the maximum) each time it
+    # doesn't
+    min_poll_interval = None
+    max_poll_interval = None
+    # Commands arriving within this many seconds of each other are
+    # coalesced, and only the last value is written
+    debounce = 0.0
+    # Home Assistant marks the value unavailable if it hasn't been
+    # published for this many seconds longer than the poll interval
+    expire_slack = 30
+    # Unchanged values are republished often enough that they never
+    # go that long: the heartbeat is at most the time Home Assistant
+    # allows, less a poll interval and this margin for a poll that has
+    # to wait for the bus
+    heartbeat_margin = 10
+    # Numeric values within this much of the last one published count
+    # as unchanged
+    deadband = 0.0
     component = "sensor"  # HA component
     discovery = {}  # Extra HA discovery parameters
 
@@ -263,13 +1146,72 @@ class Register:
         topic_prefix = f"{self.controller.mqtt_path}/{ha_name}"
         self.state_topic = f"{topic_prefix}/state"
         self.command_topic = f"{topic_prefix}/command"
+        self.attributes_topic = f"{topic_prefix}/attributes"
+        self.discovery_topic = f"{controller.bus.ha_discovery_prefix}/"\
+            f"{self.component}/{self.unique_id}/config"
+        self.discovery_key = None
+        self.discovery_cache = None
         self.entity_name = f"{controller.entity_prefix}_{ha_name}"
         self.human_name = self.names[name]
         if "poll-interval" in config:
             self.poll_interval = config["poll-interval"]
+            # An explicit interval is fixed unless bounds are given too
+            self.min_poll_interval = None
+            self.max_poll_interval = None
+        self.min_poll_interval = config.get(
+            "min-poll-interval", self.min_poll_interval)
+        self.max_poll_interval = config.get(
+            "max-poll-interval", self.max_poll_interval)
+        self.adaptive = self.min_poll_interval is not None \
+            and self.max_poll_interval is not None
+        if self.adaptive:
+            self.poll_interval = min(max(
+                self.poll_interval, self.min_poll_interval),
+                self.max_poll_interval)
+        # The longest we may go between polls
+        self.longest_poll_interval = max(
+            self.poll_interval,
+            self.max_poll_interval if self.adaptive else 0)
         if "description" in config:
             self.human_name = config["description"]
-        self.schedule_update(10)
+        self.debounce = config.get("debounce", self.debounce)
+        self.expire_after = config.get(
+            "expire-after", self.longest_poll_interval + self.expire_slack)
+        longest_heartbeat = max(
+            self.expire_after - self.longest_poll_interval
+            - self.heartbeat_margin, 0)
+        self.heartbeat = config.get("heartbeat", longest_heartbeat)
+        if self.heartbeat > longest_heartbeat:
+            self.log.warning(
+                "heartbeat %ss doesn't fit expire-after %ss; using %ss",
+                self.heartbeat, self.expire_after, longest_heartbeat)
+            self.heartbeat = longest_heartbeat
+        self.deadband = config.get("deadband", self.deadband)
+        # The last state published, when, and how many states we have
+        # published or suppressed because they were unchanged
+        self.published_payload = None
+        self.published_at = 0.0
+        self.published = 0
+        self.suppressed = 0
+        self.timer = None
+        # Where in each poll interval this register is polled
+        self.phase = controller.bus.next_phase()
+        # The last value read from or written to the register, when
+        # we got it, and whether it was restored from the state file
+        # and hasn't been read since
+        self.value = None
+        self.updated = None
+        self.restored = False
+        # Value from the most recent command not yet written, and
+        # whether a write is in progress
+        self.pending_value = None
+        self.write_timer = None
+        self.writing = False
+        # Commands dropped because a newer value arrived before they
+        # were written
+        self.superseded = 0
+        self.cache_max_age = config.get(
+            "cache-max-age", controller.bus.cache_max_age)
         if self.writable:
             controller.bus.mqtt_topics[self.command_topic] = self
 
@@ -282,51 +1224,220 @@ class Register:
         return f"{self.name} on {self.controller}"
 
     def schedule_update(self, t):
-        self.last_update = time.time() - self.poll_interval + t
+        """Arrange for the register to be polled in t seconds
+        """
+        if self.timer:
+            self.timer.cancel()
+        self.timer = self.controller.bus.scheduler.call_later(t, self.poll)
+
+    def first_poll_delay(self):
+        """How long to wait before polling a newly announced register
+
+        If we already have a recent enough value we wait until it is
+        due to be refreshed.  Older values are refreshed at the
+        register's phase within the poll interval, and registers with
+        no value at all at its phase within the next minute, so that
+        they aren't all polled at once.
+        """
+        if self.updated is None:
+            return 10 + self.phase * min(self.poll_interval, 60)
+        age = time.time() - self.updated
+        if 0 <= age < self.poll_interval:
+            return self.poll_interval - age
+        return self.phase * self.poll_interval
+
+    def next_poll_delay(self):
+        """How long to wait until the next regular poll
+
+        Polls are kept to the register's phase: at a multiple of the
+        poll interval plus its phase offset.  Registers with the same
+        interval are spread evenly across it, rather than falling due
+        together.
+        """
+        interval = self.poll_interval
+        offset = self.phase * interval
+        now = time.monotonic()
+        slot = math.ceil((now + interval / 2 - offset) / interval)
+        return slot * interval + offset - now
+
+    def remember(self, val):
+        self.value = val
+        self.updated = time.time()
+
+    def restore(self, val, updated):
+        self.value = val
+        self.updated = updated
+        self.restored = True
 
     def send_ha_discovery(self):
-        topic = f"{self.controller.bus.ha_discovery_prefix}/{self.component}/"\
-            f"{self.unique_id}/config"
+        """Announce the register to Home Assistant and start polling it
+
+        Its state is published once the announcement has been.
+        """
+        self.publish_discovery()
+        self.schedule_update(self.first_poll_delay())
+
+    def publish_discovery(self):
+        self.controller.bus.discovery.publish(
+            self.discovery_topic, self.discovery_payload(), self.replay_state)
+
+    def discovery_payload(self):
+        """Return the discovery message, building it if necessary
+
+        It only needs building again if the firmware version or our
+        name have changed.
+        """
+        key = (self.controller.sw_version, self.human_name)
+        if key == self.discovery_key:
+            return self.discovery_cache
         msg = {
-            "availability_topic": self.controller.bus.availability_topic,
+            **self.controller.ha_availability,
             "device": self.controller.ha_device,
             "object_id": self.entity_name,
             "name": self.human_name,
             "state_topic": self.state_topic,
+            "json_attributes_topic": self.attributes_topic,
             "unique_id": self.unique_id,
-            "expire_after": self.poll_interval + 30,
+            "expire_after": self.expire_after,
         }
         if self.writable:
             msg["command_topic"] = self.command_topic
         msg.update(self.discovery)
-        self.controller.bus.mqttc.publish(topic, json.dumps(msg))
-        self.schedule_update(10)
+        self.discovery_key = key
+        self.discovery_cache = json.dumps(msg)
+        return self.discovery_cache
 
     def poll(self):
-        if (time.time() - self.last_update) < self.poll_interval:
+        self.timer = None
+        if not self.controller.online:
+            # We start polling again once it comes online
             return
-        self.publish_update(self.controller.read(self.name))
+        self.controller.read(self.name, self.publish_update)
 
     def publish_update(self, val):
         if not val:
             self.log.warning("Null update; not sending")
             # If it's a writable config register, it may be blank;
-            # this is ok, we expect the user to set a value soon
+            # this is ok, we expect the user to set a value soon.
+            # Otherwise try again shortly.
             if self.writable:
-                self.last_update = time.time()
+                self.schedule_update(self.poll_interval)
+            else:
+                self.schedule_update(10)
             return
+        self.adapt_poll_interval(val)
+        self.remember(val)
         payload = self.format_payload(val)
         if payload:
-            self.controller.bus.mqttc.publish(
-                self.state_topic, self.format_payload(val))
+            self.publish_state(payload)
+        if self.restored:
+            self.restored = False
+            self.publish_attributes()
         self.ack(val)
-        self.last_update = time.time()
+        self.schedule_update(self.next_poll_delay())
+
+    def replay_state(self):
+        """Publish the last value we saw, if any
+        """
+        if self.value:
+            payload = self.format_payload(self.value)
+            if payload:
+                self.publish_state(payload, force=True)
+            if self.restored:
+                self.publish_attributes()
+
+    def publish_state(self, payload, force=False):
+        """Publish a state, unless it is the same as the last one
+
+        Unchanged states are only republished every heartbeat seconds.
+        """
+        now = time.monotonic()
+        if not force and self.published_payload is not None \
+           and now - self.published_at < self.heartbeat \
+           and self.unchanged(payload):  # noqa: E127
+            self.suppressed += 1
+            return
+        self.controller.bus.mqttc.publish(self.state_topic, payload)
+        self.published_payload = payload
+        self.published_at = now
+        self.published += 1
+
+    def unchanged(self, payload):
+        return self.same(payload, self.published_payload)
+
+    def same(self, a, b):
+        """Are two values the same, to within the deadband?
+        """
+        if a == b:
+            return True
+        if not self.deadband:
+            return False
+        try:
+            return abs(float(a) - float(b)) < self.deadband
+        except ValueError:
+            return False
+
+    def adapt_poll_interval(self, val):
+        if not self.adaptive or self.value is None:
+            return
+        if self.same(val, self.value):
+            self.poll_interval = min(
+                self.poll_interval * 1.5, self.max_poll_interval)
+        else:
+            self.poll_interval = max(
+                self.poll_interval / 2, self.min_poll_interval)
+
+    def publish_attributes(self):
+        """Tell Home Assistant whether the value is a restored one
+
+        age is how old the value was when published, in seconds.
+        """
+        age = time.time() - self.updated if self.restored else 0
+        self.controller.bus.mqttc.publish(self.attributes_topic, json.dumps({
+            "restored": self.restored,
+            "age": round(age),
+        }))
 
     def process_mqtt_message(self, topic, payload):
         if not self.writable:
             self.log.error("Attempt to write to read-only register")
             return
-        self.publish_update(self.controller.write(self.name, payload))
+        if self.pending_value is not None:
+            self.superseded += 1
+            self.log.debug("Dropping superseded value %s (%d so far)",
+                           self.pending_value, self.superseded)
+        self.pending_value = payload
+        if self.write_timer:
+            self.write_timer.cancel()
+            self.write_timer = None
+        if self.debounce > 0:
+            self.write_timer = self.controller.bus.scheduler.call_later(
+                self.debounce, self.write_pending)
+        else:
+            self.write_pending()
+
+    def write_pending(self):
+        """Write the value from the most recent command
+
+        If a write is already in progress, this is done again when it
+        completes.
+        """
+        self.write_timer = None
+        if self.writing:
+            return
+        value = self.pending_value
+        self.pending_value = None
+        self.writing = True
+        self.controller.write(self.name, value, self.write_done)
+
+    def write_done(self, val):
+        self.writing = False
+        if self.pending_value is None:
+            self.publish_update(val)
+        elif not self.write_timer:
+            # Another command arrived while we were writing; the state
+            # is published once that one has been written
+            self.write_pending()
 
     def format_payload(self, val):
         """Process raw value from hardware before sending mqtt message
@@ -344,6 +1455,13 @@ class Register:
 
 
 class ModeButton:
+    # Values used to activate a mode must have been read within this
+    # many seconds.  The mode settings are only polled daily, and can
+    # be changed from the front panel without our knowing, so older
+    # values are read again first.  A change made in the last minute
+    # may still be missed.
+    max_value_age = 60
+
     def __init__(self, modename_reg):
         name = modename_reg.name.replace("name", "button")
         prefix = name[:2]
@@ -358,6 +1476,11 @@ class ModeButton:
         self.command_topic = f"{topic_prefix}/command"
         self.entity_name = f"{controller.entity_prefix}_{ha_name}"
         self.human_name = f"{modename_reg.name} activate"
+        self.discovery_topic = f"{controller.bus.ha_discovery_prefix}/"\
+            f"scene/{self.unique_id}/config"
+        self.discovery_key = None
+        self.discovery_cache = None
+        self.activating = False
         self.regmap = [
             ("alarm/hi", f"{prefix}/a/hi"),
             ("alarm/lo", f"{prefix}/a/lo"),
@@ -371,10 +1494,15 @@ class ModeButton:
         controller.add_button(self)
 
     def send_ha_discovery(self):
-        topic = f"{self.controller.bus.ha_discovery_prefix}/scene/"\
-            f"{self.unique_id}/config"
+        self.controller.bus.discovery.publish(
+            self.discovery_topic, self.discovery_payload())
+
+    def discovery_payload(self):
+        key = (self.controller.sw_version, self.human_name)
+        if key == self.discovery_key:
+            return self.discovery_cache
         msg = {
-            "availability_topic": self.controller.bus.availability_topic,
+            **self.controller.ha_availability,
             "device": self.controller.ha_device,
             "object_id": self.entity_name,
             "name": self.human_name,
@@ -382,28 +1510,109 @@ class ModeButton:
             "payload_on": "ON",
             "unique_id": self.unique_id,
         }
-        self.controller.bus.mqttc.publish(topic, json.dumps(msg))
+        self.discovery_key = key
+        self.discovery_cache = json.dumps(msg)
+        return self.discovery_cache
 
     def set_name(self, name):
+        # Discovery is retained, so a missing name would stay on the
+        # broker
+        if not name or name == self.human_name:
+            return
         self.human_name = name
         self.send_ha_discovery()
 
     def process_mqtt_message(self, topic, payload):
         self.log.debug("pressed")
-        # Read mode settings
-        settings = [self.controller.read(src) for _, src in self.regmap]
-        if not all(settings):
-            # Reading at least one of these failed; we can't continue
+        if self.activating:
+            self.log.warning("Already activating; ignoring")
+            return
+        self.activating = True
+        # We need the mode settings, and the current values of the
+        # active registers in case we have to put them back.  Use the
+        # values from recent polls where we have them, and read the
+        # rest.
+        values = {name: self.known_value(name)
+                  for pair in self.regmap for name in pair}
+        missing = [name for name, val in values.items() if val is None]
+        if not missing:
+            self.write_settings(values)
+            return
+        waiting = set(missing)
+
+        def read_done(name, val):
+            values[name] = val
+            waiting.discard(name)
+            if not waiting:
+                self.write_settings(values)
+        for name in missing:
+            self.controller.read(
+                name, lambda val, name=name: read_done(name, val),
+                PRIORITY_READ)
+
+    def known_value(self, name):
+        """Return the last value seen for a register, or None
+
+        Values older than max_value_age, and those of registers with a
+        write in progress or pending, are treated as unknown.
+        """
+        reg = self.controller.registers.get(name)
+        if not reg or reg.writing or reg.pending_value is not None \
+           or reg.updated is None \
+           or time.time() - reg.updated > self.max_value_age:  # noqa: E127
+            return None
+        return reg.value
+
+    def write_settings(self, values):
+        failed = [src for _, src in self.regmap if not values[src]]
+        if failed:
+            # We can't activate the mode without all its settings
             self.log.error("Failed to read settings for %s: %s",
-                           self.name, settings)
+                           self.name, failed)
+            self.activating = False
             return
+        self.write_next(
+            [(dest, values[src], values[dest]) for dest, src in self.regmap],
+            [])
+
+    def write_next(self, writes, done):
+        """Write settings into active registers one after another
+
+        writes is a list of (register, new value, old value) still to
+        be written, and done a list of those already written.  Each
+        write is queued as soon as the previous one completes, so they
+        run back to back.  State is published once all have been
+        written.
+        """
+        if not writes:
+            self.activating = False
+            for dest, val, _ in done:
+                reg = self.controller.registers.get(dest)
+                if reg:
+                    reg.publish_update(val)
+            return
+        dest, val, old = writes[0]
 
-        # Write settings into active registers
-        for ((dest, _), val) in zip(self.regmap, settings):
-            written = self.controller.write(dest, val)
+        def written(result):
+            if result is None:
+                self.log.error("Failed to set %s; rolling back", dest)
+                self.roll_back(done)
+            else:
+                self.write_next(writes[1:], done + [(dest, result, old)])
+        self.controller.write(dest, val, written)
+
+    def roll_back(self, done):
+        """Restore the active registers written so far
+        """
+        self.activating = False
+        for dest, _, old in reversed(done):
+            if old is None:
+                self.log.error("Previous value of %s unknown; "
+                               "can't restore it", dest)
+                continue
             reg = self.controller.registers.get(dest)
-            if reg:
-                reg.publish_update(written)
+            self.controller.write(
+                dest, old, reg.publish_update if reg else None)
 
 
 class TempReg(Register):
@@ -420,6 +1629,7 @@ class TempReg(Register):
         "unit_of_measurement": "°C",
         "suggested_display_precision": 2,
     }
+    deadband = 0.05
 
     def format_payload(self, val):
         try:
@@ -466,6 +1676,7 @@ class TempSetReg(Register):
         "max": 100,
     }
     poll_interval = 60
+    debounce = 1.0
 
     def format_payload(self, val):
         return f"{float(val):0.1f}"
@@ -516,7 +1727,9 @@ class ConfigModeName(Register):
 
     def publish_update(self, val):
         super().publish_update(val)
-        self.modebutton.set_name(val)
+        # A failed read leaves the button's name as it was
+        if val:
+            self.modebutton.set_name(val)
 
 
 _mode_temp_names = {}
@@ -535,6 +1748,7 @@ class ConfigModeTemp(Register):
     names = _mode_temp_names
     poll_interval = 86400
     writable = True
+    debounce = 1.0
     component = "number"
     discovery = {
         "entity_category": "config",
@@ -568,4 +1782,6 @@ class ErrorReg(Register):
 
     def ack(self, val):
         if val != "0":
-            self.controller.write(self.name, val)
+            # Part of background polling, so it mustn't hold up
+            # commands from users
+            self.controller.write(self.name, val, priority=PRIORITY_POLL)
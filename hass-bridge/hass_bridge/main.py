@@ -1,58 +1,250 @@
 import sys
 import argparse
+import collections
 import pathlib
 import logging
 import tomli
 import selectors
+import signal
 import socket
 import sdnotify
 import paho.mqtt.client as mqtt
-from .hardware import Bus
+from .hardware import Bridge, Bus, BusMetrics, DiscoveryQueue
+from .hardware import MAX_POLL_UTILISATION
+from .scheduler import Scheduler
 
 log = logging.getLogger(__name__)
 
 
-def incoming_connection(sock, bus):
-    log.debug("Accepting TCP connection")
-    conn, addr = sock.accept()
-    conn.settimeout(10)
-    with conn.makefile('rb') as f:
+class TcpListener:
+    def __init__(self, sock, sel, bus, client_class=None):
+        self.sock = sock
+        self.sel = sel
+        self.bus = bus
+        self.client_class = client_class or TcpClient
+        sel.register(sock, selectors.EVENT_READ, self)
+
+    def event(self, fileobj, mask):
+        log.debug("Accepting TCP connection")
+        try:
+            conn, addr = self.sock.accept()
+        except OSError as e:
+            log.error("Exception accepting connection: %s", e)
+            return
+        self.client_class(conn, self.sel, self.bus)
+
+
+class TcpClient:
+    """A connection from a third-party client such as the datalog
+
+    Commands are read a line at a time and passed to the bus one at a
+    time, where they are queued with those from other clients and its
+    own polls.
+    At most max_pending commands are queued; after that we stop
+    reading from the client until the queue drains.
+    """
+    max_pending = 64
+    max_line = 1024
+
+    def __init__(self, conn, sel, bus):
+        self.conn = conn
+        self.sel = sel
+        self.bus = bus
+        # The ident of the controller this client has selected, and
+        # the bus it is on
+        self.selected = None
+        self.selected_bus = None
+        self.pending = collections.deque()
+        # Is one of our commands waiting to be run on the bus?
+        self.busy = False
+        self.rbuf = b""
+        self.wbuf = b""
+        self.eof = False
+        self.events = 0
+        conn.setblocking(False)
+        self.update_events()
+
+    def update_events(self):
+        """Register interest in the events we can deal with now
+        """
+        if self.eof and not self.pending and not self.busy \
+           and not self.wbuf:  # noqa: E127
+            self.close()
+            return
+        events = 0
+        if not self.eof and len(self.pending) < self.max_pending:
+            events |= selectors.EVENT_READ
+        if self.wbuf:
+            events |= selectors.EVENT_WRITE
+        if events == self.events:
+            return
+        if not self.events:
+            self.sel.register(self.conn, events, self)
+        elif not events:
+            self.sel.unregister(self.conn)
+        else:
+            self.sel.modify(self.conn, events, self)
+        self.events = events
+
+    def event(self, fileobj, mask):
+        if mask & selectors.EVENT_READ:
+            self.read()
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        self.update_events()
+
+    def read(self):
         try:
-            for data in f:
-                data = data.strip()
-                if not data:
-                    continue
-                response = bus.communicate(data)
-                bus.interpret(data, response)
-                try:
-                    conn.send(response)
-                except Exception as e:
-                    log.error("Exception writing to socket: %s", e)
-                    break
-        except Exception as e:
+            data = self.conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
             log.error("Exception reading from socket: %s", e)
-    log.debug("Closing TCP connection")
-    conn.close()
+            data = b""
+        if not data:
+            self.eof = True
+            return
+        self.rbuf += data
+        *lines, self.rbuf = self.rbuf.split(b"\n")
+        if len(self.rbuf) > self.max_line:
+            log.error("Overlong line from TCP client")
+            self.eof = True
+        for line in lines:
+            line = line.strip()
+            if line:
+                self.pending.append(line)
+        self.next_command()
+
+    def next_command(self):
+        """Pass our next command to the bus, if it isn't busy with one
+        """
+        while self.pending and not self.busy:
+            self.busy = True
+            self.bus.tcp_transaction(
+                self, self.pending.popleft(), self.respond)
+
+    def respond(self, response):
+        self.busy = False
+        self.wbuf += response
+        self.flush()
+        self.next_command()
+        # If the client has stopped sending, this may have been the
+        # last response it was waiting for
+        self.update_events()
+
+    def flush(self):
+        try:
+            sent = self.conn.send(self.wbuf)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            log.error("Exception writing to socket: %s", e)
+            self.pending.clear()
+            self.wbuf = b""
+            self.eof = True
+            return
+        self.wbuf = self.wbuf[sent:]
+
+    def close(self):
+        log.debug("Closing TCP connection")
+        if self.events:
+            self.sel.unregister(self.conn)
+            self.events = 0
+        self.conn.close()
+
+
+class MetricsClient:
+    """An HTTP request for our metrics, e.g. from Prometheus
+
+    GET /metrics returns them in Prometheus's text format; they are
+    only put together when asked for.  Anything else gets an error.
+    The connection is closed after each response.
+    """
+    max_request = 8192
+
+    def __init__(self, conn, sel, bridge):
+        self.conn = conn
+        self.sel = sel
+        self.bridge = bridge
+        self.rbuf = b""
+        self.wbuf = b""
+        conn.setblocking(False)
+        sel.register(conn, selectors.EVENT_READ, self)
+
+    def event(self, fileobj, mask):
+        if mask & selectors.EVENT_READ:
+            self.read()
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+
+    def read(self):
+        try:
+            data = self.conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+            return
+        self.rbuf += data
+        if b"\r\n\r\n" not in self.rbuf \
+           and len(self.rbuf) < self.max_request:  # noqa: E127
+            return
+        request = self.rbuf.split(b"\r\n", 1)[0].split()
+        if request[:2] == [b"GET", b"/metrics"]:
+            self.respond(b"200 OK", self.bridge.metrics.registry.exposition(),
+                         b"text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self.respond(b"404 Not Found", b"Try /metrics\n")
+        self.sel.modify(self.conn, selectors.EVENT_WRITE, self)
+
+    def respond(self, status, body, content_type=b"text/plain"):
+        self.wbuf = (
+            b"HTTP/1.0 " + status + b"\r\n"
+            b"Content-Type: " + content_type + b"\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body)
+
+    def flush(self):
+        try:
+            sent = self.conn.send(self.wbuf)
+        except BlockingIOError:
+            return
+        except OSError:
+            sent = len(self.wbuf)
+        self.wbuf = self.wbuf[sent:]
+        if not self.wbuf:
+            self.close()
+
+    def close(self):
+        self.sel.unregister(self.conn)
+        self.conn.close()
 
 
 def on_mqtt_connect(client, userdata, flags, reason_code, properties):
     log.debug("MQTT connected reason_code %s", reason_code)
-    bus = userdata
-    client.subscribe(f"{bus.ha_discovery_prefix}/status")
-    client.subscribe(f"{bus.mqtt_path}/+/+/command")
-    bus.send_ha_discovery()
+    if reason_code.is_failure:
+        # We will be disconnected, and try again
+        log.error("MQTT connection refused: %s", reason_code)
+        return
+    bridge = userdata
+    client.subscribe(f"{bridge.ha_discovery_prefix}/status")
+    client.subscribe(f"{bridge.mqtt_path}/+/+/command")
+    bridge.mqtt_connected()
 
 
 def on_mqtt_disconnect(client, userdata, flags, reason_code, properties):
     log.error("MQTT disconnected reason_code %s", reason_code)
-    # We exit and expect to be restarted by systemd
-    sys.exit(1)
+    # We carry on polling, and try to reconnect
+    bridge = userdata
+    bridge.mqtt_disconnected()
 
 
 def on_mqtt_message(client, userdata, msg):
     log.debug("MQTT message: topic %s payload %s", msg.topic, msg.payload)
-    bus = userdata
-    bus.process_mqtt_message(msg)
+    bridge = userdata
+    bridge.process_mqtt_message(msg)
 
 
 class MqttSelectorsHelper:
@@ -66,17 +258,18 @@ class MqttSelectorsHelper:
 
     def on_socket_open(self, client, userdata, sock):
         log.debug("Mqtt socket opened")
-        self.sel.register(sock, selectors.EVENT_READ)
+        self.sel.register(sock, selectors.EVENT_READ, self)
 
     def on_socket_close(self, client, userdata, sock):
         log.debug("Mqtt socket closing")
         self.sel.unregister(sock)
 
     def on_socket_register_write(self, client, userdata, sock):
-        self.sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        self.sel.modify(
+            sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
 
     def on_socket_unregister_write(self, client, userdata, sock):
-        self.sel.modify(sock, selectors.EVENT_READ)
+        self.sel.modify(sock, selectors.EVENT_READ, self)
 
     def event(self, fileobj, mask):
         if mask & selectors.EVENT_WRITE:
@@ -118,9 +311,6 @@ def fvbridge():
     general = config.get("general", {})
 
     sp_path = general.get("serial", args.serial)
-    if not sp_path:
-        print("No serial port specified")
-        sys.exit(1)
 
     mqtt_hostname = general.get("mqtt_hostname", "localhost")
     mqtt_port = general.get("mqtt_port", 1883)
@@ -130,27 +320,63 @@ def fvbridge():
     mqtt_path = general.get("mqtt_path", "fvcontrol")
     listen_hostname = general.get("listen_hostname", "localhost")
     listen_port = general.get("listen_port", 1576)
+    cache_max_age = general.get("cache_max_age", 0)
+    state_file = general.get("state_file")
+    max_poll_utilisation = general.get(
+        "max_poll_utilisation", MAX_POLL_UTILISATION)
+    metrics_hostname = general.get("metrics_hostname", "localhost")
+    metrics_port = general.get("metrics_port")
 
     controller_config = config.get("controller", {})
+    bus_config = config.get("bus", {})
 
     if not controller_config:
         log.warning("No controllers declared in configuration file")
 
+    # Controllers go on the bus named in their configuration, or on
+    # the bus given by the "serial" setting if they don't name one
+    bus_controllers = {name: {} for name in bus_config}
+    for ident, c in controller_config.items():
+        bus_name = c.get("bus")
+        if bus_name is not None and bus_name not in bus_config:
+            print(f"Controller {ident} is on undeclared bus '{bus_name}'")
+            sys.exit(1)
+        bus_controllers.setdefault(bus_name, {})[ident] = c
+    if None in bus_controllers or not bus_config:
+        if not sp_path:
+            print("No serial port specified")
+            sys.exit(1)
+        bus_config = {None: {"serial": sp_path}, **bus_config}
+    for name, c in bus_config.items():
+        if "serial" not in c:
+            print(f"No serial port specified for bus '{name}'")
+            sys.exit(1)
+
     sel = selectors.DefaultSelector()
+    scheduler = Scheduler()
 
     mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 
     if mqtt_username:
         mqttc.username_pw_set(username=mqtt_username, password=mqtt_password)
 
-    bus = Bus(sp_path, controller_config, mqttc, discovery_prefix, mqtt_path)
-
-    mqttc.user_data_set(bus)
+    discovery = DiscoveryQueue(mqttc, scheduler)
+    metrics = BusMetrics()
+    buses = [
+        Bus(c["serial"], bus_controllers.get(name, {}), mqttc,
+            discovery_prefix, mqtt_path,
+            c.get("cache_max_age", cache_max_age), scheduler, discovery,
+            c.get("max_poll_utilisation", max_poll_utilisation), metrics)
+        for name, c in bus_config.items()]
+    bridge = Bridge(buses, mqttc, discovery_prefix, mqtt_path, scheduler,
+                    state_file, metrics)
+
+    mqttc.user_data_set(bridge)
     mqttc.on_connect = on_mqtt_connect
     mqttc.on_disconnect = on_mqtt_disconnect
     mqttc.on_message = on_mqtt_message
     mqtt_helper = MqttSelectorsHelper(mqttc, sel)
-    mqttc.will_set(bus.availability_topic, b"offline")
+    mqttc.will_set(bridge.availability_topic, b"offline")
 
     log.debug("Opening listening socket %s", (listen_hostname, listen_port))
     sock = socket.socket()
@@ -159,24 +385,47 @@ def fvbridge():
     sock.listen(10)
     sock.setblocking(False)
 
-    sel.register(sock, selectors.EVENT_READ)
+    TcpListener(sock, sel, bridge)
+
+    if metrics_port:
+        log.debug("Opening metrics socket %s",
+                  (metrics_hostname, metrics_port))
+        msock = socket.socket()
+        msock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        msock.bind((metrics_hostname, metrics_port))
+        msock.listen(10)
+        msock.setblocking(False)
+        TcpListener(msock, sel, bridge, MetricsClient)
+    for bus in buses:
+        sel.register(bus.s, selectors.EVENT_READ, bus)
 
     log.debug("About to connect to mqtt %s", (mqtt_hostname, mqtt_port))
-    mqttc.connect(mqtt_hostname, mqtt_port, 60)
+    try:
+        mqttc.connect(mqtt_hostname, mqtt_port, 60)
+    except OSError as e:
+        log.error("Could not connect to MQTT broker: %s", e)
+        bridge.mqtt_disconnected()
 
     if args.notify:
         log.debug("Notifying startup complete to systemd")
         sdnotify.SystemdNotifier().notify("READY=1")
 
+    # Let systemd stop us cleanly, so that we save our state
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     log.debug("Entering event loop")
-    while True:
-        events = sel.select(5)
-        for key, mask in events:
-            if key.fileobj == sock:
-                incoming_connection(sock, bus)
-            else:
-                # Must be the MQTT client
-                mqtt_helper.event(key.fileobj, mask)
-        mqtt_helper.misc()
-        bus.announce_online()
-        bus.poll()
+    try:
+        while True:
+            # Wake up when the next register is due to be polled, or
+            # after 5s at most to deal with MQTT keepalives
+            events = sel.select(bridge.timeout(5.0))
+            for key, mask in events:
+                # The MQTT client, a serial port, the TCP listener or a
+                # TCP client
+                key.data.event(key.fileobj, mask)
+            mqtt_helper.misc()
+            bridge.announce_online()
+            bridge.poll()
+    finally:
+        if state_file:
+            bridge.save_state()
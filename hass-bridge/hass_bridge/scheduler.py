@@ -0,0 +1,79 @@
+import heapq
+import itertools
+import time
+
+
+class Timer:
+    """A callback scheduled to be called at a particular time
+    """
+    __slots__ = ("when", "callback", "scheduler", "cancelled")
+
+    def __init__(self, when, callback, scheduler):
+        self.when = when
+        self.callback = callback
+        self.scheduler = scheduler
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler.cancelled += 1
+
+
+class Scheduler:
+    """A queue of timers, ordered by deadline
+
+    Timers are kept in a min-heap, so scheduling a timer and finding
+    the next one due are both O(log n).  Cancelled timers are left in
+    the heap and skipped when they reach the top; if they come to make
+    up more than half the heap it is rebuilt without them.
+
+    Times are from time.monotonic().
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cancelled = 0
+
+    def call_at(self, when, callback):
+        timer = Timer(when, callback, self)
+        heapq.heappush(self.heap, (when, next(self.counter), timer))
+        if self.cancelled > len(self.heap) // 2:
+            self.heap = [e for e in self.heap if not e[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+        return timer
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def _discard_cancelled(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+
+    def timeout(self, maximum=None):
+        """Return the number of seconds until the next timer is due
+
+        The result is never more than maximum; if there are no timers,
+        maximum is returned.
+        """
+        self._discard_cancelled()
+        if not self.heap:
+            return maximum
+        t = max(self.heap[0][0] - time.monotonic(), 0.0)
+        if maximum is not None:
+            t = min(t, maximum)
+        return t
+
+    def run_due(self):
+        """Call the callbacks of all the timers that are due
+        """
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            timer.cancelled = True
+            timer.callback()
@@ -0,0 +1,44 @@
+import unittest
+
+from simbus import SimTestCase
+
+
+class AdaptiveIntervalTest(SimTestCase):
+    def register(self, config):
+        bus = self.make_bus({"FV1": {"registers": ["t0"], "t0": config}})
+        return bus.controllers["FV1"].registers["t0"]
+
+    def intervals(self, t0, values):
+        intervals = []
+        for value in values:
+            t0.publish_update(value)
+            intervals.append(t0.poll_interval)
+        return intervals
+
+    def test_interval_follows_changes(self):
+        t0 = self.register({"poll-interval": 20, "min-poll-interval": 10,
+                            "max-poll-interval": 60})
+        self.assertTrue(t0.adaptive)
+        self.assertEqual(
+            self.intervals(t0, ["18.5", "18.5", "18.52", "18.5", "18.5",
+                                "19.0", "20.0", "21.0"]),
+            [20, 30, 45, 60, 60, 30, 15, 10])
+
+    def test_interval_limited_to_bounds(self):
+        t0 = self.register({"poll-interval": 300, "min-poll-interval": 10,
+                            "max-poll-interval": 60})
+        self.assertEqual(t0.poll_interval, 60)
+
+    def test_fixed_by_default(self):
+        t0 = self.register({})
+        self.assertFalse(t0.adaptive)
+        self.assertEqual(self.intervals(t0, ["18.5", "18.5", "19.0"]),
+                         [60, 60, 60])
+
+    def test_explicit_interval_fixed(self):
+        t0 = self.register({"poll-interval": 20})
+        self.assertFalse(t0.adaptive)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+from unittest import mock
+
+from hass_bridge.hardware import Bus, Controller
+
+from simbus import SimTestCase
+
+
+class CircuitBreakerTest(SimTestCase):
+    def setUp(self):
+        super().setUp()
+        for patch in (
+                mock.patch.object(Bus, "response_timeout", 0.2),
+                mock.patch.object(Controller, "probe_interval_min", 0.3)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.bus = self.make_bus(
+            {"FV1": {"registers": ["t0", "v0", "alarm", "set/lo"]}},
+            max_poll_utilisation=1.0)
+        self.controller = self.bus.controllers["FV1"]
+        self.assertTrue(self.run_loop(until=lambda: self.controller.online))
+        self.sim_controller = self.sim.controllers[0]
+        self.reads = []
+        submit = self.bus.submit
+
+        def record(transaction):
+            self.reads.append(transaction.command)
+            submit(transaction)
+        self.bus.submit = record
+
+    def poll_all(self):
+        for register in self.controller.registers.values():
+            register.poll()
+
+    def test_opens_after_repeated_failures(self):
+        self.sim.controllers.remove(self.sim_controller)
+        self.poll_all()
+        self.assertTrue(self.run_loop(
+            until=lambda: self.controller.state == Controller.OPEN))
+        # The fourth poll was dropped rather than left to time out
+        self.assertEqual(len(self.reads), 4)
+        self.assertEqual(self.bus.metrics.transactions.values[
+            (self.bus.sp_path, "FV1", "READ", "timeout")], 3)
+        self.assertFalse(any(self.bus.queues))
+        self.assertEqual(
+            self.mqttc.payloads(self.controller.availability_topic)[-1],
+            b"offline")
+        # Registers aren't polled while it is open
+        self.poll_all()
+        self.assertEqual(len(self.reads), 4)
+
+    def test_closes_when_probe_answered(self):
+        self.sim.controllers.remove(self.sim_controller)
+        self.poll_all()
+        self.assertTrue(self.run_loop(
+            until=lambda: self.controller.state == Controller.OPEN))
+        self.sim.controllers.append(self.sim_controller)
+        self.assertTrue(self.run_loop(until=lambda: self.controller.online))
+        self.assertEqual(
+            self.mqttc.payloads(self.controller.availability_topic)[-1],
+            b"online")
+        self.assertEqual(self.reads[4:], [b"READ ident", b"READ ver"])
+        # Polling starts again
+        self.assertTrue(all(r.timer for r in
+                            self.controller.registers.values()))
+
+    def test_occasional_failures_tolerated(self):
+        self.controller.failures = self.controller.failure_threshold - 1
+        self.controller.registers["t0"].poll()
+        self.assertTrue(self.run_loop(until=lambda: not self.bus.current))
+        self.assertEqual(self.controller.failures, 0)
+        self.assertTrue(self.controller.online)
+
+    def test_stats(self):
+        responses = []
+        self.bus.tcp_transaction(None, b"STATS", responses.append)
+        self.assertIn(b"controllers closed=1 half-open=0 open=0\n",
+                      responses[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
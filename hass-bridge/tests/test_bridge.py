@@ -0,0 +1,76 @@
+import unittest
+
+from hass_bridge.hardware import Bridge, DiscoveryQueue
+
+from simbus import SimTestCase, Message
+
+
+class Client:
+    """Stands in for a TCP client
+    """
+    def __init__(self):
+        self.selected = None
+        self.selected_bus = None
+
+
+class MultiBusTest(SimTestCase):
+    """Controllers on two buses, served by one bridge
+    """
+    def setUp(self):
+        super().setUp()
+        self.other_sim = self.simulate(["FV2"])
+        discovery = DiscoveryQueue(self.mqttc, self.scheduler)
+        self.buses = [
+            self.make_bus({"FV1": {"registers": ["set/lo"]}},
+                          discovery=discovery),
+            self.make_bus({"FV2": {"registers": ["set/lo"]}},
+                          sim=self.other_sim, discovery=discovery)]
+        self.bridge = Bridge(self.buses, self.mqttc, "homeassistant",
+                             "fvtest", self.scheduler)
+        self.assertTrue(self.run_loop(until=lambda: all(
+            c.online for c in self.bridge.controllers)))
+
+    def tcp(self, client, command):
+        responses = []
+        self.bridge.tcp_transaction(client, command, responses.append)
+        self.assertTrue(self.run_loop(until=lambda: responses))
+        return responses[0]
+
+    def test_tcp_commands_go_to_the_controller_bus(self):
+        client = Client()
+        self.assertEqual(self.tcp(client, b"SELECT FV2"),
+                         b"OK FV2 selected\n")
+        self.assertIs(client.selected_bus, self.buses[1])
+        self.assertEqual(self.tcp(client, b"READ ident"), b"OK FV2\n")
+        self.assertEqual(self.tcp(client, b"SELECT FV1"),
+                         b"OK FV1 selected\n")
+        self.assertEqual(self.tcp(client, b"!READ ident"), b"OK FV1\n")
+
+    def test_unknown_controller_on_first_bus(self):
+        client = Client()
+        self.assertEqual(self.tcp(client, b"SELECT FV9"), b"TIMEOUT\n")
+        self.assertIs(client.selected_bus, self.buses[0])
+
+    def test_mqtt_commands_go_to_the_controller_bus(self):
+        reg = self.buses[1].controllers["FV2"].registers["set/lo"]
+        reg.debounce = 0.0
+        self.bridge.process_mqtt_message(
+            Message(reg.command_topic, b"15"))
+        self.assertTrue(self.run_loop(
+            until=lambda: reg.state_topic in self.mqttc.topics()))
+        self.assertEqual(self.other_sim.controllers[0].values["set/lo"],
+                         "15.000000")
+        self.assertEqual(self.sim.controllers[0].values["set/lo"],
+                         "18.000000")
+
+    def test_both_buses_announced(self):
+        discovery = self.buses[0].discovery
+        self.assertTrue(self.run_loop(until=lambda: not discovery.pending))
+        self.assertEqual(
+            sorted(t for t in self.mqttc.topics() if t.endswith("/config")),
+            sorted(bus.controllers[name].registers["set/lo"].discovery_topic
+                   for bus, name in zip(self.buses, ["FV1", "FV2"])))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import time
+import unittest
+
+from hass_bridge.hardware import Transaction, PRIORITY_SET, PRIORITY_POLL
+
+from simbus import SimTestCase
+
+
+class PollBudgetTest(SimTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sim.latency = 0.02
+        self.done = []
+
+    def submit(self, bus, priority, count=1):
+        for _ in range(count):
+            bus.submit(Transaction(
+                "FV1", b"READ ident",
+                lambda r: self.done.append(priority), priority))
+
+    def test_polls_limited_to_share_of_bus(self):
+        bus = self.make_bus(max_poll_utilisation=0.25)
+        self.submit(bus, PRIORITY_POLL, 100)
+        start = time.monotonic()
+        self.run_loop(1.0)
+        elapsed = time.monotonic() - start
+        # The time the transactions took, one of which may overrun
+        busy = bus.metrics.latency.values[(bus.sp_path, "READ")][1]
+        self.assertGreater(len(self.done), 0)
+        self.assertLess(busy, 0.25 * elapsed + 0.05)
+        self.assertIsNotNone(bus.budget_timer)
+
+    def test_commands_not_held_back(self):
+        bus = self.make_bus(max_poll_utilisation=0.25)
+        # Polling has overspent for the next few seconds
+        bus.update_poll_credit(1.0)
+        self.submit(bus, PRIORITY_POLL)
+        self.submit(bus, PRIORITY_SET)
+        self.assertTrue(self.run_loop(until=lambda: self.done))
+        self.assertEqual(self.done, [PRIORITY_SET])
+        self.assertEqual(len(bus.queues[PRIORITY_POLL]), 1)
+
+    def test_no_limit(self):
+        bus = self.make_bus(max_poll_utilisation=1.0)
+        self.submit(bus, PRIORITY_POLL, 10)
+        self.assertTrue(self.run_loop(until=lambda: len(self.done) == 10))
+        self.assertIsNone(bus.budget_timer)
+
+
+class PhaseTest(SimTestCase):
+    def test_polls_spread_over_interval(self):
+        bus = self.make_bus({"FV1": {"registers": [
+            "t0", "v0", "alarm", "set/lo", "set/hi"]}})
+        registers = bus.controllers["FV1"].registers.values()
+        phases = sorted(r.phase for r in registers)
+        self.assertTrue(all(0 <= p < 1 for p in phases))
+        # No two registers are polled within 5s of each other
+        delays = sorted(r.next_poll_delay() % 60 for r in registers)
+        self.assertTrue(all(b - a > 5 for a, b in zip(delays, delays[1:])))
+
+    def test_poll_load(self):
+        bus = self.make_bus({"FV1": {"registers": ["t0", "v0"]}})
+        controller = bus.controllers["FV1"]
+        self.assertTrue(self.run_loop(until=lambda: controller.online))
+        bus.transaction_cost = 0.1
+        # Two registers each polled once a minute
+        self.assertAlmostEqual(bus.poll_load(), 0.2 / 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import time
+
+from hass_bridge.hardware import Transaction
+
+from simbus import SimTestCase
+
+
+class BusTest(SimTestCase):
+    idents = ["FV1", "FV2"]
+
+    def setUp(self):
+        super().setUp()
+        self.bus = self.make_bus()
+        self.bus.response_timeout = 0.2
+
+    def test_selects_controller_once(self):
+        self.assertEqual(
+            self.transact(self.bus, Transaction("FV1", b"READ ident")),
+            b"OK FV1\n")
+        self.assertEqual(self.bus.selected, "FV1")
+        before = self.sim.transactions
+        self.assertEqual(
+            self.transact(self.bus, Transaction("FV1", b"READ ver")),
+            b"OK sim\n")
+        self.assertEqual(self.sim.transactions, before + 1)
+        self.assertEqual(
+            self.transact(self.bus, Transaction("FV2", b"READ ident")),
+            b"OK FV2\n")
+        self.assertEqual(self.sim.transactions, before + 3)
+
+    def test_transactions_run_in_turn(self):
+        responses = []
+        for ident in ("FV1", "FV2", "FV1", "FV2"):
+            self.bus.submit(Transaction(
+                ident, b"READ ident", responses.append))
+        self.assertTrue(self.run_loop(until=lambda: len(responses) == 4))
+        self.assertEqual(responses, [b"OK FV1\n", b"OK FV2\n"] * 2)
+
+    def test_submit_does_not_wait_for_response(self):
+        self.sim.latency = 0.3
+        start = time.monotonic()
+        self.bus.submit(Transaction("FV1", b"READ ident"))
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertIsNotNone(self.bus.current)
+        self.assertTrue(self.run_loop(until=lambda: not self.bus.current))
+
+    def test_no_response_times_out(self):
+        self.assertEqual(
+            self.transact(self.bus, Transaction("FV9", b"READ ident")),
+            b"TIMEOUT\n")
+        self.assertIsNone(self.bus.selected)
+        # The bus carries on
+        self.assertEqual(
+            self.transact(self.bus, Transaction("FV1", b"READ ident")),
+            b"OK FV1\n")
+
+    def test_noise_removed(self):
+        self.sim.noise = 1.0
+        self.assertEqual(
+            self.transact(self.bus, Transaction("FV1", b"READ ident")),
+            b"OK FV1\n")
+        self.assertGreater(self.bus.metrics.noise.values[(self.bus.sp_path,)],
+                           0)
+
+    def test_partial_response_is_corrupt(self):
+        self.sim.partial = 1.0
+        self.assertEqual(
+            self.transact(self.bus, Transaction(None, b"SELECT FV1")),
+            b"CORRUPT\n")
+        self.assertIsNone(self.bus.selected)
+
+    def test_run_until_idle(self):
+        responses = []
+        for ident in ("FV1", "FV2"):
+            self.bus.submit(Transaction(
+                ident, b"READ ident", responses.append))
+        self.bus.run_until_idle()
+        self.assertEqual(responses, [b"OK FV1\n", b"OK FV2\n"])
@@ -0,0 +1,72 @@
+import unittest
+
+from simbus import SimTestCase
+
+
+class Client:
+    """Stands in for a TCP client
+    """
+    def __init__(self, selected=None):
+        self.selected = selected
+        self.selected_bus = None
+
+
+class CacheTest(SimTestCase):
+    """READ commands from TCP clients answered from recent polls
+    """
+    def setUp(self):
+        super().setUp()
+        self.bus = self.make_bus({"FV1": {}}, cache_max_age=60)
+        self.assertTrue(self.run_loop(
+            until=lambda: self.bus.controllers["FV1"].online))
+        self.client = Client("FV1")
+
+    def tcp(self, command, bus=None):
+        responses = []
+        (bus or self.bus).tcp_transaction(
+            self.client, command, responses.append)
+        self.assertTrue(self.run_loop(until=lambda: responses))
+        return responses[0]
+
+    def test_cached_read_does_not_use_bus(self):
+        self.assertEqual(self.tcp(b"READ bl"), b"OK 1000\n")
+        before = self.sim.transactions
+        self.assertEqual(self.tcp(b"READ bl"), b"OK 1000\n")
+        self.assertEqual(self.sim.transactions, before)
+
+    def test_bang_bypasses_cache(self):
+        self.tcp(b"READ bl")
+        self.sim.controllers[0].values["bl"] = "500"
+        self.assertEqual(self.tcp(b"READ bl"), b"OK 1000\n")
+        self.assertEqual(self.tcp(b"!READ bl"), b"OK 500\n")
+        # Which refreshes the cache
+        self.assertEqual(self.tcp(b"READ bl"), b"OK 500\n")
+
+    def test_set_invalidates_cache(self):
+        self.tcp(b"READ bl")
+        self.assertEqual(self.tcp(b"SET bl 500"), b"OK bl set to 500\n")
+        before = self.sim.transactions
+        self.assertEqual(self.tcp(b"READ bl"), b"OK 500\n")
+        self.assertEqual(self.sim.transactions, before + 1)
+
+    def test_read_started_before_set_not_cached(self):
+        responses = []
+        self.bus.tcp_transaction(self.client, b"!READ bl", responses.append)
+        self.bus.tcp_transaction(self.client, b"SET bl 500",
+                                 responses.append)
+        self.assertTrue(self.run_loop(until=lambda: len(responses) == 2))
+        self.assertEqual(self.tcp(b"READ bl"), b"OK 500\n")
+
+    def test_cache_off_by_default(self):
+        sim = self.simulate(["FV1"])
+        bus = self.make_bus({"FV1": {}}, sim=sim)
+        self.assertTrue(self.run_loop(
+            until=lambda: bus.controllers["FV1"].online))
+        self.tcp(b"READ bl", bus)
+        before = sim.transactions
+        self.tcp(b"READ bl", bus)
+        self.assertEqual(sim.transactions, before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
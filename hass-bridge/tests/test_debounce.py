@@ -0,0 +1,59 @@
+import unittest
+
+from simbus import SimTestCase
+
+
+class DebounceTest(SimTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bus = self.make_bus(
+            {"FV1": {"registers": ["set/lo"], "set/lo": {"debounce": 0.2}}})
+        self.controller = self.bus.controllers["FV1"]
+        self.assertTrue(self.run_loop(until=lambda: self.controller.online))
+        self.reg = self.controller.registers["set/lo"]
+        self.sets = []
+        submit = self.bus.submit
+
+        def record(transaction):
+            if transaction.command.startswith(b"SET "):
+                self.sets.append(transaction.command)
+            submit(transaction)
+        self.bus.submit = record
+
+    def command(self, value):
+        self.reg.process_mqtt_message(self.reg.command_topic, value)
+
+    def settled(self):
+        return not (self.reg.writing or self.reg.write_timer
+                    or self.reg.pending_value is not None)
+
+    def test_only_last_command_written(self):
+        for value in ("15", "15.5", "16"):
+            self.command(value)
+        self.run_loop(0.1)
+        self.assertEqual(self.sets, [])
+        self.assertTrue(self.run_loop(until=self.settled))
+        self.assertEqual(self.sets, [b"SET set/lo 16"])
+        self.assertEqual(self.reg.superseded, 2)
+        self.assertEqual(self.mqttc.payloads(self.reg.state_topic)[-1],
+                         "16.0")
+
+    def test_command_during_write(self):
+        self.reg.debounce = 0.0
+        self.sim.latency = 0.1
+        self.command("15")
+        self.assertTrue(self.reg.writing)
+        self.command("15.5")
+        self.command("16")
+        self.assertTrue(self.run_loop(until=self.settled))
+        self.assertEqual(self.sets, [b"SET set/lo 15", b"SET set/lo 16"])
+        self.assertEqual(self.reg.superseded, 1)
+        # Only the final value is published
+        self.assertEqual(self.mqttc.payloads(self.reg.state_topic),
+                         ["16.0"])
+        self.assertEqual(self.sim.controllers[0].values["set/lo"],
+                         "16.000000")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import time
+import unittest
+
+from hass_bridge.hardware import Bridge, DiscoveryQueue
+from hass_bridge.scheduler import Scheduler
+
+from simbus import FakeMQTT, Message, SimTestCase
+
+
+class DiscoveryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.mqttc = FakeMQTT()
+        self.scheduler = Scheduler()
+        self.queue = DiscoveryQueue(self.mqttc, self.scheduler)
+
+    def send_due(self):
+        self.scheduler.run_due()
+        return self.mqttc.published
+
+    def test_rate_limited(self):
+        for topic in ("a", "b", "c"):
+            self.queue.publish(topic, "{}")
+        self.assertEqual(self.send_due(), [("a", "{}", True)])
+        self.assertAlmostEqual(self.scheduler.timeout(),
+                               1 / self.queue.rate, places=2)
+        while self.queue.pending:
+            time.sleep(self.scheduler.timeout())
+            self.send_due()
+        self.assertEqual(self.mqttc.topics(), ["a", "b", "c"])
+
+    def test_unchanged_message_not_sent_again(self):
+        called = []
+        self.queue.publish("a", "{}", lambda: called.append(1))
+        self.send_due()
+        self.queue.publish("a", "{}", lambda: called.append(2))
+        self.assertEqual(called, [1, 2])
+        self.queue.publish("a", '{"name": "x"}')
+        self.send_due()
+        self.assertEqual(self.mqttc.payloads("a"), ["{}", '{"name": "x"}'])
+
+    def test_forget(self):
+        self.queue.publish("a", "{}")
+        self.send_due()
+        self.queue.forget()
+        self.queue.publish("a", "{}")
+        self.send_due()
+        self.assertEqual(self.mqttc.payloads("a"), ["{}", "{}"])
+
+    def test_waits_until_connected(self):
+        self.mqttc.connected = False
+        self.queue.publish("a", "{}")
+        self.assertEqual(self.send_due(), [])
+        self.mqttc.connected = True
+        self.queue.resume()
+        self.assertEqual(self.send_due(), [("a", "{}", True)])
+
+
+class RepublishTest(SimTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bus = self.make_bus({"FV1": {"registers": ["t0", "m0/name"]}})
+        self.bridge = Bridge([self.bus], self.mqttc, "homeassistant",
+                             "fvtest", self.scheduler)
+        self.bridge.ha_settle_time = 0.1
+        self.controller = self.bus.controllers["FV1"]
+        self.t0 = self.controller.registers["t0"]
+        self.bridge.mqtt_connected()
+        self.assertTrue(self.run_loop(until=self.idle))
+        self.t0.publish_update("18.5")
+        self.mqttc.published.clear()
+
+    def idle(self):
+        return self.controller.online and not self.bus.discovery.pending
+
+    def check_republished(self):
+        self.assertTrue(self.run_loop(until=lambda: self.idle() and (
+            self.t0.state_topic in self.mqttc.topics())))
+        topics = self.mqttc.topics()
+        self.assertIn(self.t0.discovery_topic, topics)
+        self.assertIn(self.controller.buttons[0].discovery_topic, topics)
+        self.assertIn(self.controller.availability_topic, topics)
+        self.assertIn(self.bridge.availability_topic, topics)
+        # Each state follows its discovery message
+        self.assertLess(topics.index(self.t0.discovery_topic),
+                        topics.index(self.t0.state_topic))
+        self.assertEqual(self.mqttc.payloads(self.t0.state_topic), ["18.5"])
+
+    def test_reconnect(self):
+        self.bridge.mqtt_connected()
+        self.check_republished()
+
+    def test_home_assistant_restart(self):
+        self.bridge.process_mqtt_message(
+            Message("homeassistant/status", b"online"))
+        self.assertEqual(self.mqttc.published, [])
+        self.check_republished()
+
+    def test_empty_mode_name_not_announced(self):
+        button = self.controller.buttons[0]
+        self.controller.registers["m0/name"].publish_update("Crash")
+        self.assertTrue(self.run_loop(until=self.idle))
+        self.assertIn('"name": "Crash"',
+                      self.mqttc.payloads(button.discovery_topic)[-1])
+        self.mqttc.published.clear()
+        button.set_name("")
+        self.assertTrue(self.run_loop(until=self.idle))
+        self.assertEqual(button.human_name, "Crash")
+        self.assertEqual(self.mqttc.payloads(button.discovery_topic), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import inspect
+import socket
+import unittest
+
+import fvmetrics
+from hass_bridge import metrics
+from hass_bridge.hardware import Bridge, Transaction
+from hass_bridge.main import MetricsClient, TcpListener
+
+from simbus import SimTestCase
+
+
+class RegistryTest(unittest.TestCase):
+    def test_exposition(self):
+        registry = metrics.Registry()
+        counter = registry.counter("c_total", "A counter", ("bus",))
+        histogram = registry.histogram("h_seconds", "A histogram", (),
+                                       buckets=(0.1, 1.0))
+        registry.sampled("g", "A gauge", ("bus",),
+                         lambda: [(("/dev/tty\"1",), 3)])
+        counter.inc("a")
+        counter.inc("a", amount=2)
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(registry.exposition().decode("utf-8"), "".join(
+            f"{line}\n" for line in [
+                "# HELP c_total A counter",
+                "# TYPE c_total counter",
+                'c_total{bus="a"} 3',
+                "# HELP h_seconds A histogram",
+                "# TYPE h_seconds histogram",
+                'h_seconds_bucket{le="0.1"} 1',
+                'h_seconds_bucket{le="1.0"} 2',
+                'h_seconds_bucket{le="+Inf"} 3',
+                "h_seconds_sum 5.55",
+                "h_seconds_count 3",
+                "# HELP g A gauge",
+                "# TYPE g gauge",
+                'g{bus="/dev/tty\\"1"} 3']))
+
+    def test_copy_in_step(self):
+        # Everything but the docstring
+        self.assertEqual(
+            inspect.getsource(metrics).split('"""', 2)[2],
+            inspect.getsource(fvmetrics).split('"""', 2)[2])
+
+
+class MetricsEndpointTest(SimTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bus = self.make_bus()
+        self.bridge = Bridge([self.bus], self.mqttc, "homeassistant",
+                             "fvtest", self.scheduler,
+                             metrics=self.bus.metrics)
+        self.listener = socket.socket()
+        self.addCleanup(self.listener.close)
+        self.listener.bind(("localhost", 0))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        TcpListener(self.listener, self.sel, self.bridge, MetricsClient)
+
+    def get(self, path):
+        conn = socket.create_connection(self.listener.getsockname())
+        self.addCleanup(conn.close)
+        conn.sendall(f"GET {path} HTTP/1.0\r\n\r\n".encode("ascii"))
+        conn.setblocking(False)
+        received = []
+
+        def closed():
+            try:
+                data = conn.recv(65536)
+            except BlockingIOError:
+                return False
+            received.append(data)
+            return not data
+        self.assertTrue(self.run_loop(until=closed))
+        return b"".join(received).decode("utf-8")
+
+    def test_transactions_counted(self):
+        for command in (b"READ ident", b"READ ident", b"FOO"):
+            self.transact(self.bus, Transaction("FV1", command))
+        response = self.get("/metrics")
+        self.assertTrue(response.startswith("HTTP/1.0 200 OK\r\n"))
+        path = self.bus.sp_path
+        for line in (
+                f'fvbridge_transactions_total{{bus="{path}",'
+                f'controller="FV1",command="READ",result="ok"}} 2',
+                f'fvbridge_transactions_total{{bus="{path}",'
+                f'controller="FV1",command="other",result="error"}} 1',
+                f'fvbridge_selects_total{{bus="{path}",result="hit"}} 2',
+                f'fvbridge_selects_total{{bus="{path}",result="miss"}} 1',
+                f'fvbridge_queue_depth{{bus="{path}",priority="poll"}} 0'):
+            self.assertIn(f"\n{line}\n", response)
+
+    def test_other_paths_not_found(self):
+        self.assertTrue(self.get("/").startswith(
+            "HTTP/1.0 404 Not Found\r\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from hass_bridge.hardware import PRIORITY_READ
+
+from simbus import SimTestCase
+
+ACTIVE = ["alarm/hi", "alarm/lo", "set/hi", "set/lo", "jog/hi", "jog/lo",
+          "mode"]
+MODE = ["m0/a/hi", "m0/a/lo", "m0/hi", "m0/lo", "m0/j/hi", "m0/j/lo",
+        "m0/name"]
+
+
+class ModeButtonTest(SimTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bus = self.make_bus({"FV1": {"registers": ACTIVE + MODE}})
+        self.controller = self.bus.controllers["FV1"]
+        self.assertTrue(self.run_loop(until=lambda: self.controller.online))
+        self.button, = self.controller.buttons
+        self.values = self.sim.controllers[0].values
+        self.values.update({
+            "m0/a/hi": "30", "m0/a/lo": "2", "m0/hi": "12.5", "m0/lo": "12",
+            "m0/j/hi": "14", "m0/j/lo": "10", "m0/name": "Crash"})
+        self.submitted = []
+        submit = self.bus.submit
+
+        def record(transaction):
+            self.submitted.append((transaction.command, transaction.priority))
+            submit(transaction)
+        self.bus.submit = record
+
+    def remember_all(self):
+        for name, reg in self.controller.registers.items():
+            reg.remember(self.values[name])
+
+    def idle(self):
+        return not (self.button.activating or self.bus.current
+                    or any(self.bus.queues))
+
+    def press(self):
+        self.button.process_mqtt_message(self.button.command_topic, "ON")
+        self.assertTrue(self.run_loop(until=self.idle))
+
+    def commands(self, verb):
+        return [c.decode("ascii") for c, _ in self.submitted
+                if c.startswith(verb)]
+
+    def test_known_values_not_read_again(self):
+        self.remember_all()
+        self.press()
+        self.assertEqual(self.commands(b"READ "), [])
+        self.assertEqual(self.commands(b"SET "), [
+            "SET alarm/hi 30", "SET alarm/lo 2", "SET set/hi 12.5",
+            "SET set/lo 12", "SET jog/hi 14", "SET jog/lo 10",
+            "SET mode Crash"])
+        self.assertEqual(self.values["set/lo"], "12.000000")
+        self.assertEqual(self.values["mode"], "Crash")
+        # State is published once everything has been written
+        self.assertEqual(
+            self.mqttc.payloads(self.controller.registers["mode"].state_topic),
+            ["Crash"])
+
+    def test_unknown_values_read_first(self):
+        self.press()
+        self.assertEqual(sorted(self.commands(b"READ ")),
+                         sorted(f"READ {name}" for name in ACTIVE + MODE))
+        self.assertTrue(all(priority == PRIORITY_READ
+                            for c, priority in self.submitted
+                            if c.startswith(b"READ ")))
+        self.assertEqual(self.values["set/hi"], "12.500000")
+
+    def test_old_values_read_again(self):
+        self.remember_all()
+        self.values["m0/lo"] = "11"
+        self.controller.registers["m0/lo"].updated -= (
+            self.button.max_value_age + 1)
+        self.press()
+        self.assertEqual(self.commands(b"READ "), ["READ m0/lo"])
+        self.assertEqual(self.values["set/lo"], "11.000000")
+
+    def test_failed_write_rolled_back(self):
+        self.values["m0/j/hi"] = "hot"
+        self.remember_all()
+        self.press()
+        self.assertEqual(self.commands(b"SET "), [
+            "SET alarm/hi 30", "SET alarm/lo 2", "SET set/hi 12.5",
+            "SET set/lo 12", "SET jog/hi hot",
+            "SET set/lo 18.000000", "SET set/hi 18.500000",
+            "SET alarm/lo 5.000000", "SET alarm/hi 25.000000"])
+        self.assertEqual(
+            [self.values[name] for name in ("alarm/hi", "alarm/lo",
+                                            "set/hi", "set/lo", "mode")],
+            ["25.000000", "5.000000", "18.500000", "18.000000", "Ferment"])
+
+    def test_press_while_activating_ignored(self):
+        self.remember_all()
+        self.button.process_mqtt_message(self.button.command_topic, "ON")
+        self.press()
+        self.assertEqual(len(self.commands(b"SET ")), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from hass_bridge.hardware import (
+    Transaction, PRIORITY_SET, PRIORITY_READ, PRIORITY_TCP, PRIORITY_POLL)
+
+from simbus import SimTestCase
+
+
+class PriorityTest(SimTestCase):
+    def setUp(self):
+        super().setUp()
+        # Polls aren't held back by the budget here
+        self.bus = self.make_bus(max_poll_utilisation=1.0)
+        self.order = []
+
+    def submit(self, name, priority):
+        self.bus.submit(Transaction(
+            "FV1", b"READ ident", lambda r: self.order.append(name),
+            priority))
+
+    def test_queues_run_in_priority_order(self):
+        self.submit("first", PRIORITY_POLL)
+        for name, priority in (("poll", PRIORITY_POLL), ("tcp", PRIORITY_TCP),
+                               ("read", PRIORITY_READ), ("set", PRIORITY_SET),
+                               ("read2", PRIORITY_READ)):
+            self.submit(name, priority)
+        self.assertTrue(self.run_loop(until=lambda: len(self.order) == 6))
+        # The transaction in progress isn't pre-empted
+        self.assertEqual(self.order,
+                         ["first", "set", "read", "read2", "tcp", "poll"])
+        self.assertEqual([s.count for s in self.bus.stats], [1, 2, 1, 2])
+        self.assertEqual([s.depth for s in self.bus.stats], [0, 0, 0, 0])
+        self.assertEqual([s.max_depth for s in self.bus.stats], [1, 2, 1, 1])
+
+    def test_stats(self):
+        self.submit("poll", PRIORITY_POLL)
+        self.run_loop(until=lambda: self.order)
+        responses = []
+        self.bus.tcp_transaction(None, b"STATS", responses.append)
+        lines = responses[0].decode("ascii").splitlines()
+        self.assertEqual(lines[0], "OK STATS 7")
+        self.assertEqual([line.split()[0] for line in lines[1:5]],
+                         ["set", "read", "tcp", "poll"])
+
+
+class ErrorAckTest(SimTestCase):
+    def test_error_counter_ack_is_a_poll(self):
+        bus = self.make_bus({"FV1": {"registers": ["err/crc"]}})
+        controller = bus.controllers["FV1"]
+        self.assertTrue(self.run_loop(until=lambda: controller.online))
+        self.sim.controllers[0].values["err/crc"] = "2"
+        submitted = []
+        submit = bus.submit
+
+        def record(transaction):
+            submitted.append((transaction.command, transaction.priority))
+            submit(transaction)
+        bus.submit = record
+        controller.registers["err/crc"].poll()
+        self.assertTrue(self.run_loop(
+            until=lambda: self.sim.controllers[0].values["err/crc"] == "0"))
+        self.assertEqual(submitted, [(b"READ err/crc", PRIORITY_POLL),
+                                     (b"SET err/crc 2", PRIORITY_POLL)])
+
+
+if __name__ == "__main__":
+    unittest.main()
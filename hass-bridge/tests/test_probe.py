@@ -0,0 +1,61 @@
+import time
+import unittest
+from unittest import mock
+
+from hass_bridge.hardware import Bus, Controller
+
+from simbus import SimTestCase
+
+
+class ProbeTest(SimTestCase):
+    idents = ["FV1", "FV2"]
+
+    def setUp(self):
+        super().setUp()
+        for patch in (
+                mock.patch.object(Bus, "response_timeout", 0.2),
+                mock.patch.object(Controller, "probe_interval_min", 0.3)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_probes_do_not_hold_up_startup(self):
+        self.sim.latency = 0.1
+        start = time.monotonic()
+        bus = self.make_bus({"FV1": {}, "FV2": {}})
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual([c.state for c in bus.controllers.values()],
+                         [Controller.HALF_OPEN] * 2)
+        self.assertTrue(self.run_loop(until=lambda: all(
+            c.online for c in bus.controllers.values())))
+
+    def test_missing_controller_probed_again(self):
+        fv2_sim = self.sim.controllers.pop()
+        bus = self.make_bus({"FV1": {"registers": ["t0"]},
+                             "FV2": {"registers": ["t0"]}})
+        fv1, fv2 = bus.controllers.values()
+        self.assertTrue(self.run_loop(
+            until=lambda: fv1.online and fv2.state == Controller.OPEN))
+        # Only the controller that answered is announced
+        topics = self.mqttc.topics()
+        self.assertIn(fv1.registers["t0"].discovery_topic, topics)
+        self.assertNotIn(fv2.registers["t0"].discovery_topic, topics)
+        self.assertNotIn(fv2.availability_topic, topics)
+        self.sim.controllers.append(fv2_sim)
+        self.assertTrue(self.run_loop(until=lambda: fv2.online))
+        self.assertEqual(fv2.sw_version, "sim")
+        self.assertEqual(fv2.probe_interval, 0.3)
+        self.assertTrue(self.run_loop(until=lambda: (
+            fv2.registers["t0"].discovery_topic in self.mqttc.topics())))
+        self.assertEqual(set(self.mqttc.payloads(fv2.availability_topic)),
+                         {b"online"})
+
+    def test_probe_interval_backs_off(self):
+        self.sim.controllers.pop()
+        bus = self.make_bus({"FV2": {}})
+        fv2 = bus.controllers["FV2"]
+        self.assertTrue(self.run_loop(until=lambda: fv2.probe_interval > 1.0))
+        self.assertEqual(fv2.probe_interval, 1.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
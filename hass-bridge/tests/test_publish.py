@@ -0,0 +1,58 @@
+import json
+import unittest
+
+from simbus import SimTestCase
+
+
+class PublishTest(SimTestCase):
+    def register(self, name, config=None):
+        bus = self.make_bus(
+            {"FV1": {"registers": [name], name: config or {}}})
+        return bus.controllers["FV1"].registers[name]
+
+    def test_changes_within_deadband_suppressed(self):
+        t0 = self.register("t0")
+        for value in ("18.50", "18.52", "18.46", "18.56", "18.57"):
+            t0.publish_update(value)
+        self.assertEqual(self.mqttc.payloads(t0.state_topic),
+                         ["18.50", "18.56"])
+        self.assertEqual((t0.published, t0.suppressed), (2, 3))
+
+    def test_deadband_configurable(self):
+        t0 = self.register("t0", {"deadband": 0})
+        for value in ("18.50", "18.52", "18.52"):
+            t0.publish_update(value)
+        self.assertEqual(self.mqttc.payloads(t0.state_topic),
+                         ["18.50", "18.52"])
+
+    def test_unchanged_value_republished_after_heartbeat(self):
+        v0 = self.register("v0")
+        v0.publish_update("Open")
+        v0.publish_update("Open")
+        self.assertEqual(self.mqttc.payloads(v0.state_topic), ["Open"])
+        v0.published_at -= v0.heartbeat
+        v0.publish_update("Open")
+        self.assertEqual(self.mqttc.payloads(v0.state_topic),
+                         ["Open", "Open"])
+
+    def test_heartbeat_fits_expire_after(self):
+        v0 = self.register("v0")
+        self.assertEqual((v0.expire_after, v0.heartbeat), (90, 20))
+        self.assertEqual(json.loads(v0.discovery_payload())["expire_after"],
+                         90)
+        t0 = self.register("t0", {"poll-interval": 5, "expire-after": 120})
+        self.assertEqual((t0.expire_after, t0.heartbeat), (120, 105))
+
+    def test_heartbeat_too_long_for_expire_after(self):
+        with self.assertLogs("hass_bridge.hardware", "WARNING"):
+            t0 = self.register("t0", {"poll-interval": 5, "heartbeat": 600})
+        self.assertEqual((t0.expire_after, t0.heartbeat), (35, 20))
+
+    def test_expire_after_allows_longest_adaptive_interval(self):
+        t0 = self.register("t0", {"min-poll-interval": 10,
+                                  "max-poll-interval": 300})
+        self.assertEqual(t0.expire_after, 330)
+
+
+if __name__ == "__main__":
+    unittest.main()
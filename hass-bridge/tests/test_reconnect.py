@@ -0,0 +1,55 @@
+import unittest
+
+from hass_bridge.hardware import Bridge
+from hass_bridge.scheduler import Scheduler
+
+from simbus import FakeMQTT
+
+
+class ReconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.mqttc = FakeMQTT()
+        self.mqttc.connected = False
+        self.bridge = Bridge([], self.mqttc, "homeassistant", "fvtest",
+                             self.scheduler)
+
+    def delays(self, attempts):
+        """Let the reconnection attempts fail, returning the delay
+        before each
+        """
+        delays = []
+        for _ in range(attempts):
+            delays.append(round(self.scheduler.timeout()))
+            self.bridge.reconnect_timer.cancel()
+            self.bridge.reconnect()
+        return delays
+
+    def test_delay_doubles_up_to_maximum(self):
+        self.bridge.mqtt_disconnected()
+        self.assertEqual(self.delays(8), [1, 2, 4, 8, 16, 32, 60, 60])
+        self.assertEqual(self.mqttc.reconnects, 8)
+
+    def test_one_attempt_at_a_time(self):
+        self.bridge.mqtt_disconnected()
+        timer = self.bridge.reconnect_timer
+        self.bridge.mqtt_disconnected()
+        self.assertIs(self.bridge.reconnect_timer, timer)
+        self.assertEqual(len(self.scheduler.heap), 1)
+        self.assertEqual(self.bridge.reconnect_delay, 2)
+
+    def test_delay_reset_once_connected(self):
+        self.bridge.mqtt_disconnected()
+        self.delays(3)
+        self.mqttc.connected = True
+        self.bridge.reconnect_timer.cancel()
+        self.bridge.reconnect()
+        self.assertIsNone(self.bridge.reconnect_timer)
+        self.bridge.mqtt_connected()
+        self.mqttc.connected = False
+        self.bridge.mqtt_disconnected()
+        self.assertEqual(self.delays(2), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
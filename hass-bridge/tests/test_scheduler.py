@@ -0,0 +1,76 @@
+import time
+import unittest
+
+from hass_bridge.scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.called = []
+
+    def callback(self, name):
+        return lambda: self.called.append(name)
+
+    def test_runs_due_timers_in_deadline_order(self):
+        now = time.monotonic()
+        self.scheduler.call_at(now - 1, self.callback("second"))
+        self.scheduler.call_at(now - 2, self.callback("first"))
+        self.scheduler.call_at(now + 60, self.callback("later"))
+        self.scheduler.run_due()
+        self.assertEqual(self.called, ["first", "second"])
+
+    def test_equal_deadlines_run_in_order_scheduled(self):
+        when = time.monotonic() - 1
+        for name in ("a", "b", "c"):
+            self.scheduler.call_at(when, self.callback(name))
+        self.scheduler.run_due()
+        self.assertEqual(self.called, ["a", "b", "c"])
+
+    def test_timer_runs_once(self):
+        self.scheduler.call_later(0, self.callback("once"))
+        self.scheduler.run_due()
+        self.scheduler.run_due()
+        self.assertEqual(self.called, ["once"])
+
+    def test_cancelled_timer_is_not_run(self):
+        timer = self.scheduler.call_later(0, self.callback("cancelled"))
+        timer.cancel()
+        timer.cancel()
+        self.scheduler.run_due()
+        self.assertEqual(self.called, [])
+        self.assertEqual(self.scheduler.cancelled, 0)
+
+    def test_cancelling_after_running_does_nothing(self):
+        timer = self.scheduler.call_later(0, self.callback("ran"))
+        self.scheduler.run_due()
+        timer.cancel()
+        self.assertEqual(self.scheduler.cancelled, 0)
+
+    def test_timeout(self):
+        self.assertIsNone(self.scheduler.timeout())
+        self.assertEqual(self.scheduler.timeout(5.0), 5.0)
+        self.scheduler.call_later(30, self.callback("later"))
+        self.assertEqual(self.scheduler.timeout(5.0), 5.0)
+        self.assertGreater(self.scheduler.timeout(), 25.0)
+        self.scheduler.call_later(-1, self.callback("overdue"))
+        self.assertEqual(self.scheduler.timeout(5.0), 0.0)
+
+    def test_timeout_skips_cancelled_timers(self):
+        self.scheduler.call_later(1, self.callback("soon")).cancel()
+        self.scheduler.call_later(30, self.callback("later"))
+        self.assertGreater(self.scheduler.timeout(), 25.0)
+        self.assertEqual(len(self.scheduler.heap), 1)
+
+    def test_heap_rebuilt_when_mostly_cancelled(self):
+        timers = [self.scheduler.call_later(60, self.callback(i))
+                  for i in range(10)]
+        for timer in timers[:8]:
+            timer.cancel()
+        self.scheduler.call_later(60, self.callback("new"))
+        self.assertEqual(len(self.scheduler.heap), 3)
+        self.assertEqual(self.scheduler.cancelled, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from hass_bridge.hardware import Bridge
+
+from simbus import SimTestCase
+
+
+class StateFileTest(SimTestCase):
+    config = {"FV1": {"registers": ["t0", "v0"]}}
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.state_file = os.path.join(tmpdir.name, "state.json")
+
+    def bridge(self, sim=None):
+        bus = self.make_bus(self.config, sim=sim)
+        return bus, Bridge([bus], self.mqttc, "homeassistant", "fvtest",
+                           self.scheduler, state_file=self.state_file)
+
+    def write_state(self, state):
+        with open(self.state_file, "w") as f:
+            f.write(state if isinstance(state, str) else json.dumps(state))
+
+    def test_saved_state_restored(self):
+        bus, bridge = self.bridge()
+        controller = bus.controllers["FV1"]
+        self.assertTrue(self.run_loop(until=lambda: controller.online))
+        controller.registers["t0"].remember("18.5")
+        bridge.save_state()
+        self.assertEqual(os.listdir(os.path.dirname(self.state_file)),
+                         ["state.json"])
+
+        # The next run, before the controller has answered
+        bus, bridge = self.bridge(self.simulate(["FV1"]))
+        controller = bus.controllers["FV1"]
+        self.assertEqual(controller.sw_version, "sim")
+        self.assertTrue(controller.known)
+        t0 = controller.registers["t0"]
+        self.assertEqual(t0.value, "18.5")
+        self.assertTrue(t0.restored)
+        self.assertIsNone(controller.registers["v0"].value)
+        # Restored values are published once connected
+        bridge.mqtt_connected()
+        self.assertTrue(self.run_loop(
+            until=lambda: t0.state_topic in self.mqttc.topics()))
+        self.assertEqual(self.mqttc.payloads(t0.state_topic), ["18.5"])
+        attributes = json.loads(self.mqttc.payloads(t0.attributes_topic)[0])
+        self.assertTrue(attributes["restored"])
+
+    def test_unreadable_state_ignored(self):
+        for state in (
+                "not json",
+                [1, 2],
+                {"saved": time.time()},
+                {"controllers": {"FV1": {"sw_version": "sim"}}},
+                {"controllers": {"FV1": {"sw_version": "sim",
+                                         "registers": ["t0"]}}},
+                {"controllers": {"FV1": {"sw_version": "sim", "registers": {
+                    "t0": {"value": "18.5", "time": "yesterday"}}}}}):
+            with self.subTest(state=state):
+                self.write_state(state)
+                with self.assertLogs("hass_bridge.hardware", "WARNING"):
+                    bus, bridge = self.bridge()
+                controller = bus.controllers["FV1"]
+                self.assertIsNone(controller.sw_version)
+                self.assertIsNone(controller.registers["t0"].value)
+
+    def test_missing_state_file(self):
+        bus, bridge = self.bridge()
+        self.assertIsNone(bus.controllers["FV1"].sw_version)
+
+
+if __name__ == "__main__":
+    unittest.main()
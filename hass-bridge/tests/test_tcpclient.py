@@ -0,0 +1,78 @@
+import socket
+import time
+import unittest
+
+from hass_bridge.main import TcpListener
+
+from simbus import SimTestCase
+
+
+class TcpClientTest(SimTestCase):
+    """Third-party clients talking to simulated controllers via the bridge
+    """
+    idents = ["FV1", "FV2"]
+
+    def setUp(self):
+        super().setUp()
+        self.bus = self.make_bus()
+        self.listener = socket.socket()
+        self.addCleanup(self.listener.close)
+        self.listener.bind(("localhost", 0))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        TcpListener(self.listener, self.sel, self.bus)
+
+    def connect(self):
+        conn = socket.create_connection(self.listener.getsockname())
+        conn.setblocking(False)
+        self.addCleanup(conn.close)
+        return conn
+
+    def run_until_closed(self, conn, timeout=5.0):
+        """Run the event loop until the bridge closes the connection
+
+        Returns everything received on it.
+        """
+        received = b""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.run_loop(0.01)
+            try:
+                data = conn.recv(4096)
+            except BlockingIOError:
+                continue
+            if not data:
+                return received
+            received += data
+        self.fail(f"Connection not closed; received {received!r}")
+
+    def test_half_close_gets_every_response(self):
+        conn = self.connect()
+        conn.sendall(b"SELECT FV1\nREAD ident\nSELECT FV2\nREAD ident\n")
+        conn.shutdown(socket.SHUT_WR)
+        self.assertEqual(
+            self.run_until_closed(conn),
+            b"OK FV1 selected\nOK FV1\nOK FV2 selected\nOK FV2\n")
+
+    def test_clients_keep_their_own_selection(self):
+        first = self.connect()
+        second = self.connect()
+        first.sendall(b"SELECT FV1\nREAD ident\nREAD ident\n")
+        second.sendall(b"SELECT FV2\nREAD ident\nREAD ident\n")
+        first.shutdown(socket.SHUT_WR)
+        second.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.run_until_closed(first),
+                         b"OK FV1 selected\nOK FV1\nOK FV1\n")
+        self.assertEqual(self.run_until_closed(second),
+                         b"OK FV2 selected\nOK FV2\nOK FV2\n")
+
+    def test_close_with_nothing_pending(self):
+        conn = self.connect()
+        conn.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.run_until_closed(conn), b"")
+        # Only the bus and the listener are left
+        self.assertEqual(len(self.sel.get_map()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
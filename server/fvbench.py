@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# This script benchmarks the paths through which software reaches the
+# fvcontroller bus, using a simulated bus (see fvsim.py) so that no
+# hardware is needed.  For each combination of number of controllers
+# and fault rates it measures:
+#
+#   fvserial   a TCP client talking to fvserial.py, end to end
+#   bridge     hass_bridge.hardware.Bus transactions on the serial port
+#   datalog    datalog.models.Controller.read() through fvserial.py
+#
+# A transaction is reading t0 from the next controller in turn,
+# including the SELECT needed to switch to it.  The results (rate,
+# latency percentiles and a latency histogram for each run) are
+# written as JSON so that runs can be compared across commits.
+
+import argparse
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import fvsim
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SERVER_DIR, "fvlogging"))
+sys.path.append(os.path.join(SERVER_DIR, "..", "hass-bridge"))
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+
+def percentile(values, p):
+    """Return the p'th percentile of a sorted list
+    """
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def classify(response):
+    if response is None:
+        return "error"
+    if response.startswith("OK "):
+        return "ok"
+    if response in ("TIMEOUT", "CORRUPT"):
+        return response.lower()
+    return "error"
+
+
+def summarise(latencies, outcomes, elapsed):
+    latencies = sorted(latencies)
+    histogram = [0] * (len(BUCKETS) + 1)
+    for t in latencies:
+        for i, bound in enumerate(BUCKETS):
+            if t <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[-1] += 1
+    return {
+        "transactions": len(latencies),
+        "elapsed": elapsed,
+        "transactions_per_second": len(latencies) / elapsed,
+        "latency": {
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1],
+        },
+        "histogram": {
+            "buckets": BUCKETS + ["+Inf"],
+            "counts": histogram,
+        },
+        "outcomes": {k: outcomes.count(k) for k in sorted(set(outcomes))},
+    }
+
+
+def run(transaction, idents, count):
+    """Time count transactions, cycling through the controllers
+    """
+    latencies = []
+    outcomes = []
+    start = time.monotonic()
+    for i in range(count):
+        ident = idents[i % len(idents)]
+        t = time.monotonic()
+        outcomes.append(classify(transaction(ident)))
+        latencies.append(time.monotonic() - t)
+    return summarise(latencies, outcomes, time.monotonic() - start)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_fvserial(path, port, *args):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(SERVER_DIR, "fvserial.py"),
+         "--serial", path, "--port", str(port), *args])
+    deadline = time.monotonic() + 10.0
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.terminate()
+    raise RuntimeError("fvserial.py did not start")
+
+
+def bench_fvserial(path, port, idents, count):
+    with socket.create_connection(("localhost", port)) as s, \
+         s.makefile("rw") as f:
+        def transaction(ident):
+            f.write(f"SELECT {ident}\nREAD t0\n")
+            f.flush()
+            selected = f.readline().strip()
+            response = f.readline().strip()
+            if selected != f"OK {ident} selected":
+                return selected
+            return response
+        return run(transaction, idents, count)
+
+
+def bench_bridge(path, port, idents, count):
+    from hass_bridge.hardware import Bus, Transaction
+    # Our transactions are queued as polls; don't hold them back
+    bus = Bus(path, {}, None, "homeassistant", "fvbench",
+              max_poll_utilisation=1.0)
+
+    def transaction(ident):
+        responses = []
+        bus.submit(Transaction(ident, b"READ t0", responses.append))
+        bus.run_until_idle()
+        return responses[0].decode("ascii").strip()
+    try:
+        return run(transaction, idents, count)
+    finally:
+        bus.s.close()
+
+
+def bench_datalog(path, port, idents, count):
+    import django
+    from django.conf import settings
+    if not settings.configured:
+        # With no cache, controllers are never marked as down (see
+        # datalog.health), so every transaction goes to the bus
+        settings.configure(
+            INSTALLED_APPS=["datalog"],
+            CACHES={"default": {
+                "BACKEND": "django.core.cache.backends.dummy.DummyCache"}})
+        django.setup()
+    from datalog.models import Controller
+    controllers = {
+        ident: Controller(ident=ident, address="localhost", port=port,
+                          active=True)
+        for ident in idents}
+
+    def transaction(ident):
+        r = controllers[ident].read("t0")
+        return None if r is None else f"OK {r}"
+    return run(transaction, idents, count)
+
+
+PATHS = {
+    "fvserial": bench_fvserial,
+    "bridge": bench_bridge,
+    "datalog": bench_datalog,
+}
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=SERVER_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def floats(arg):
+    return [float(x) for x in arg.split(",")]
+
+
+def ints(arg):
+    return [int(x) for x in arg.split(",")]
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark access to a simulated fvcontroller bus")
+    parser.add_argument(
+        '--paths', default=",".join(PATHS),
+        help="Comma-separated paths to measure")
+    parser.add_argument(
+        '--controllers', type=ints, default=[1, 10, 100],
+        help="Comma-separated numbers of controllers")
+    parser.add_argument(
+        '--drop', type=floats, default=[0.0, 0.01],
+        help="Comma-separated probabilities of a reply being dropped")
+    parser.add_argument(
+        '--corrupt', type=floats, default=[0.0, 0.01],
+        help="Comma-separated probabilities of a reply being cut off "
+        "or having noise mixed in")
+    parser.add_argument(
+        '--count', type=int, default=200,
+        help="Transactions per run")
+    parser.add_argument(
+        '--baud', type=int, default=fvsim.DEFAULT_BAUD,
+        help="Simulated line speed, or 0 for no per-byte delay")
+    parser.add_argument(
+        '--seed', type=int, default=1, help="Random number seed")
+    parser.add_argument(
+        '-o', '--output', help="Write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.controllers:
+        idents = [f"FV{i}" for i in range(1, n + 1)]
+        for drop in args.drop:
+            for corrupt in args.corrupt:
+                bus = fvsim.Bus(idents, baud=args.baud, drop=drop,
+                                partial=corrupt / 2, noise=corrupt / 2,
+                                seed=args.seed)
+                path = bus.start()
+                port = free_port()
+                proxy = start_fvserial(path, port)
+                try:
+                    for name in args.paths.split(","):
+                        if name == "bridge":
+                            # The bridge needs the serial port to itself
+                            proxy.terminate()
+                            proxy.wait()
+                        print(f"{name}: {n} controllers, drop {drop}, "
+                              f"corrupt {corrupt}", file=sys.stderr)
+                        result = PATHS[name](path, port, idents, args.count)
+                        result.update({
+                            "path": name,
+                            "controllers": n,
+                            "drop": drop,
+                            "corrupt": corrupt,
+                        })
+                        results.append(result)
+                        if name == "bridge":
+                            proxy = start_fvserial(path, port)
+                finally:
+                    proxy.terminate()
+                    proxy.wait()
+                    bus.stop()
+
+    report = {
+        "commit": commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "baud": args.baud,
+        "count": args.count,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,281 @@
+"""Pooled sessions on the RS485 bus proxy.
+
+Opening a TCP connection and selecting a controller costs two round
+trips before any useful work is done.  The pool keeps connections to
+each (address, port) open between uses, and remembers which
+controller each one has selected so that repeated access to one
+controller skips the SELECT entirely.
+
+A session is only ever used by one thread at a time: it is checked
+out of the pool for the duration of a transaction and handed back
+afterwards.  Sessions that have been idle for more than MAX_IDLE
+seconds are closed, both so that we don't try to use a connection
+the proxy has given up on and so that we don't hold the bus proxy
+open when there is nothing to do.
+
+A process can set pool.priority to ask the proxy to run its commands
+at that priority; background logging uses "poll" so that it gives way
+to people using the web interface.
+"""
+
+import select
+import socket
+import threading
+import time
+
+# Socket timeout while waiting for a response from the proxy
+TIMEOUT = 1.5
+
+# Extra time allowed for an MREAD header per register read, since the
+# header only arrives once every READ has been run, and each can take
+# up to the proxy's own timeout if the controller doesn't answer
+MREAD_TIMEOUT_PER_REGISTER = 1.5
+
+# Idle sessions are closed after this many seconds
+MAX_IDLE = 5.0
+
+
+class BusError(Exception):
+    """The proxy could not be reached or the connection failed."""
+
+
+class ConnectError(BusError):
+    """The connection to the proxy was refused or couldn't be made."""
+
+
+class ProxyTimeout(BusError):
+    """The proxy didn't respond in time; it may just be busy."""
+
+
+class SelectError(BusError):
+    """The controller did not acknowledge the SELECT command."""
+
+
+class MreadUnsupported(BusError):
+    """The proxy does not understand the MREAD command."""
+
+
+class Session:
+    """A connection to a bus proxy.
+
+    Tracks which controller is selected on the connection.
+    """
+    def __init__(self, address, port):
+        self.key = (address, port)
+        self.selected = None
+        self.priority = None
+        self.reused = False
+        self.last_used = time.monotonic()
+        try:
+            self.sock = socket.create_connection(
+                (address, port), timeout=TIMEOUT)
+        except OSError as e:
+            raise ConnectError(
+                f"Could not connect to {address}:{port}") from e
+        self.f = self.sock.makefile('rw')
+
+    def close(self):
+        self.selected = None
+        try:
+            self.f.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+    def stale(self):
+        """Has this session been idle too long or closed by the proxy?
+
+        The proxy never sends anything unprompted, so a readable
+        socket on an idle session means end-of-file or garbage; either
+        way we can't use it.
+        """
+        if time.monotonic() - self.last_used > MAX_IDLE:
+            return True
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def readline(self):
+        response = self.f.readline()
+        if not response.endswith("\n"):
+            raise ConnectionResetError("Connection closed by proxy")
+        return response[:-1]
+
+    def exchange(self, commands):
+        """Send a list of commands and return the list of responses.
+
+        All the commands are sent before any of the responses are
+        read.  Responses have their trailing newline removed.
+        """
+        self.f.write("".join(f"{c}\n" for c in commands))
+        self.f.flush()
+        responses = [self.readline() for _ in commands]
+        self.last_used = time.monotonic()
+        return responses
+
+    def select(self, ident):
+        if self.selected == ident:
+            return
+        self.selected = None
+        response, = self.exchange([f"SELECT {ident}"])
+        if response != f"OK {ident} selected":
+            raise SelectError(f"Could not select {ident}: {response}")
+        self.selected = ident
+
+    def mread(self, ident, names):
+        """Read a list of registers using the proxy's MREAD command.
+
+        Returns the list of responses to READ, one per register.  The
+        controller should already be selected, so that a proxy that
+        doesn't know MREAD passes it on to the controller and we get
+        an error response rather than a timeout.
+        """
+        self.f.write(f"MREAD {ident} {' '.join(names)}\n")
+        self.f.flush()
+        self.sock.settimeout(
+            TIMEOUT + MREAD_TIMEOUT_PER_REGISTER * len(names))
+        try:
+            header = self.readline()
+        finally:
+            self.sock.settimeout(TIMEOUT)
+        if header.startswith("ERR "):
+            raise MreadUnsupported(header)
+        if header != f"OK MREAD {len(names)}":
+            self.selected = None
+            raise BusError(f"MREAD failed: {header}")
+        responses = []
+        for name in names:
+            response = self.readline()
+            if not response.startswith(f"{name} "):
+                raise ConnectionResetError(f"Bad MREAD response {response}")
+            responses.append(response[len(name) + 1:])
+        self.last_used = time.monotonic()
+        return responses
+
+
+class SessionPool:
+    """Idle sessions keyed by (address, port)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.reaper = None
+        # Proxies known not to support MREAD, by (address, port)
+        self.no_mread = set()
+        # Priority requested from the proxy for our commands, if any
+        self.priority = None
+        # Proxies known not to support PRIORITY, by (address, port)
+        self.no_priority = set()
+
+    def checkout(self, address, port):
+        key = (address, port)
+        with self.lock:
+            sessions = self.idle.get(key, [])
+            while sessions:
+                session = sessions.pop()
+                if not session.stale():
+                    session.reused = True
+                    return session
+                session.close()
+        return Session(address, port)
+
+    def checkin(self, session):
+        with self.lock:
+            self.idle.setdefault(session.key, []).append(session)
+            if not self.reaper:
+                self.reaper = threading.Timer(MAX_IDLE, self.reap)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+    def reap(self):
+        """Close sessions that have been idle for too long
+        """
+        with self.lock:
+            self.reaper = None
+            for sessions in self.idle.values():
+                for session in [s for s in sessions if s.stale()]:
+                    sessions.remove(session)
+                    session.close()
+            if any(self.idle.values()):
+                self.reaper = threading.Timer(MAX_IDLE, self.reap)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+    def close_all(self):
+        with self.lock:
+            for sessions in self.idle.values():
+                for session in sessions:
+                    session.close()
+            self.idle = {}
+
+    def run(self, address, port, ident, f):
+        """Select a controller and call f(session).
+
+        Returns the result of f.  Raises ConnectError if the proxy
+        can't be reached, ProxyTimeout if it doesn't respond in time,
+        and another BusError if the controller can't be selected or
+        the connection fails.  If a pooled session turns out to have
+        been closed by the proxy, we reconnect and try again.
+        """
+        while True:
+            session = self.checkout(address, port)
+            try:
+                self.set_priority(session)
+                session.select(ident)
+                result = f(session)
+            except BusError:
+                self.checkin(session)
+                raise
+            except socket.timeout as e:
+                # A late response may still arrive, so the session is
+                # no longer in step with the proxy
+                session.close()
+                raise ProxyTimeout("Timeout waiting for proxy") from e
+            except OSError as e:
+                session.close()
+                if session.reused:
+                    continue
+                raise BusError("Connection to proxy failed") from e
+            self.checkin(session)
+            return result
+
+    def set_priority(self, session):
+        if session.priority == self.priority:
+            return
+        if session.key in self.no_priority:
+            return
+        response, = session.exchange([f"PRIORITY {self.priority}"])
+        if response.startswith("OK "):
+            session.priority = self.priority
+        else:
+            self.no_priority.add(session.key)
+
+    def transaction(self, address, port, ident, commands):
+        """Select a controller and send it a list of commands.
+
+        Returns the list of responses.
+        """
+        return self.run(address, port, ident,
+                        lambda session: session.exchange(commands))
+
+    def read_many(self, address, port, ident, names):
+        """Select a controller and read a list of registers.
+
+        Returns the list of responses to READ, one per register.  Uses
+        a single MREAD command if the proxy supports it, and pipelined
+        READ commands otherwise.
+        """
+        key = (address, port)
+        if key not in self.no_mread:
+            try:
+                return self.run(address, port, ident,
+                                lambda session: session.mread(ident, names))
+            except MreadUnsupported:
+                self.no_mread.add(key)
+        return self.transaction(
+            address, port, ident, [f"READ {name}" for name in names])
+
+
+pool = SessionPool()
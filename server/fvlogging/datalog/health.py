@@ -0,0 +1,101 @@
+"""Remember which controllers have recently failed to respond.
+
+Each attempt to reach a controller that isn't there costs a socket
+timeout, and a page showing several of its registers would pay it
+several times over.  Once a controller's proxy can't be reached, or
+FAILURE_THRESHOLD transactions in a row have had no response (a proxy
+too busy to answer in time counts as no response), it is marked as
+down in Django's cache, so that the mark is shared by every
+process using the same cache backend, and nothing tries to reach it
+until COOL_DOWN seconds have passed.  Meanwhile pages show the values
+last recorded in the database, marked as stale with their age.
+
+While a controller is down a single background thread probes it every
+PROBE_INTERVAL seconds, renewing the mark each time the probe fails
+and removing it as soon as the controller answers.  cache.add() makes
+sure only one process probes each controller.  If that process goes
+away the marks simply expire, and the next request to need the
+controller tries it again.
+"""
+
+import threading
+import time
+
+from django.core.cache import cache
+
+from datalog.bus import pool, BusError
+
+# Seconds for which a controller that has failed to respond is left
+# alone
+COOL_DOWN = 60
+
+# Seconds between probes of a controller that is down
+PROBE_INTERVAL = 15
+
+# Transactions in a row without a response after which a controller is
+# marked down; a single dropped reply shouldn't take it offline
+FAILURE_THRESHOLD = 3
+
+
+def key(controller):
+    return f"{controller.address}:{controller.port}:{controller.ident}"
+
+
+def is_down(controller):
+    """Has the controller failed to respond within the cool-down?
+    """
+    return cache.get(f"datalog:down:{key(controller)}") is not None
+
+
+def failed(controller):
+    """Record a transaction with no response
+    """
+    k = key(controller)
+    cache.add(f"datalog:failures:{k}", 0, COOL_DOWN)
+    try:
+        failures = cache.incr(f"datalog:failures:{k}")
+    except ValueError:
+        # It expired in between
+        failures = 1
+    if failures >= FAILURE_THRESHOLD:
+        mark_down(controller)
+
+
+def succeeded(controller):
+    cache.delete(f"datalog:failures:{key(controller)}")
+
+
+def mark_down(controller):
+    """Record that the controller didn't respond, and start probing it
+    """
+    k = key(controller)
+    cache.set(f"datalog:down:{k}", time.time(), COOL_DOWN)
+    cache.delete(f"datalog:failures:{k}")
+    if cache.add(f"datalog:probe:{k}", True, COOL_DOWN):
+        # The thread only gets the fields it needs, so that it never
+        # touches the database
+        threading.Thread(
+            target=probe, daemon=True,
+            args=(k, controller.address, controller.port,
+                  controller.ident)).start()
+
+
+def probe(k, address, port, ident):
+    """Probe a controller until it responds
+    """
+    try:
+        while cache.get(f"datalog:down:{k}") is not None:
+            time.sleep(PROBE_INTERVAL)
+            try:
+                r = pool.transaction(address, port, ident, ["READ ident"])
+            except BusError:
+                r = None
+            if r and r[0].strip() == f"OK {ident}":
+                cache.delete(f"datalog:down:{k}")
+                return
+            # Still not there: renew the mark and our claim to be the
+            # one probing it
+            cache.set(f"datalog:down:{k}", time.time(), COOL_DOWN)
+            cache.set(f"datalog:probe:{k}", True, COOL_DOWN)
+    finally:
+        cache.delete(f"datalog:probe:{k}")
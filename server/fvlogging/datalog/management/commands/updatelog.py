@@ -2,14 +2,18 @@
 
 from django.core.management.base import BaseCommand
 from datalog.models import Controller
+from datalog.bus import pool
 import django.utils.timezone
 
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
+        # Let anyone using the web interface go first
+        pool.priority = "poll"
         now = django.utils.timezone.now()
         for c in Controller.objects.all():
             # Check all the non-config registers
+            pending = []
             for r in c.register_set.filter(config=False):
                 if r.future_time and r.future_time <= now:
                     r.set(r.future_value)
@@ -17,4 +21,5 @@ class Command(BaseCommand):
                     r.future_value = None
                     r.save()
                 else:
-                    r.value()
+                    pending.append(r)
+            c.refresh(pending, adaptive=True)
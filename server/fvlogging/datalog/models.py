@@ -1,17 +1,25 @@
 from django.db import models
 from django.urls import reverse
-import socket
 import datetime
 import django.utils.timezone
+from datalog.bus import pool, BusError, ConnectError
+from datalog import health
 now = django.utils.timezone.now
 
+# Background logging reads a register whose value has stopped changing
+# less often, but at least every this many times its max_interval
+STABLE_INTERVAL_FACTOR = 4
+
 
 class Controller(models.Model):
     """A controller that can be present on a RS485 bus.
 
     Has a number of registers (defined in a separate model).  Accessed
     by connecting to a TCP port, sending a SELECT ident command, and
-    using READ and SET commands.
+    using READ and SET commands.  Connections are pooled (see
+    datalog.bus) so the SELECT is only sent when necessary.  A
+    controller that fails to respond is left alone for a while (see
+    datalog.health).
     """
     ident = models.CharField(max_length=8)
     description = models.TextField()
@@ -19,59 +27,133 @@ class Controller(models.Model):
     port = models.IntegerField()
     active = models.BooleanField()
 
-    def connect(self):
-        """Connect to this controller.
+    def transaction(self, commands):
+        """Send a list of commands to this controller.
 
-        Returns a file-like connection to the RS485 bus, with this
-        controller selected, or None if there is a failure.
+        Uses a pooled session on the RS485 bus, selecting this
+        controller first if necessary.  Returns the list of responses,
+        or None if there is a failure or the controller has failed
+        recently.
         """
-        if not self.active:
+        return self.use_bus(lambda: pool.transaction(
+            self.address, self.port, self.ident, commands))
+
+    def use_bus(self, f):
+        """Call f() to use the bus, keeping track of the controller's health
+
+        Returns the result of f, or None if the controller has failed
+        recently or f raises BusError.  Only a proxy that can't be
+        reached marks the controller down at once; other failures,
+        such as a busy proxy not answering in time, count towards
+        health.FAILURE_THRESHOLD.
+        """
+        if not self.available:
             return None
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            s.connect((self.address, self.port))
-        except Exception:
-            return None
-        s.settimeout(1.5)
-        sf = s.makefile('rw')
-        s.close()
-        sf.write(f"SELECT {self.ident}\n")
-        sf.flush()
-        response = sf.readline()
-        if response != f"OK {self.ident} selected\n":
-            sf.close()
+            r = f()
+        except ConnectError:
+            health.mark_down(self)
             return None
-        return sf
+        except BusError:
+            r = None
+        self.record_health(r)
+        return r
+
+    def record_health(self, r):
+        """Keep track of whether the controller is responding
+
+        r is the list of responses to a transaction, or None if there
+        was no usable response.
+        """
+        if not r or all(x.strip() == "TIMEOUT" for x in r):
+            health.failed(self)
+        else:
+            health.succeeded(self)
+
+    @property
+    def down(self):
+        """Has the controller failed to respond recently?
+        """
+        return health.is_down(self)
+
+    @property
+    def available(self):
+        """Should we try to reach the controller?
+        """
+        return self.active and not self.down
 
     def read(self, register):
         """Read a register as a string.
         """
-        s = self.connect()
-        if not s:
+        r = self.transaction([f"READ {register}"])
+        if not r:
             return None  # Maybe raise exception instead?
-        try:
-            s.write("READ %s\n" % register)
-            s.flush()
-            response = s.readline().strip()
-            if response[0:3] != "OK ":
-                return None
-            return response[3:]
-        finally:
-            s.close()
+        response = r[0].strip()
+        if response[0:3] != "OK ":
+            return None
+        return response[3:]
 
     def write(self, register, value):
         """Write a string to a register.
         """
-        s = self.connect()
-        if not s:
+        r = self.transaction([f"SET {register} {value}"])
+        if not r:
             return None  # Exception?
-        try:
-            s.write("SET %s %s\n" % (register, value))
-            s.flush()
-            response = s.readline().strip()
-            return response
-        finally:
-            s.close()
+        return r[0].strip()
+
+    def read_many(self, names):
+        """Read several registers in a single bus transaction.
+
+        The SELECT (if needed) is followed by a single MREAD command
+        if the proxy supports it, or by all the READ commands without
+        waiting for each response if not.  Returns a tuple of two
+        dicts keyed by register name: values read as strings, and
+        error responses for registers that could not be read.
+        """
+        names = list(names)
+        if not names:
+            return {}, {}
+        r = self.use_bus(lambda: pool.read_many(
+            self.address, self.port, self.ident, names))
+        if not r:
+            return {}, {name: "No response" for name in names}
+        values = {}
+        errors = {}
+        for name, response in zip(names, r):
+            response = response.strip()
+            if response[0:3] == "OK ":
+                values[name] = response[3:]
+            else:
+                errors[name] = response
+        return values, errors
+
+    def refresh(self, registers=None, force_check=False, adaptive=False):
+        """Bring the recorded values of registers up to date.
+
+        Registers whose most recent datapoint is older than their
+        max_interval (or all of them, if force_check is set) are read
+        from the hardware in a single bus transaction.  Defaults to
+        all this controller's registers.  If adaptive is set, stable
+        registers are read less often; see Register.poll_due().
+        Returns a dict of error responses for registers that could not
+        be read.
+        """
+        if registers is None:
+            registers = self.register_set.all()
+        due = []
+        for register in registers:
+            dpl = register.recent()
+            if adaptive:
+                is_due = register.poll_due(dpl)
+            else:
+                is_due = register.due(dpl)
+            if force_check or is_due:
+                due.append((register, dpl))
+        values, errors = self.read_many(register.name for register, _ in due)
+        for register, dpl in due:
+            if values.get(register.name):
+                register.record(values[register.name], dpl)
+        return errors
 
     def regs(self):
         """Return register set as a dict for use in templates.
@@ -95,6 +177,9 @@ class Datum(models.Model):
         abstract = True
     register = models.ForeignKey("Register", on_delete=models.PROTECT)
     timestamp = models.DateTimeField()
+    # Set on a datapoint returned in place of a value that couldn't be
+    # read from the hardware
+    stale = False
 
     @staticmethod
     def cast(value):
@@ -185,38 +270,75 @@ class Register(models.Model):
     def __str__(self):
         return "%s %s" % (self.controller, self.name)
 
-    def value(self, force_check=False):
-        # Read most recent (up to) two datapoints.
+    def recent(self):
+        """Read most recent (up to) two datapoints.
+        """
         dt = DATATYPE_DICT[self.datatype]
-        dpl = dt.objects.filter(register=self).order_by('-timestamp')[:2]
-        # If there are zero datapoints, we always record a new one.
-        # Otherwise, we check to see how old the most recent datapoint
-        # is, and consider recording a new one if it is more than
-        # max_interval seconds old.
-        if len(dpl) == 0 or force_check or (
-                (now() - dpl[0].timestamp)
-                > datetime.timedelta(seconds=self.max_interval)):
+        return dt.objects.filter(register=self).order_by('-timestamp')[:2]
+
+    def due(self, dpl):
+        """Should we read this register from the hardware again?
+
+        If there are zero datapoints, we always record a new one.
+        Otherwise, we check to see how old the most recent datapoint
+        is, and consider recording a new one if it is more than
+        max_interval seconds old.
+        """
+        return len(dpl) == 0 or (
+            (now() - dpl[0].timestamp)
+            > datetime.timedelta(seconds=self.max_interval))
+
+    def poll_due(self, dpl):
+        """Should background logging read this register again?
+
+        Like due(), but once the value has been the same for a while
+        the interval grows to half as long as it has been stable, up
+        to STABLE_INTERVAL_FACTOR times max_interval.  A register
+        whose value is changing is read every max_interval.
+        """
+        if len(dpl) < 2 or dpl[0].data != dpl[1].data:
+            return self.due(dpl)
+        max_interval = datetime.timedelta(seconds=self.max_interval)
+        stable = dpl[0].timestamp - dpl[1].timestamp
+        interval = min(max(max_interval, stable / 2),
+                       max_interval * STABLE_INTERVAL_FACTOR)
+        return now() - dpl[0].timestamp > interval
+
+    def record(self, r, dpl):
+        """Record a string value read from the hardware.
+
+        dpl is the list of most recent datapoints from recent().
+        Returns the datapoint holding the value.
+        """
+        dt = DATATYPE_DICT[self.datatype]
+        val = dt.cast(r)
+        if len(dpl) > 0 and val == dpl[0].data and len(dpl) == 2 \
+           and dpl[0].data == dpl[1].data:
+            # No change, and we already have two datapoints in a
+            # row with this value.  We just update the timestamp
+            # on the most recent.
+            dpl[0].timestamp = now()
+            dpl[0].save()
+            return dpl[0]
+        # We record a new datapoint.
+        dp = dt(register=self, timestamp=now(), data=val)
+        dp.save()
+        return dp
+
+    def value(self, force_check=False):
+        dpl = self.recent()
+        if force_check or self.due(dpl):
             r = self.controller.read(self.name)
             if not r:
                 # Reading from the hardware failed.  We return the most
-                # recent value if there is one, or None.
+                # recent value if there is one, flagged as stale, or
+                # None.
                 if len(dpl) > 0:
+                    dpl[0].stale = True
                     return dpl[0]
                 else:
                     return None
-            val = dt.cast(r)
-            if len(dpl) > 0 and val == dpl[0].data and len(dpl) == 2 \
-               and dpl[0].data == dpl[1].data:
-                # No change, and we already have two datapoints in a
-                # row with this value.  We just update the timestamp
-                # on the most recent.
-                dpl[0].timestamp = now()
-                dpl[0].save()
-                dp = dpl[0]
-            else:
-                # We record a new datapoint.
-                dp = dt(register=self, timestamp=now(), data=val)
-                dp.save()
+            dp = self.record(r, dpl)
         else:
             # Return the most recent datapoint - it isn't time to check
             # the hardware yet
@@ -1,11 +1,27 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+Tests of the datalog's access to the bus, using simulated controllers
+(see server/fvsim.py) behind fvserial.py.
 
-Replace this with more appropriate tests for your application.
+Run with "PYTHONPATH=.. ./manage.py test", so that fvsim and fvbench
+can be imported.
 """
 
-from django.test import TestCase
+import datetime
+import socket
+import socketserver
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase, TestCase, override_settings
+
+import fvbench
+import fvsim
+from datalog import bus, health, models
+from datalog.bus import SessionPool, SelectError, ProxyTimeout
+from datalog.models import Controller, FloatDatum
 
 
 class SimpleTest(TestCase):
@@ -14,3 +30,359 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class SimulatedBusTestCase(SimpleTestCase):
+    """Runs fvserial.py on a simulated bus with controller FV1
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sim = fvsim.Bus(["FV1"], baud=0)
+        cls.port = fvbench.free_port()
+        cls.proxy = fvbench.start_fvserial(cls.sim.start(), cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy.terminate()
+        cls.proxy.wait()
+        cls.sim.stop()
+        super().tearDownClass()
+
+
+class SessionPoolTest(SimulatedBusTestCase):
+    def setUp(self):
+        self.pool = SessionPool()
+        self.addCleanup(self.pool.close_all)
+
+    def idle(self):
+        return self.pool.idle.get(("localhost", self.port), [])
+
+    def test_session_reused_without_select(self):
+        self.assertEqual(
+            self.pool.transaction("localhost", self.port, "FV1",
+                                  ["READ ident"]), ["OK FV1"])
+        session, = self.idle()
+        self.assertEqual(session.selected, "FV1")
+        before = self.sim.transactions
+        self.assertEqual(
+            self.pool.transaction("localhost", self.port, "FV1",
+                                  ["READ ver", "READ ident"]),
+            ["OK sim", "OK FV1"])
+        # Only the two READs reached the bus
+        self.assertEqual(self.sim.transactions, before + 2)
+        self.assertEqual(self.idle(), [session])
+        self.assertTrue(session.reused)
+
+    def test_idle_session_is_stale(self):
+        self.pool.transaction("localhost", self.port, "FV1", ["READ ident"])
+        session, = self.idle()
+        with mock.patch.object(bus, "MAX_IDLE", 0.0):
+            self.assertTrue(session.stale())
+            self.pool.transaction(
+                "localhost", self.port, "FV1", ["READ ident"])
+        replacement, = self.idle()
+        self.assertIsNot(replacement, session)
+        self.assertFalse(replacement.reused)
+
+    def test_session_closed_by_proxy_is_replaced(self):
+        self.pool.transaction("localhost", self.port, "FV1", ["READ ident"])
+        session, = self.idle()
+        # fvserial.py closes the connection once we stop sending
+        session.sock.shutdown(socket.SHUT_WR)
+        self.assertTrue(wait_for(session.stale))
+        self.assertEqual(
+            self.pool.transaction("localhost", self.port, "FV1",
+                                  ["READ ident"]), ["OK FV1"])
+        replacement, = self.idle()
+        self.assertIsNot(replacement, session)
+
+    def test_select_error(self):
+        with self.assertRaises(SelectError):
+            self.pool.transaction(
+                "localhost", self.port, "FV2", ["READ ident"])
+        # The session is still usable
+        session, = self.idle()
+        self.assertIsNone(session.selected)
+        self.assertEqual(
+            self.pool.transaction("localhost", self.port, "FV1",
+                                  ["READ ident"]), ["OK FV1"])
+        self.assertEqual(self.idle(), [session])
+
+    def test_read_many_uses_mread(self):
+        self.assertEqual(
+            self.pool.read_many("localhost", self.port, "FV1",
+                                ["ident", "ver", "nosuch"]),
+            ["OK FV1", "OK sim", "ERR register nosuch does not exist"])
+        self.assertEqual(self.pool.no_mread, set())
+
+    def test_priority(self):
+        self.pool.priority = "poll"
+        self.pool.transaction("localhost", self.port, "FV1", ["READ ident"])
+        session, = self.idle()
+        self.assertEqual(session.priority, "poll")
+        self.assertEqual(self.pool.no_priority, set())
+
+
+class OldProxyHandler(socketserver.StreamRequestHandler):
+    """A proxy that predates MREAD and PRIORITY
+
+    Every command is passed straight to the simulated controllers.
+    """
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode("ascii").strip()
+            self.server.commands.append(command)
+            reply = self.server.sim.command(command)
+            self.wfile.write(reply or b"TIMEOUT\n")
+
+
+class MreadFallbackTest(SimpleTestCase):
+    def setUp(self):
+        self.sim = fvsim.Bus(["FV1"], baud=0)
+        self.server = socketserver.ThreadingTCPServer(
+            ("localhost", 0), OldProxyHandler)
+        self.server.daemon_threads = True
+        self.server.sim = self.sim
+        self.server.commands = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.port = self.server.server_address[1]
+        self.pool = SessionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+        self.sim.stop()
+
+    def test_falls_back_to_read(self):
+        names = ["ident", "ver"]
+        self.assertEqual(
+            self.pool.read_many("localhost", self.port, "FV1", names),
+            ["OK FV1", "OK sim"])
+        self.assertEqual(self.pool.no_mread, {("localhost", self.port)})
+        self.assertEqual(
+            self.pool.read_many("localhost", self.port, "FV1", names),
+            ["OK FV1", "OK sim"])
+        # MREAD is only tried once, and the session is reused
+        self.assertEqual(self.server.commands, [
+            "SELECT FV1", "MREAD FV1 ident ver", "READ ident", "READ ver",
+            "READ ident", "READ ver"])
+
+    def test_priority_not_retried(self):
+        self.pool.priority = "poll"
+        for _ in range(2):
+            self.pool.transaction(
+                "localhost", self.port, "FV1", ["READ ident"])
+        self.assertEqual(self.server.commands, [
+            "PRIORITY poll", "SELECT FV1", "READ ident", "READ ident"])
+
+
+# Keep the controllers' health out of the site's cache
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RefreshTest(SimulatedBusTestCase, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.c = Controller.objects.create(
+            ident="FV1", description="FV1", address="localhost",
+            port=self.port, active=True)
+        for name, datatype in (("t0", "F"), ("bl", "I"), ("ver", "S")):
+            self.c.register_set.create(
+                name=name, description=name, datatype=datatype,
+                readonly=True, max_interval=60, config=False,
+                frontpage=False)
+
+    def values(self):
+        return {r.name: [dp.data for dp in r.recent()]
+                for r in self.c.register_set.all()}
+
+    def test_read_many(self):
+        self.assertEqual(
+            self.c.read_many(["ident", "ver", "nosuch"]),
+            ({"ident": "FV1", "ver": "sim"},
+             {"nosuch": "ERR register nosuch does not exist"}))
+
+    def test_refresh_reads_registers_that_are_due(self):
+        self.assertEqual(self.c.refresh(), {})
+        t0 = self.values()["t0"][0]
+        self.assertEqual(self.values(),
+                         {"t0": [t0], "bl": [1000], "ver": ["sim"]})
+        before = self.sim.transactions
+        self.c.refresh()
+        # Nothing was due
+        self.assertEqual(self.sim.transactions, before)
+        self.c.refresh(force_check=True)
+        self.assertEqual(self.sim.transactions, before + 3)
+        self.assertEqual(len(self.values()["ver"]), 2)
+
+    def test_refresh_reports_errors(self):
+        self.c.register_set.create(
+            name="nosuch", description="nosuch", datatype="S",
+            readonly=True, max_interval=60, config=False, frontpage=False)
+        self.assertEqual(self.c.refresh(),
+                         {"nosuch": "ERR register nosuch does not exist"})
+        self.assertEqual(self.values()["nosuch"], [])
+        self.assertEqual(self.values()["bl"], [1000])
+
+
+class PollDueTest(TestCase):
+    def setUp(self):
+        c = Controller.objects.create(
+            ident="FV1", description="FV1", address="localhost", port=0,
+            active=True)
+        self.r = c.register_set.create(
+            name="t0", description="t0", datatype="F", readonly=True,
+            max_interval=60, config=False, frontpage=False)
+
+    def record(self, *points):
+        """Record datapoints given as (seconds ago, value)
+        """
+        for ago, value in points:
+            FloatDatum.objects.create(
+                register=self.r, data=value,
+                timestamp=models.now() - datetime.timedelta(seconds=ago))
+        return self.r.recent()
+
+    def test_no_history(self):
+        self.assertTrue(self.r.poll_due(self.record()))
+        self.assertFalse(self.r.poll_due(self.record((30, 18.5))))
+
+    def test_changing_value_read_every_max_interval(self):
+        dpl = self.record((7200, 18.0), (100, 18.5))
+        self.assertTrue(self.r.poll_due(dpl))
+
+    def test_stable_value_read_less_often(self):
+        # Stable for about five minutes, so read every 160s
+        dpl = self.record((400, 18.5), (80, 18.5))
+        self.assertTrue(self.r.due(dpl))
+        self.assertFalse(self.r.poll_due(dpl))
+
+    def test_stable_value_read_eventually(self):
+        dpl = self.record((400, 18.5), (170, 18.5))
+        self.assertTrue(self.r.poll_due(dpl))
+
+    def test_stable_interval_limited(self):
+        # Stable for two hours, but read at least every 4 minutes
+        dpl = self.record((7300, 18.5), (230, 18.5))
+        self.assertFalse(self.r.poll_due(dpl))
+        FloatDatum.objects.all().delete()
+        dpl = self.record((7300, 18.5), (250, 18.5))
+        self.assertTrue(self.r.poll_due(dpl))
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class HealthTest(SimulatedBusTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def controller(self, ident):
+        return Controller(ident=ident, description=ident,
+                          address="localhost", port=self.port, active=True)
+
+    def test_marked_down_after_repeated_failures(self):
+        c = self.controller("FV1")
+        with mock.patch.object(health, "probe"):
+            for _ in range(health.FAILURE_THRESHOLD - 1):
+                health.failed(c)
+            health.succeeded(c)
+            for _ in range(health.FAILURE_THRESHOLD - 1):
+                health.failed(c)
+            self.assertFalse(c.down)
+            health.failed(c)
+            self.assertTrue(c.down)
+
+    def test_only_one_probe(self):
+        c = self.controller("FV1")
+        with mock.patch.object(health.threading, "Thread") as thread:
+            health.mark_down(c)
+            health.mark_down(c)
+        thread.assert_called_once()
+
+    def test_down_controller_not_contacted(self):
+        c = self.controller("FV1")
+        with mock.patch.object(health, "probe"):
+            health.mark_down(c)
+        before = self.sim.transactions
+        self.assertIsNone(c.read("ident"))
+        self.assertEqual(c.read_many(["ident"]),
+                         ({}, {"ident": "No response"}))
+        self.assertEqual(self.sim.transactions, before)
+
+    def test_busy_proxy_counts_as_failure(self):
+        c = self.controller("FV1")
+        with mock.patch.object(bus.pool, "transaction",
+                               side_effect=ProxyTimeout("busy")):
+            self.assertIsNone(c.read("ident"))
+        self.assertFalse(c.down)
+        self.assertEqual(cache.get(f"datalog:failures:{health.key(c)}"), 1)
+        # An answer clears the count
+        self.assertEqual(c.read("ident"), "FV1")
+        self.assertIsNone(cache.get(f"datalog:failures:{health.key(c)}"))
+
+    def test_unreachable_proxy_marks_down_at_once(self):
+        c = self.controller("FV1")
+        c.port = fvbench.free_port()
+        with mock.patch.object(health, "probe"):
+            self.assertIsNone(c.read("ident"))
+        self.assertTrue(c.down)
+
+    @mock.patch.object(health, "PROBE_INTERVAL", 0.05)
+    def test_probe_until_controller_answers(self):
+        c = self.controller("FV2")
+        health.mark_down(c)
+        k = health.key(c)
+        # Each probe fails after fvserial.py's SELECT timeout
+        time.sleep(1.5)
+        self.assertTrue(c.down)
+        self.assertTrue(cache.get(f"datalog:probe:{k}"))
+        self.sim.controllers.append(fvsim.Controller("FV2", self.sim.rng))
+        self.addCleanup(self.sim.controllers.pop)
+        self.assertTrue(wait_for(lambda: not c.down))
+        self.assertTrue(wait_for(
+            lambda: cache.get(f"datalog:probe:{k}") is None))
+        self.assertEqual(c.read("ident"), "FV2")
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class StaleValueTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        c = Controller.objects.create(
+            ident="FV1", description="FV1", address="localhost", port=0,
+            active=True)
+        self.r = c.register_set.create(
+            name="t0", description="t0", datatype="F", unit="C",
+            readonly=True, max_interval=60, config=False, frontpage=False)
+        FloatDatum.objects.create(
+            register=self.r, data=18.5,
+            timestamp=models.now() - datetime.timedelta(hours=1))
+        with mock.patch.object(health, "probe"):
+            health.mark_down(c)
+
+    def test_stale_value_shown_with_age(self):
+        dp = self.r.value()
+        self.assertTrue(dp.stale)
+        html = render_to_string("datalog/value.html", {"r": self.r})
+        self.assertIn("18.50C", html)
+        self.assertIn('class="stale"', html)
+        self.assertIn("1\xa0hour old", html)
+
+    def test_fresh_value_not_marked(self):
+        FloatDatum.objects.create(register=self.r, data=18.6,
+                                  timestamp=models.now())
+        html = render_to_string("datalog/value.html", {"r": self.r})
+        self.assertIn("18.60C", html)
+        self.assertNotIn("stale", html)
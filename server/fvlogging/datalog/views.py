@@ -3,6 +3,7 @@ from django.http import HttpResponseRedirect
 from django.http import Http404
 from django.shortcuts import render
 from django import forms
+from django.db.models import Q
 from django.urls import reverse
 from datalog.models import Controller, Register, DATATYPE_DICT
 import datetime
@@ -10,11 +11,20 @@ import csv
 import xml.etree.ElementTree as ET
 
 
+# Registers shown for every controller on the summary page
+SUMMARY_REGISTERS = ("t0", "mode", "set/lo", "set/hi", "v0", "alarm")
+
+
 def summary(request):
     controllers = Controller.objects.all()
     registers = Register.objects.filter(frontpage=True)\
                                 .order_by("description")\
                                 .all()
+    # Bring each controller's registers on the page up to date with a
+    # single bus transaction
+    for c in controllers:
+        c.refresh(c.register_set.filter(
+            Q(name__in=SUMMARY_REGISTERS) | Q(frontpage=True)))
     return render(request, 'datalog/summary.html',
                   context={'controllers': controllers,
                            'registers': registers})
@@ -56,6 +66,10 @@ def detail(request, name, config=False):
     else:
         fcform = FutureChangeForm()
 
+    # Fetch everything that is out of date in one go, rather than
+    # letting the template read registers from the hardware one by one
+    controller.refresh(registers)
+
     return render(
         request, 'datalog/detail.html', context={
             'controller': controller,
@@ -0,0 +1,165 @@
+"""Counters and histograms in the Prometheus text format
+
+This is a copy of hass-bridge/hass_bridge/metrics.py, so that
+fvserial.py can be run on its own; keep the two in step.
+
+Updating a metric is a dictionary lookup and an addition, so they can
+be kept on every bus transaction.  Nothing is formatted until someone
+asks for the metrics; values that are already kept elsewhere, such as
+queue depths, are sampled only then.
+"""
+import bisect
+import collections
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')\
+        .replace("\n", "\\n")
+
+
+def series(name, labels, values, extra=""):
+    """Format the name and labels of one time series
+    """
+    pairs = [f'{k}="{escape(v)}"' for k, v in zip(labels, values)]
+    if extra:
+        pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # Label values -> count
+        self.values = collections.Counter()
+
+    def inc(self, *values, amount=1):
+        self.values[values] += amount
+
+    def lines(self):
+        return self.header() + [
+            f"{series(self.name, self.labels, values)} {count}"
+            for values, count in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Label values -> [count per bucket, sum]; the last bucket is
+        # for values above the largest bound
+        self.values = {}
+
+    def observe(self, value, *values):
+        entry = self.values.get(values)
+        if entry is None:
+            entry = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def lines(self):
+        lines = self.header()
+        for values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(
+                    f"{series(self.name + '_bucket', self.labels, values, le)}"
+                    f" {cumulative}")
+            lines.append(
+                f"{series(self.name + '_sum', self.labels, values)} {total}")
+            lines.append(
+                f"{series(self.name + '_count', self.labels, values)} "
+                f"{cumulative}")
+        return lines
+
+
+class Sampled(Metric):
+    """A metric whose values are kept elsewhere, and read when asked for
+
+    sample is called with no arguments and returns an iterable of
+    (label values, value) pairs.
+    """
+    def __init__(self, name, help, labels, sample, kind="gauge"):
+        super().__init__(name, help, labels)
+        self.sample = sample
+        self.kind = kind
+
+    def lines(self):
+        return self.header() + [
+            f"{series(self.name, self.labels, values)} {value}"
+            for values, value in self.sample()]
+
+
+class Registry:
+    """All the metrics of one process
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.add(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.add(Histogram(*args, **kwargs))
+
+    def sampled(self, *args, **kwargs):
+        return self.add(Sampled(*args, **kwargs))
+
+    def exposition(self):
+        """Return the metrics in the Prometheus text format, as bytes
+        """
+        return "".join(
+            f"{line}\n" for metric in self.metrics
+            for line in metric.lines()).encode("utf-8")
+
+
+class QueueStats:
+    """Queue depth and waiting times for one priority
+    """
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def queued(self):
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def started(self, wait):
+        self.depth -= 1
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def __str__(self):
+        mean = self.total_wait / self.count if self.count else 0.0
+        return (f"depth={self.depth} max_depth={self.max_depth} "
+                f"count={self.count} mean_wait={mean:.3f} "
+                f"max_wait={self.max_wait:.3f}")
@@ -1,18 +1,92 @@
 #!/usr/bin/env python3
 
 # This script presents the fvcontroller RS485 interface as a
-# socket-based service.  Only one connection is dealt with at once;
-# others are queued.
+# socket-based service.  Any number of clients may be connected at
+# once; their commands are interleaved on the serial line one
+# transaction (command and response) at a time.
 
-# The script ensures that no controller is selected between
-# connections, and that controllers are in a known state (empty rxbuf,
-# nobody transmitting) waiting for commands.  It provides an explicit
-# TIMEOUT response if a controller does not respond, and deals with
-# returning the RS485 network to the default state if a timeout
-# occurs.
+# Each client sees its own session: the proxy remembers which
+# controller each client has selected, and if another client has
+# selected a different controller in the meantime it re-issues the
+# SELECT before running the client's command.  A client that has not
+# selected a controller (or whose last SELECT failed) gets a TIMEOUT
+# response without the bus being used, because no controller would
+# answer.
 
+# Clients need not wait for each response before sending the next
+# command.  Commands are queued per client and run back-to-back, and
+# the responses are returned in the order the commands were sent.  At
+# most MAX_PIPELINE commands are queued for each client; once that
+# many are waiting the proxy stops reading from the client until some
+# have been dealt with, so the client's writes will eventually block.
+
+# As well as the commands understood by the controllers, the proxy
+# accepts "MREAD ident reg1 reg2 ...".  This selects the controller
+# (if this client doesn't already have it selected) and reads each
+# register in turn.  If the controller can't be selected the response
+# to the SELECT is returned on its own, and the client is left with
+# no controller selected.  Otherwise the response is a line "OK MREAD
+# n" followed by n lines, one per register in the order requested,
+# each consisting of the register name, a space, and the response to
+# READ for that register (e.g. "OK 18.50", "ERR ...", "TIMEOUT" or
+# "CORRUPT").  The controller stays selected afterwards.
+
+# Responses to READ may optionally be cached, with a maximum age set
+# per register on the command line.  Cached responses are returned
+# without using the bus.  Once a SET to a register has been run, any
+# cached response for that register on the selected controller is
+# removed, and responses to READs started before the SET are not
+# cached, since they may have been read before it.  A client
+# can bypass the cache for a single READ or MREAD by prefixing the
+# command with "!", e.g. "!READ t0"; the fresh response is still
+# stored in the cache for other clients.
+
+# Waiting commands are run in order of priority rather than strictly
+# in turn.  A SET always has the highest priority, so that a change
+# made by a user reaches the controller within one transaction however
+# many READs are waiting.  Other commands run at the client's
+# priority, which is "read" unless the client sends "PRIORITY poll"
+# (or "PRIORITY read" to change it back); background loggers should do
+# this so that their READs give way to interactive ones.  The response
+# is "OK priority <name>".  "STATS" returns "OK STATS n" followed by n
+# lines, one per priority, giving the number of commands waiting, the
+# most that have been waiting at once, and how long commands have
+# waited for the bus.
+
+# With --metrics-port, counters and histograms of bus transactions
+# (per controller, command and result), \0 noise, SELECTs needed and
+# avoided, cache hits, queue depths and latency are served over HTTP
+# at /metrics in the Prometheus text format.  They are only formatted
+# when asked for.
+
+# The script ensures that controllers are in a known state (empty
+# rxbuf, nobody transmitting) waiting for commands.  It provides an
+# explicit TIMEOUT response if a controller does not respond, and
+# deals with returning the RS485 network to the default state if a
+# timeout occurs.
+
+import argparse
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import time
 import serial
-import socketserver
+
+from fvmetrics import QueueStats, Registry
+
+# Maximum number of commands queued per client
+MAX_PIPELINE = 64
+
+# Command priorities, most urgent first
+PRIORITY_SET = 0
+PRIORITY_READ = 1
+PRIORITY_POLL = 2
+PRIORITY_NAMES = [b"set", b"read", b"poll"]
+
+# Commands counted by name in the metrics; anything else is "other"
+COMMANDS = {"SELECT", "READ", "SET", "HELP", "SCANBUS"}
+
 
 def full_reset(s):
     """Return the bus to a known state
@@ -33,32 +107,421 @@ def full_reset(s):
         foo = s.read()
     s.timeout = old_timeout
 
-class ConnectionHandler(socketserver.StreamRequestHandler):
-    def handle(self):
-        for data in self.rfile:
-            data = data.strip()
-            s.write(data + b"\n")
-            response = s.read_until()
-            # A floating line produces \0 characters.  Remove them.
+
+def communicate(s, command):
+    """Send a command and wait for the response
+
+    This blocks for up to the serial port timeout, so it is run in the
+    bus thread rather than in the event loop.
+    """
+    s.write(command + b"\n")
+    return s.read_until()
+
+
+def classify(response):
+    """Summarise a response for the metrics
+    """
+    if response.startswith(b"OK "):
+        return "ok"
+    if response in (b"TIMEOUT\n", b"CORRUPT\n"):
+        return response[:-1].decode("ascii").lower()
+    return "error"
+
+
+class Cache:
+    """Responses to READ, kept for a per-register maximum age
+    """
+    def __init__(self, max_ages, default_max_age=0.0):
+        self.max_ages = max_ages
+        self.default_max_age = default_max_age
+        # (ident, register) -> (time, response)
+        self.responses = {}
+        # (ident, register) -> time the most recent SET was started
+        self.set_times = {}
+
+    def max_age(self, register):
+        return self.max_ages.get(register, self.default_max_age)
+
+    def get(self, ident, register):
+        entry = self.responses.get((ident, register))
+        if entry is None:
+            return None
+        t, response = entry
+        if time.monotonic() - t > self.max_age(register):
+            del self.responses[(ident, register)]
+            return None
+        return response
+
+    def put(self, ident, register, response, started):
+        """Store a response to a READ that was started at a given time
+
+        If a SET to the register has been started since, the response
+        may be from before the SET, so it isn't kept.
+        """
+        if started <= self.set_times.get((ident, register), 0.0):
+            return
+        if self.max_age(register) > 0 and response.startswith(b"OK "):
+            self.responses[(ident, register)] = (time.monotonic(), response)
+
+    def setting(self, ident, register):
+        """Note that a SET to a register is starting
+        """
+        self.set_times[(ident, register)] = time.monotonic()
+
+    def invalidate(self, ident, register):
+        """Forget the response for a register, once a SET has finished
+        """
+        self.responses.pop((ident, register), None)
+
+
+class PriorityLock:
+    """A lock granted to waiters in order of priority, then arrival
+    """
+    def __init__(self):
+        self.locked = False
+        # Heap of (priority, sequence number, future)
+        self.waiters = []
+        self.counter = itertools.count()
+        self.stats = [QueueStats() for _ in PRIORITY_NAMES]
+
+    async def acquire(self, priority):
+        stats = self.stats[priority]
+        stats.queued()
+        start = time.monotonic()
+        if self.locked:
+            future = asyncio.get_running_loop().create_future()
+            entry = (priority, next(self.counter), future)
+            heapq.heappush(self.waiters, entry)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The lock was handed to us as we were cancelled
+                    self.release()
+                elif entry in self.waiters:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+                stats.depth -= 1
+                raise
+        # A waiter is handed the lock by release(), so it is already
+        # marked as locked
+        self.locked = True
+        stats.started(time.monotonic() - start)
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.locked = False
+
+
+class Bus:
+    """The serial line, shared between all clients
+    """
+    def __init__(self, s, cache=None):
+        self.s = s
+        self.cache = cache or Cache({})
+        # The ident of the controller currently selected on the bus
+        self.selected = None
+        self.lock = PriorityLock()
+        self.thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Only ever updated from the event loop, so that they are
+        # never formatted while being changed
+        self.registry = Registry()
+        self.transactions = self.registry.counter(
+            "fvserial_transactions_total",
+            "Commands run on the bus by controller, command and result",
+            ("controller", "command", "result"))
+        self.noise = self.registry.counter(
+            "fvserial_noisy_responses_total",
+            "Responses with NUL characters from a floating line in them")
+        self.selects = self.registry.counter(
+            "fvserial_selects_total",
+            "Commands whose controller was already selected (hit) or "
+            "had to be selected first (miss)", ("result",))
+        self.cache_lookups = self.registry.counter(
+            "fvserial_cache_lookups_total",
+            "READs answered from the cache (hit) or not (miss)",
+            ("result",))
+        self.latency = self.registry.histogram(
+            "fvserial_transaction_seconds",
+            "Time commands held the bus, including any SELECT",
+            ("command",))
+        self.wait = self.registry.histogram(
+            "fvserial_queue_wait_seconds",
+            "Time commands waited for the bus", ("priority",))
+        self.registry.sampled(
+            "fvserial_queue_depth", "Commands waiting for the bus",
+            ("priority",), lambda: (
+                ((name.decode(),), stats.depth)
+                for name, stats in zip(PRIORITY_NAMES, self.lock.stats)))
+
+    async def communicate(self, command):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self.thread, communicate, self.s, command)
+        # A floating line produces \0 characters.  Remove them.
+        if b'\0' in response:
+            self.noise.inc()
             response = response.replace(b'\0', b'')
-            if response == b"":
-                response = b"TIMEOUT\n"
-            elif response[-1] != ord("\n"):
-                response = b"CORRUPT\n"
+        if response == b"":
+            response = b"TIMEOUT\n"
+        elif response[-1] != ord("\n"):
+            response = b"CORRUPT\n"
+        if response in (b"TIMEOUT\n", b"CORRUPT\n"):
+            # We can't be sure which controller (if any) is selected
+            # now, so make the next transaction select one explicitly
+            self.selected = None
+        return response
+
+    async def select(self, ident):
+        response = await self.communicate(b"SELECT " + ident)
+        if response == b"OK " + ident + b" selected\n":
+            self.selected = ident
+        else:
+            self.selected = None
+        return response
+
+    def stats(self):
+        lines = [b"OK STATS %d\n" % len(PRIORITY_NAMES)] + [
+            name + b" " + str(stats).encode("ascii") + b"\n"
+            for name, stats in zip(PRIORITY_NAMES, self.lock.stats)]
+        return b"".join(lines)
+
+    async def transaction(self, client, command, cached=True):
+        """Run a client's command on the bus and return the response
+
+        If cached is set, a READ may be answered from the cache.
+        """
+        ident = client.selected
+        if command.startswith(b"READ ") and ident is not None:
+            register = command[5:]
+            response = self.cache.get(ident, register) if cached else None
+            if cached and self.cache.max_age(register) > 0:
+                self.cache_lookups.inc("miss" if response is None else "hit")
+            if response is None:
+                started = time.monotonic()
+                response = await self._transaction(client, command)
+                self.cache.put(ident, register, response, started)
+            return response
+        if command.startswith(b"SET ") and ident is not None:
+            register = command[4:].split(b" ")[0]
+            self.cache.setting(ident, register)
             try:
-                self.wfile.write(response)
-            except:
-                break
+                return await self._transaction(client, command)
+            finally:
+                # Whatever was cached is from before the SET
+                self.cache.invalidate(ident, register)
+        return await self._transaction(client, command)
 
-class ReuseTCPServer(socketserver.TCPServer):
-    allow_reuse_address = True
+    async def _transaction(self, client, command):
+        if command.startswith(b"SET "):
+            priority = PRIORITY_SET
+        else:
+            priority = client.priority
+        start = time.monotonic()
+        await self.lock.acquire(priority)
+        started = time.monotonic()
+        self.wait.observe(started - start, PRIORITY_NAMES[priority].decode())
+        name, _, arg = command.partition(b" ")
+        name = name.decode("ascii", errors="replace")
+        if name not in COMMANDS:
+            name = "other"
+        if name == "SELECT":
+            ident = arg
+        else:
+            ident = client.selected
+        response = None
+        try:
+            response = await self._run(client, command)
+            return response
+        finally:
+            self.lock.release()
+            # Commands without a controller to send them to don't use
+            # the bus
+            if response is not None and ident is not None:
+                self.transactions.inc(
+                    ident.decode("ascii", errors="replace"),
+                    name, classify(response))
+                self.latency.observe(time.monotonic() - started, name)
 
-if __name__=="__main__":
-    HOST, PORT = "localhost", 1576
+    async def _run(self, client, command):
+        if command.startswith(b"SELECT "):
+            response = await self.select(command[7:])
+            client.selected = self.selected
+            return response
+        if client.selected is None:
+            return b"TIMEOUT\n"
+        if self.selected != client.selected:
+            self.selects.inc("miss")
+            response = await self.select(client.selected)
+            if self.selected is None:
+                return response
+        else:
+            self.selects.inc("hit")
+        return await self.communicate(command)
+
+
+class Client:
+    """A connection from a client
+    """
+    def __init__(self, bus, reader, writer):
+        self.bus = bus
+        self.reader = reader
+        self.writer = writer
+        # The ident of the controller this client has selected
+        self.selected = None
+        self.priority = PRIORITY_READ
+
+    async def run(self):
+        queue = asyncio.Queue(maxsize=MAX_PIPELINE)
+        reader = asyncio.create_task(self.read_commands(queue))
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    break
+                cached = not data.startswith(b"!")
+                if not cached:
+                    data = data[1:]
+                if data.startswith(b"MREAD "):
+                    response = await self.mread(data[6:].split(), cached)
+                elif data.startswith(b"PRIORITY "):
+                    response = self.set_priority(data[9:])
+                elif data == b"STATS":
+                    response = self.bus.stats()
+                else:
+                    response = await self.bus.transaction(self, data, cached)
+                self.writer.write(response)
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            reader.cancel()
+            self.writer.close()
 
-    server = ReuseTCPServer((HOST, PORT), ConnectionHandler)
+    def set_priority(self, name):
+        if name not in (b"read", b"poll"):
+            return b"ERR PRIORITY must be read or poll\n"
+        self.priority = PRIORITY_NAMES.index(name)
+        return b"OK priority " + name + b"\n"
+
+    async def mread(self, args, cached=True):
+        """Select a controller and read a list of registers
+
+        Each READ is a separate bus transaction, so other clients'
+        commands may be interleaved with them.
+        """
+        if not args:
+            return b"ERR MREAD needs an ident\n"
+        ident, *names = args
+        if self.selected != ident:
+            response = await self.bus.transaction(self, b"SELECT " + ident)
+            if self.selected is None:
+                return response
+        lines = [b"OK MREAD %d\n" % len(names)]
+        for name in names:
+            response = await self.bus.transaction(
+                self, b"READ " + name, cached)
+            lines.append(name + b" " + response)
+        return b"".join(lines)
+
+    async def read_commands(self, queue):
+        """Queue commands from the client until it closes the connection
+
+        Commands already queued are still run and their responses
+        sent, in case the client has only shut down its sending side.
+        """
+        try:
+            while True:
+                data = await self.reader.readline()
+                if not data:
+                    break
+                await queue.put(data.strip())
+        except (ConnectionError, ValueError):
+            # ValueError is raised for overlong lines
+            pass
+        await queue.put(None)
+
+
+async def serve_metrics(bus, reader, writer):
+    """Answer an HTTP request for the metrics, e.g. from Prometheus
+    """
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError):
+        writer.close()
+        return
+    if request.split(b"\r\n", 1)[0].split()[:2] == [b"GET", b"/metrics"]:
+        status = b"200 OK"
+        content_type = b"text/plain; version=0.0.4; charset=utf-8"
+        body = bus.registry.exposition()
+    else:
+        status = b"404 Not Found"
+        content_type = b"text/plain"
+        body = b"Try /metrics\n"
+    writer.write(
+        b"HTTP/1.0 " + status + b"\r\n"
+        b"Content-Type: " + content_type + b"\r\n"
+        b"Content-Length: %d\r\n" % len(body) +
+        b"Connection: close\r\n\r\n" + body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+async def serve(s, host, port, cache=None, metrics_port=None):
+    bus = Bus(s, cache)
+    server = await asyncio.start_server(
+        lambda reader, writer: Client(bus, reader, writer).run(),
+        host, port, reuse_address=True)
+    if metrics_port:
+        # Only on the loopback interface, like the default for clients
+        await asyncio.start_server(
+            lambda reader, writer: serve_metrics(bus, reader, writer),
+            "localhost", metrics_port, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+def max_age(arg):
+    """Parse a register=seconds argument
+    """
+    register, sep, seconds = arg.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected register=seconds")
+    return register.encode("ascii"), float(seconds)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the fvcontroller RS485 bus over TCP")
+    parser.add_argument(
+        '--serial', default="/dev/ttyUSB0", help="Path to serial port")
+    parser.add_argument(
+        '--host', default="localhost", help="Address to listen on")
+    parser.add_argument(
+        '--port', type=int, default=1576, help="Port to listen on")
+    parser.add_argument(
+        '--cache', type=max_age, action="append", default=[],
+        metavar="REGISTER=SECONDS",
+        help="Cache READ responses for this register; may be repeated")
+    parser.add_argument(
+        '--cache-default', type=float, default=0.0, metavar="SECONDS",
+        help="Cache READ responses for all other registers")
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help="Serve Prometheus metrics on this port on localhost")
+    args = parser.parse_args()
 
-    s = serial.Serial("/dev/ttyUSB0", timeout=1.0)
+    s = serial.Serial(args.serial, timeout=1.0)
     full_reset(s)
 
-    server.serve_forever()
+    asyncio.run(serve(s, args.host, args.port,
+                      Cache(dict(args.cache), args.cache_default),
+                      args.metrics_port))
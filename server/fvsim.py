@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+# This script simulates a number of fvcontroller units sharing an
+# RS485 bus, so that the software that talks to them (fvserial.py,
+# the hass-bridge, the datalog) can be tested and benchmarked without
+# real hardware.  The simulated bus is presented as a pseudo-terminal
+# whose path is printed on startup; open it with serial.Serial() just
+# as you would /dev/ttyUSB0.
+
+# The simulated controllers implement the protocol in
+# firmware/command.c: SELECT, READ, SET, HELP and SCANBUS, with the
+# same replies as the firmware.  A controller only replies to SELECT
+# for its own ident, and only replies to other commands while it is
+# selected; a SELECT for any other ident silently deselects it.
+
+# The bus can be made to misbehave in the ways real ones do: bytes
+# take 10 bit-times each to send, controllers take a while to start
+# replying, and replies can be dropped entirely, cut off part way
+# through a line, or have \0 characters from a floating line mixed in.
+
+import argparse
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+DEFAULT_BAUD = 9600
+
+VERSION = "sim"
+
+
+def write_string(length):
+    def write(value):
+        return value[:length]
+    return write
+
+
+def write_uint(maximum):
+    def write(value):
+        try:
+            v = int(value)
+        except ValueError:
+            return None
+        if v < 0 or v > maximum:
+            return None
+        return str(v)
+    return write
+
+
+def write_temperature(value):
+    try:
+        t = int(float(value) * 10000.0)
+    except ValueError:
+        return None
+    return f"{t / 10000.0:f}"
+
+
+def write_probe_address(value):
+    if len(value) < 16:
+        return None
+    try:
+        int(value[:16], 16)
+    except ValueError:
+        return None
+    return value[:16].upper()
+
+
+# Register name, description, initial value, and a function that
+# returns the stored form of a new value or None if the value can't
+# be written.  Registers without a write function are read-only.
+REGISTERS = [
+    ("ident", "Station ident", None, write_string(8)),
+    ("flashcnt", "Reprogram count", "3", None),
+    ("ver", "Firmware version", VERSION, None),
+    ("bl", "Backlight time", "1000", write_uint(65535)),
+    ("bl/alarm", "Alarm flash time", "50", write_uint(255)),
+    ("alarm", "Current alarm", "None", None),
+    ("fpsetup", "Setup enable", "1", write_uint(255)),
+    ("jog/flip", "Valve jog time", "100", write_uint(65535)),
+    ("jog/wait", "Jog try interval", "6000", write_uint(65535)),
+]
+for _probe in ("t0", "t1", "t2", "t3"):
+    REGISTERS += [
+        (_probe, f"{_probe} probe reading", "None", None),
+        (f"{_probe}/id", f"{_probe} probe address",
+         "0000000000000000", write_probe_address),
+        (f"{_probe}/c0", f"{_probe} cal point 0", "0", write_uint(65535)),
+        (f"{_probe}/c0r", f"{_probe} reading at c0", "0", write_uint(65535)),
+    ]
+REGISTERS += [
+    ("v0", "Valve state", "Closed", None),
+    ("vtype", "Valve type", "0", write_uint(255)),
+    ("set/hi", "Upper set point", "18.500000", write_temperature),
+    ("set/lo", "Lower set point", "18.000000", write_temperature),
+    ("mode", "Mode name", "Ferment", write_string(8)),
+    ("alarm/hi", "High temp alarm", "25.000000", write_temperature),
+    ("alarm/lo", "Low temp alarm", "5.000000", write_temperature),
+    ("jog/hi", "Valve stuck off", "20.000000", write_temperature),
+    ("jog/lo", "Valve stuck on", "16.000000", write_temperature),
+]
+for _m in range(6):
+    REGISTERS += [
+        (f"m{_m}/name", f"Mode m{_m} name", f"Mode{_m}", write_string(8)),
+        (f"m{_m}/lo", f"Mode m{_m} low set", "18", write_string(4)),
+        (f"m{_m}/hi", f"Mode m{_m} hi set", "18.5", write_string(4)),
+        (f"m{_m}/a/lo", f"Mode m{_m}alarm lo", "5", write_string(4)),
+        (f"m{_m}/a/hi", f"Mode m{_m}alarm hi", "25", write_string(4)),
+        (f"m{_m}/j/lo", f"Mode m{_m}jog lo", "16", write_string(4)),
+        (f"m{_m}/j/hi", f"Mode m{_m} jog hi", "20", write_string(4)),
+    ]
+REGISTERS += [
+    ("err/miss", "owb missing", "0", "errcount"),
+    ("err/shrt", "owb shorted", "0", "errcount"),
+    ("err/crc", "DS18B20 bad CRC", "0", "errcount"),
+    ("err/pwr", "DS18B20 no power", "0", "errcount"),
+]
+
+REGISTER_TABLE = {name: (desc, initial, write)
+                  for name, desc, initial, write in REGISTERS}
+
+
+class Controller:
+    """A simulated fvcontroller
+    """
+    def __init__(self, ident, rng):
+        self.ident = ident
+        self.selected = False
+        self.rng = rng
+        self.values = {name: initial for name, _, initial, _ in REGISTERS}
+        self.values["ident"] = ident
+        self.values["t0/id"] = f"28{rng.getrandbits(48):012X}00"
+        self.phase = rng.random() * 2 * math.pi
+
+    def update(self):
+        """Move the fermenter temperature and valve along
+        """
+        lo = float(self.values["set/lo"])
+        hi = float(self.values["set/hi"])
+        t = (lo + hi) / 2 + (hi - lo) * math.sin(
+            time.time() / 600 + self.phase) + self.rng.gauss(0, 0.02)
+        self.values["t0"] = f"{t:f}"
+        if t > hi:
+            self.values["v0"] = "Open"
+        elif t < lo:
+            self.values["v0"] = "Closed"
+
+    def command(self, line):
+        """Process a command line; return the reply, or None
+        """
+        if line.startswith("SELECT "):
+            self.selected = line[7:] == self.ident
+            if self.selected:
+                return f"OK {self.ident} selected\n"
+            return None
+        if not self.selected:
+            return None
+        if line.startswith("READ "):
+            return self.read(line[5:])
+        if line.startswith("SET "):
+            return self.set(line[4:])
+        if line.startswith("HELP "):
+            return self.help(line[5:])
+        if line.startswith("SCANBUS"):
+            return f"OK 1 sensors found {self.values['t0/id']}\n"
+        return ("ERR Unknown command; try SELECT, READ, SET, "
+                "HELP reg, SCANBUS\n")
+
+    def read(self, name):
+        if name not in REGISTER_TABLE:
+            return f"ERR register {name} does not exist\n"
+        self.update()
+        return f"OK {self.values[name]}\n"
+
+    def set(self, arg):
+        if " " not in arg:
+            return "ERR SET needs argument after space\n"
+        name, value = arg.split(" ", maxsplit=1)
+        if name not in REGISTER_TABLE:
+            return f"ERR register {name} does not exist\n"
+        write = REGISTER_TABLE[name][2]
+        if write == "errcount":
+            # Writing to an error counter decreases it
+            try:
+                dec = int(value)
+            except ValueError:
+                dec = -1
+            current = int(self.values[name])
+            stored = str(current - dec) if 0 <= dec <= current else None
+        else:
+            stored = write(value) if write else None
+        if stored is None:
+            return "ERR write failed\n"
+        self.values[name] = stored
+        return f"OK {name} set to {stored}\n"
+
+    def help(self, name):
+        if name not in REGISTER_TABLE:
+            return "ERR Available registers: " + "".join(
+                f"{n} " for n, _, _, _ in REGISTERS) + "\n"
+        return f"OK {REGISTER_TABLE[name][0]}\n"
+
+
+class Bus:
+    """A set of simulated controllers behind a pseudo-terminal
+
+    baud: line speed; each byte takes 10 bit-times to send
+    latency: seconds before a controller starts to reply
+    drop: probability that a reply is never sent
+    partial: probability that a reply stops part way through the line
+    noise: probability that a reply has \\0 characters mixed into it
+    """
+    def __init__(self, idents, baud=DEFAULT_BAUD, latency=0.002,
+                 drop=0.0, partial=0.0, noise=0.0, seed=None):
+        self.rng = random.Random(seed)
+        self.controllers = [Controller(ident, self.rng) for ident in idents]
+        self.byte_time = 10.0 / baud if baud else 0.0
+        self.latency = latency
+        self.drop = drop
+        self.partial = partial
+        self.noise = noise
+        self.transactions = 0
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.stopping = False
+        self.thread = None
+
+    def command(self, line):
+        """Pass a command line to every controller; return any reply
+        """
+        replies = [c.command(line) for c in self.controllers]
+        replies = [r for r in replies if r]
+        if not replies:
+            return None
+        self.transactions += 1
+        reply = replies[0].encode("ascii")
+        if self.rng.random() < self.drop:
+            return None
+        if self.rng.random() < self.partial:
+            reply = reply[:self.rng.randrange(len(reply) - 1)]
+        if self.rng.random() < self.noise:
+            for _ in range(self.rng.randint(1, 4)):
+                i = self.rng.randrange(len(reply) + 1)
+                reply = reply[:i] + b"\0" + reply[i:]
+        return reply
+
+    def transmit(self, reply, start):
+        """Send a reply no faster than the line speed allows
+        """
+        for i in range(0, len(reply), 8):
+            delay = start + (i + 8) * self.byte_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            os.write(self.master, reply[i:i + 8])
+
+    def run(self):
+        buf = b""
+        received = None
+        while not self.stopping:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            data = os.read(self.master, 1024)
+            if not buf:
+                received = time.monotonic()
+            buf += data
+            while True:
+                ends = [i for i in (buf.find(b"\n"), buf.find(b"\r"))
+                        if i >= 0]
+                if not ends:
+                    break
+                end = min(ends)
+                line = buf[:end].decode("ascii", errors="replace")
+                buf = buf[end + 1:]
+                # The command can't be dealt with until the last byte
+                # of it has arrived
+                received += (end + 1) * self.byte_time
+                reply = self.command(line)
+                if reply is not None:
+                    start = max(received, time.monotonic()) + self.latency
+                    self.transmit(reply, start)
+                received = time.monotonic()
+
+    def start(self):
+        """Run the bus in a background thread; returns the pty path
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.path
+
+    def stop(self):
+        self.stopping = True
+        if self.thread:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate fvcontrollers on an RS485 bus")
+    parser.add_argument(
+        'idents', nargs='*', help="Controller idents (default FV1..FVn)")
+    parser.add_argument(
+        '-n', '--controllers', type=int, default=4,
+        help="Number of controllers if no idents are given")
+    parser.add_argument(
+        '--baud', type=int, default=DEFAULT_BAUD,
+        help="Line speed, or 0 for no per-byte delay")
+    parser.add_argument(
+        '--latency', type=float, default=0.002,
+        help="Seconds before a controller starts to reply")
+    parser.add_argument(
+        '--drop', type=float, default=0.0,
+        help="Probability of a reply being dropped")
+    parser.add_argument(
+        '--partial', type=float, default=0.0,
+        help="Probability of a reply being cut off part way")
+    parser.add_argument(
+        '--noise', type=float, default=0.0,
+        help="Probability of \\0 characters in a reply")
+    parser.add_argument(
+        '--seed', type=int, help="Random number seed")
+    parser.add_argument(
+        '--link', help="Make a symbolic link to the pty at this path")
+    args = parser.parse_args()
+
+    idents = args.idents or [
+        f"FV{i}" for i in range(1, args.controllers + 1)]
+    bus = Bus(idents, baud=args.baud, latency=args.latency, drop=args.drop,
+              partial=args.partial, noise=args.noise, seed=args.seed)
+    if args.link:
+        if os.path.islink(args.link):
+            os.unlink(args.link)
+        os.symlink(bus.path, args.link)
+    print(bus.path, flush=True)
+    try:
+        bus.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link:
+            os.unlink(args.link)
@@ -0,0 +1,53 @@
+import unittest
+
+import fvbench
+import fvsim
+
+
+class SummaryTest(unittest.TestCase):
+    def test_percentile(self):
+        values = [1.0, 2.0, 3.0, 4.0, 5.0]
+        self.assertEqual(fvbench.percentile(values, 50), 3.0)
+        self.assertEqual(fvbench.percentile(values, 100), 5.0)
+        self.assertEqual(fvbench.percentile(values, 25), 2.0)
+        self.assertEqual(fvbench.percentile([1.0, 2.0], 50), 1.5)
+        self.assertIsNone(fvbench.percentile([], 50))
+
+    def test_summarise(self):
+        summary = fvbench.summarise(
+            [0.005, 0.015, 0.3, 10.0], ["ok", "ok", "timeout", "ok"], 2.0)
+        self.assertEqual(summary["transactions"], 4)
+        self.assertEqual(summary["transactions_per_second"], 2.0)
+        self.assertEqual(summary["latency"]["max"], 10.0)
+        self.assertEqual(summary["histogram"]["counts"],
+                         [1, 1, 0, 0, 0, 1, 0, 0, 0, 1])
+        self.assertEqual(summary["outcomes"], {"ok": 3, "timeout": 1})
+
+
+class BenchTest(unittest.TestCase):
+    """Each path runs against the simulated bus
+    """
+    def setUp(self):
+        self.sim = fvsim.Bus(["FV1", "FV2"], baud=0)
+        self.addCleanup(self.sim.stop)
+        self.path = self.sim.start()
+
+    def check(self, result, count):
+        self.assertEqual(result["transactions"], count)
+        self.assertEqual(result["outcomes"], {"ok": count})
+
+    def test_fvserial(self):
+        port = fvbench.free_port()
+        proc = fvbench.start_fvserial(self.path, port)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.terminate)
+        self.check(fvbench.bench_fvserial(
+            self.path, port, ["FV1", "FV2"], 10), 10)
+
+    def test_bridge(self):
+        self.check(fvbench.bench_bridge(
+            self.path, None, ["FV1", "FV2"], 10), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,215 @@
+import asyncio
+import socket
+import time
+import unittest
+
+import fvbench
+import fvserial
+import fvsim
+from fvserial import PRIORITY_POLL, PRIORITY_READ, PRIORITY_SET
+
+
+class PriorityLockTest(unittest.TestCase):
+    def test_waiters_run_by_priority_then_arrival(self):
+        async def scenario():
+            lock = fvserial.PriorityLock()
+            order = []
+
+            async def waiter(name, priority):
+                await lock.acquire(priority)
+                order.append(name)
+                lock.release()
+
+            await lock.acquire(PRIORITY_READ)
+            tasks = [asyncio.create_task(waiter(name, priority))
+                     for name, priority in [
+                         ("poll", PRIORITY_POLL), ("read1", PRIORITY_READ),
+                         ("set", PRIORITY_SET), ("read2", PRIORITY_READ)]]
+            await asyncio.sleep(0)
+            lock.release()
+            await asyncio.gather(*tasks)
+            return lock, order
+
+        lock, order = asyncio.run(scenario())
+        self.assertEqual(order, ["set", "read1", "read2", "poll"])
+        self.assertFalse(lock.locked)
+        self.assertEqual([s.depth for s in lock.stats], [0, 0, 0])
+        self.assertEqual([s.count for s in lock.stats], [1, 3, 1])
+        self.assertEqual([s.max_depth for s in lock.stats], [1, 2, 1])
+
+    def test_cancelled_waiter_leaves_queue(self):
+        async def scenario():
+            lock = fvserial.PriorityLock()
+            await lock.acquire(PRIORITY_READ)
+            task = asyncio.create_task(lock.acquire(PRIORITY_POLL))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            lock.release()
+            return lock
+
+        lock = asyncio.run(scenario())
+        self.assertEqual(lock.waiters, [])
+        self.assertFalse(lock.locked)
+        self.assertEqual(lock.stats[PRIORITY_POLL].depth, 0)
+
+    def test_lock_handed_to_cancelled_waiter_is_passed_on(self):
+        async def scenario():
+            lock = fvserial.PriorityLock()
+            await lock.acquire(PRIORITY_READ)
+            first = asyncio.create_task(lock.acquire(PRIORITY_SET))
+            second = asyncio.create_task(lock.acquire(PRIORITY_POLL))
+            await asyncio.sleep(0)
+            # Hand the lock to the first waiter, then cancel it before
+            # it gets to run
+            lock.release()
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            await asyncio.wait_for(second, 1.0)
+            return lock
+
+        lock = asyncio.run(scenario())
+        self.assertTrue(lock.locked)
+        self.assertEqual(lock.waiters, [])
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = fvserial.Cache({b"t0": 30.0})
+
+    def test_only_configured_registers_are_cached(self):
+        started = time.monotonic()
+        self.cache.put(b"FV1", b"t0", b"OK 18.5\n", started)
+        self.cache.put(b"FV1", b"v0", b"OK Open\n", started)
+        self.assertEqual(self.cache.get(b"FV1", b"t0"), b"OK 18.5\n")
+        self.assertIsNone(self.cache.get(b"FV1", b"v0"))
+        self.assertIsNone(self.cache.get(b"FV2", b"t0"))
+
+    def test_failures_are_not_cached(self):
+        self.cache.put(b"FV1", b"t0", b"TIMEOUT\n", time.monotonic())
+        self.assertIsNone(self.cache.get(b"FV1", b"t0"))
+
+    def test_responses_expire(self):
+        cache = fvserial.Cache({}, default_max_age=0.01)
+        cache.put(b"FV1", b"t0", b"OK 18.5\n", time.monotonic())
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(b"FV1", b"t0"))
+
+    def test_set_invalidates(self):
+        self.cache.put(b"FV1", b"t0", b"OK 18.5\n", time.monotonic())
+        self.cache.setting(b"FV1", b"t0")
+        self.cache.invalidate(b"FV1", b"t0")
+        self.assertIsNone(self.cache.get(b"FV1", b"t0"))
+
+    def test_read_started_before_set_is_not_cached(self):
+        started = time.monotonic()
+        self.cache.setting(b"FV1", b"t0")
+        self.cache.invalidate(b"FV1", b"t0")
+        self.cache.put(b"FV1", b"t0", b"OK 18.5\n", started)
+        self.assertIsNone(self.cache.get(b"FV1", b"t0"))
+        self.cache.put(b"FV1", b"t0", b"OK 19.0\n", time.monotonic())
+        self.assertEqual(self.cache.get(b"FV1", b"t0"), b"OK 19.0\n")
+
+
+class ProxyTest(unittest.TestCase):
+    """fvserial.py serving simulated controllers
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = fvsim.Bus(["FV1", "FV2"], baud=0)
+        cls.port = fvbench.free_port()
+        cls.proc = fvbench.start_fvserial(
+            cls.sim.start(), cls.port, "--cache", "set/lo=30")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.terminate()
+        cls.proc.wait()
+        cls.sim.stop()
+
+    def connect(self):
+        conn = socket.create_connection(("localhost", self.port), timeout=5)
+        f = conn.makefile("rw")
+        self.addCleanup(conn.close)
+        self.addCleanup(f.close)
+        return f
+
+    def exchange(self, f, commands, lines=None):
+        """Send all the commands, then read a response line for each
+        """
+        f.write("".join(f"{c}\n" for c in commands))
+        f.flush()
+        return [f.readline() for _ in range(lines or len(commands))]
+
+    def test_pipelined_responses_in_order(self):
+        f = self.connect()
+        commands = ["SELECT FV1", "READ ident", "SELECT FV2", "READ ident",
+                    "READ nosuch", "SELECT FV1", "READ ident"]
+        self.assertEqual(self.exchange(f, commands), [
+            "OK FV1 selected\n", "OK FV1\n", "OK FV2 selected\n", "OK FV2\n",
+            "ERR register nosuch does not exist\n",
+            "OK FV1 selected\n", "OK FV1\n"])
+
+    def test_clients_keep_their_own_selection(self):
+        first = self.connect()
+        second = self.connect()
+        self.exchange(first, ["SELECT FV1"])
+        self.exchange(second, ["SELECT FV2"])
+        for _ in range(3):
+            self.assertEqual(self.exchange(first, ["READ ident"]),
+                             ["OK FV1\n"])
+            self.assertEqual(self.exchange(second, ["READ ident"]),
+                             ["OK FV2\n"])
+
+    def test_read_without_select_times_out(self):
+        f = self.connect()
+        self.assertEqual(self.exchange(f, ["READ ident"]), ["TIMEOUT\n"])
+
+    def test_mread(self):
+        f = self.connect()
+        self.assertEqual(
+            self.exchange(f, ["MREAD FV2 ident ver nosuch"], 4),
+            ["OK MREAD 3\n", "ident OK FV2\n", "ver OK sim\n",
+             "nosuch ERR register nosuch does not exist\n"])
+        # The controller stays selected
+        self.assertEqual(self.exchange(f, ["READ ident"]), ["OK FV2\n"])
+
+    def test_set_invalidates_cache(self):
+        f = self.connect()
+        self.exchange(f, ["SELECT FV1", "SET set/lo 15"])
+        self.assertEqual(self.exchange(f, ["READ set/lo"]),
+                         ["OK 15.000000\n"])
+        # Another client's SET replaces the cached value
+        other = self.connect()
+        self.assertEqual(self.exchange(other, ["SELECT FV1", "SET set/lo 16"]),
+                         ["OK FV1 selected\n",
+                          "OK set/lo set to 16.000000\n"])
+        self.assertEqual(self.exchange(f, ["READ set/lo"]),
+                         ["OK 16.000000\n"])
+
+    def test_cached_read_does_not_use_bus(self):
+        f = self.connect()
+        self.exchange(f, ["SELECT FV2", "READ set/lo"])
+        before = self.sim.transactions
+        cached = self.exchange(f, ["READ set/lo"] * 3)
+        self.assertEqual(self.sim.transactions, before)
+        # "!" bypasses the cache
+        fresh = self.exchange(f, ["!READ set/lo"])
+        self.assertEqual(self.sim.transactions, before + 1)
+        self.assertEqual(cached, fresh * 3)
+
+    def test_priority_and_stats(self):
+        f = self.connect()
+        self.assertEqual(self.exchange(f, ["PRIORITY poll", "PRIORITY set"]),
+                         ["OK priority poll\n",
+                          "ERR PRIORITY must be read or poll\n"])
+        stats = self.exchange(f, ["STATS"], 4)
+        self.assertEqual(stats[0], "OK STATS 3\n")
+        self.assertEqual([line.split()[0] for line in stats[1:]],
+                         ["set", "read", "poll"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import select
+import unittest
+
+import fvsim
+
+
+class SimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = fvsim.Bus(["FV1", "FV2"], baud=0, seed=1)
+        self.addCleanup(self.sim.stop)
+
+    def command(self, line):
+        reply = self.sim.command(line)
+        return reply and reply.decode("ascii")
+
+    def test_only_selected_controller_answers(self):
+        self.assertIsNone(self.command("READ ident"))
+        self.assertEqual(self.command("SELECT FV2"), "OK FV2 selected\n")
+        self.assertEqual(self.command("READ ident"), "OK FV2\n")
+        self.assertIsNone(self.command("SELECT FV3"))
+        self.assertIsNone(self.command("READ ident"))
+        self.assertEqual(self.sim.transactions, 2)
+
+    def test_read_and_set(self):
+        self.command("SELECT FV1")
+        self.assertEqual(self.command("SET set/lo 15"),
+                         "OK set/lo set to 15.000000\n")
+        self.assertEqual(self.command("READ set/lo"), "OK 15.000000\n")
+        self.assertEqual(self.command("SET ver 2"), "ERR write failed\n")
+        self.assertEqual(self.command("READ nosuch"),
+                         "ERR register nosuch does not exist\n")
+        self.assertEqual(self.command("FOO"),
+                         "ERR Unknown command; try SELECT, READ, SET, "
+                         "HELP reg, SCANBUS\n")
+
+    def test_writing_error_counter_decreases_it(self):
+        self.command("SELECT FV1")
+        self.sim.controllers[0].values["err/crc"] = "5"
+        self.assertEqual(self.command("SET err/crc 3"),
+                         "OK err/crc set to 2\n")
+        self.assertEqual(self.command("SET err/crc 3"), "ERR write failed\n")
+
+    def test_faults(self):
+        self.command("SELECT FV1")
+        self.sim.partial = 1.0
+        reply = self.sim.command("READ ident")
+        self.assertFalse(reply.endswith(b"\n"))
+        self.sim.partial = 0.0
+        self.sim.noise = 1.0
+        reply = self.sim.command("READ ident")
+        self.assertIn(b"\0", reply)
+        self.assertEqual(reply.replace(b"\0", b""), b"OK FV1\n")
+        self.sim.drop = 1.0
+        self.assertIsNone(self.sim.command("READ ident"))
+
+    def test_serial_port(self):
+        fd = os.open(self.sim.start(), os.O_RDWR | os.O_NOCTTY)
+        self.addCleanup(os.close, fd)
+        os.write(fd, b"SELECT FV1\nREAD ident\n")
+        received = b""
+        while received.count(b"\n") < 2:
+            readable, _, _ = select.select([fd], [], [], 5.0)
+            self.assertTrue(readable)
+            received += os.read(fd, 1024)
+        self.assertEqual(received, b"OK FV1 selected\nOK FV1\n")
+
+
+if __name__ == "__main__":
+    unittest.main()